@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Needs Python >= 3.3, PyQt5, NumPy
+
+
+"""Times the shader script parser against the line based parser it replaced, on a corpus made of
+many concatenated copies of a .shader file. Both have to find the same shaders and preview sources.
+
+	./benchmarks/shader_parser.py [--copies N] [--repeat N] [file.shader]
+
+Without a file a script written like the ones shipped with Unvanquished is used."""
+
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import chameleon
+
+
+SAMPLE_SCRIPT = b"""// metal textures of the sample set
+
+textures/sample/metal_floor
+{
+	qer_editorimage textures/sample/metal_floor_d.tga
+	diffuseMap textures/sample/metal_floor_d
+	normalMap textures/sample/metal_floor_n
+	specularMap textures/sample/metal_floor_s
+}
+
+textures/sample/metal_light
+{
+	qer_editorImage textures/sample/metal_light_d.tga
+	q3map_surfacelight 2000
+	q3map_lightRGB 1.0 0.9 0.8
+	{
+		map textures/sample/metal_light_d
+		rgbGen identity
+	}
+	{
+		map $lightmap
+		blendFunc filter
+	}
+	{
+		map textures/sample/metal_light_a
+		blendFunc add
+		rgbGen wave sin 0.5 0.5 0 0.5
+	}
+}
+
+textures/sample/grate
+{
+	surfaceparm metalsteps
+	surfaceparm trans
+	cull none
+	{
+		map textures/sample/grate_d
+		alphaFunc GE128
+		depthWrite
+	}
+	{
+		map $lightmap
+		blendFunc filter
+		depthFunc equal
+	}
+}
+
+textures/sample/water
+{
+	qer_editorimage textures/sample/water_d.jpg
+	qer_trans 0.5
+	surfaceparm nomarks
+	surfaceparm trans
+	surfaceparm water
+	deformVertexes wave 64 sin 0 2 0 0.5
+	{
+		map textures/sample/water_d
+		blendFunc blend
+		tcMod scroll 0.01 0.02
+	}
+}
+
+textures/sample/sky
+{
+	qer_editorimage textures/sample/sky_up.tga
+	surfaceparm sky
+	surfaceparm noimpact
+	surfaceparm nolightmap
+	skyParms env/sample/sky - -
+}
+"""
+
+
+def parseLines(content):
+	"""The line based parser replaced by ShaderScriptParser, returns (name, preview source) of every
+	shader. A block starts at a line beginning with textures/, its lines are then looked at one by one."""
+	shaders = list()
+
+	try:
+		content = content.decode("ascii")
+	except UnicodeDecodeError:
+		return shaders
+
+	shader = None
+	for line in content.splitlines():
+		if line.isspace() or line.strip().startswith("//"):
+			continue
+
+		line = line.split("//", 1)[0]
+
+		if line.startswith("textures/"):
+			if shader != None:
+				parseLinesText(shaders, shader)
+			shader = line
+		elif shader != None:
+			shader += ("\n" + line)
+
+	if shader != None:
+		parseLinesText(shaders, shader)
+
+	return shaders
+
+
+def parseLinesText(shaders, text):
+	lines = text.splitlines()
+
+	name = lines.pop(0).split("/", 1)[-1]
+	preview_source = None
+
+	qer_editorimage = None
+	diffusemap = None
+	random_map = None
+
+	for line in lines:
+		line = line.strip()
+		line_lower = line.lower()
+
+		try:
+			if line_lower.startswith("qer_editorimage"):
+				qer_editorimage = line.split(None, 1)[-1]
+			elif line_lower.startswith("diffusemap"):
+				diffusemap = line.split(None, 1)[-1]
+			elif line_lower.startswith("map") and "textures/" in line:
+				random_map = line.split(None, 1)[-1]
+		except IndexError:
+			return
+
+		if qer_editorimage != None:
+			preview_source = qer_editorimage
+		elif diffusemap != None:
+			preview_source = diffusemap
+		elif random_map != None:
+			preview_source = random_map
+
+	if preview_source != None:
+		shaders.append((name, preview_source.split("/", 1)[-1].rsplit(".", 1)[0]))
+
+
+def parseBlocks(content):
+	"Parses content like a ShaderScanner does, returns (name, preview source) of every shader."
+	scanner = chameleon.ShaderScanner()
+
+	# the scanner reports every script it parses
+	with contextlib.redirect_stdout(io.StringIO()):
+		shaders = scanner._ShaderScanner__parseShaderFileContent("benchmark.shader", content)
+
+	return [(name, preview_source) for (name, preview_source, text) in shaders]
+
+
+def measure(parse, content, repeat):
+	"Returns the result of parse(content) and the best time of repeat runs."
+	best = None
+
+	for i in range(repeat):
+		start = time.perf_counter()
+		result = parse(content)
+		seconds = time.perf_counter() - start
+
+		if best == None or seconds < best:
+			best = seconds
+
+	return (result, best)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Compares the shader script parser with the line based one it replaced.")
+	parser.add_argument("script", nargs = "?", help = "a .shader file, defaults to a sample script")
+	parser.add_argument("--copies", type = int, default = 5000, help = "copies of the script concatenated into the corpus")
+	parser.add_argument("--repeat", type = int, default = 3, help = "runs per parser, the best one counts")
+	args = parser.parse_args()
+
+	if args.script != None:
+		with open(args.script, "rb") as f:
+			script = f.read()
+	else:
+		script = SAMPLE_SCRIPT
+
+	corpus = (script.rstrip(b"\n") + b"\n\n") * args.copies
+
+	(old_shaders, old_seconds) = measure(parseLines, corpus, args.repeat)
+	(new_shaders, new_seconds) = measure(parseBlocks, corpus, args.repeat)
+
+	print("%.1f MiB corpus, %d shaders" % (len(corpus) / 1024 / 1024, len(new_shaders)))
+	print("line parser:  %.3f s" % old_seconds)
+	print("block parser: %.3f s, %.2fx" % (new_seconds, old_seconds / new_seconds))
+
+	if old_shaders != new_shaders:
+		print("The parsers disagree, the line parser found " + str(len(old_shaders)) + " shaders.", file = sys.stderr)
+		sys.exit(1)
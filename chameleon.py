@@ -18,102 +18,87 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import time
+
+# before anything else is imported, --startup-benchmark measures from here
+STARTUP_TIME = time.perf_counter()
+
+import sys
+
+if __name__ == "__main__" and "--batch" in sys.argv[1:]:
+	# the batch mode runs as chameleon_core, so that neither it nor the worker processes it spawns,
+	# which import the main module again, import PyQt
+	import runpy
+	runpy.run_module("chameleon_core", run_name = "__main__", alter_sys = True)
+
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PIL   import Image
 from io    import BytesIO
 
+import argparse
+import collections
+import concurrent.futures
 import copy
+import hashlib
 import math
+import multiprocessing
+import numpy
 import os
 import pickle
-import platform
+import re
 import shutil
-import subprocess
-import sys
+import sqlite3
+import struct
 import tempfile
-import zipfile
+import threading
 
+import chameleon_core
+from chameleon_core import Batch, MapModifiedError, Rules, ShaderCache, ShaderCacheVersionError, ShaderIndex
 
-class Static():
-	APP_TITLE = "Chameleon"
-	GAME_TITLE = "Unvanquished"
+# Pillow, subprocess and zipfile are imported by the functions using them, they are not needed
+# to show the window and Pillow alone takes about as long to import as PyQt.
 
+
+class Static(chameleon_core.Static):
 	PREVIEW_WIDTH = 128
 	PREVIEW_HEIGHT = 128
 
+	# worker processes used to scan shader sources, 1 scans on the loading thread
+	SCAN_PROCESSES = os.cpu_count() or 1
+
+	# seconds between progress updates and refreshes of the shaders shown while shaders are loaded
+	LOADING_UPDATE_INTERVAL = 0.25
+
+	# only read texture dimensions while scanning and decode previews when they are shown
+	LAZY_PREVIEWS = True
+
+	# threads decoding the previews shown by the shader picker and seconds between refreshes of the previews decoded
+	THUMBNAIL_THREADS = os.cpu_count() or 1
+	THUMBNAIL_UPDATE_INTERVAL = 0.1
+
+	# crunch processes run at once and textures decoded per crunch process
+	CRUNCH_PROCESSES = os.cpu_count() or 1
+	CRUNCH_BATCH_SIZE = 32
+
+	# memory used by decoded and by scaled and rotated previews kept for repaints, in bytes
+	PREVIEW_CACHE_BUDGET = 64 * 1024 * 1024
+	TRANSFORMED_PREVIEW_CACHE_BUDGET = 64 * 1024 * 1024
+
+	# candidates listed by the shader picker when looking for similar shaders
+	SIMILAR_SHADER_COUNT = 256
+
+	# previews decoded to compare looks without asking first, lazy previews leave the whole install undecoded
+	DESCRIPTOR_CONFIRM_COUNT = 500
+
+	# weights of name, aspect ratio and look when suggesting replacements
+	SUGGESTION_WEIGHTS = (0.5, 0.2, 0.3)
+
 	# no dot
 	TEXTURE_CRUNCH_EXTENSION = ("crn", "dds", "ktx")
 	TEXTURE_EXTENSIONS = ("tga", "png", "jpg", "jpeg", "webp") + TEXTURE_CRUNCH_EXTENSION
 
-	MAP_FILE_EXTENSION = ".map"
-	RULE_FILE_EXTENSION = ".rules"
-
-	QtCore.QCoreApplication.setApplicationName("Chameleon")
-	standardConfigParentDir = os.path.dirname(QtCore.QStandardPaths.standardLocations(QtCore.QStandardPaths.AppConfigLocation)[0])
-	standardApplicationParentDir = os.path.dirname(QtCore.QStandardPaths.standardLocations(QtCore.QStandardPaths.ApplicationsLocation)[0])
-	standardDataParentDir = os.path.dirname(QtCore.QStandardPaths.standardLocations(QtCore.QStandardPaths.AppDataLocation)[0])
-	standardCacheParentDir = os.path.dirname(QtCore.QStandardPaths.standardLocations(QtCore.QStandardPaths.CacheLocation)[0])
-
-	old_settings_dir = None
-
-	if platform.system() == "Windows":
-		old_settings_dir = os.path.join(os.path.expandvars("%APPDATA%", APP_TITLE))
-		# "My Games" is not a Microsoft standard but a de facto standard,
-		# there is no environement variable and the name is not expected to be localized.
-		DEFAULT_HOMEPATH = os.path.join(os.path.expandvars("%CSIDL_MYDOCUMENTS%"), "My Games", GAME_TITLE)
-		DEFAULT_BASEPATH = os.path.join(os.path.expandvars("%PROGRAMFILES%"), GAME_TITLE)
-		# Qt is broken and uses a disposable place (Local App Data) to save configuration,
-		# The data folder is correct anyway.
-		SETTINGS_DIR = os.path.join(standardDataParentDir, APP_TITLE)
-		# There is no distinction between configuration and data on Windows anyway.
-		DATA_DIR = SETTINGS_DIR
-		CACHE_DIR = os.path.join(standardCacheParentDir, APP_TITLE)
-	elif platform.system() == "Darwin":
-		DEFAULT_HOMEPATH = os.path.join(standardDataParentDir, GAME_TITLE)
-		DEFAULT_BASEPATH = os.path.join(standardApplicationParentDir, GAME_TITLE + ".app", "Contents", "MacOS")
-		SETTINGS_DIR = os.path.join(standardConfigParentDir, APP_TITLE)
-		DATA_DIR = os.path.join(standardDataParentDir, APP_TITLE)
-		CACHE_DIR = os.path.join(standardCacheParentDir, APP_TITLE)
-	else: # Assume Linux or other Posix system.
-		old_settings_dir = os.path.join(os.path.expandvars("${HOME}"), "." + APP_TITLE.lower())
-		DEFAULT_HOMEPATH = os.path.join(standardDataParentDir, GAME_TITLE.lower())
-		DEFAULT_BASEPATH = os.path.join(DEFAULT_HOMEPATH, "base")
-		SETTINGS_DIR = os.path.join(standardConfigParentDir, APP_TITLE.lower())
-		DATA_DIR = os.path.join(standardDataParentDir, APP_TITLE.lower())
-		CACHE_DIR = os.path.join(standardCacheParentDir, APP_TITLE.lower())
-
-	DEFAULT_PAKDIR = "pkg"
-
-	os.makedirs(os.path.dirname(SETTINGS_DIR), exist_ok=True)
-	os.makedirs(os.path.dirname(CACHE_DIR), exist_ok=True)
-
-	if old_settings_dir:
-		# What if it fails?
-		if os.path.isdir(old_settings_dir) and not os.path.exists(SETTINGS_DIR):
-			for file_name in [ "shader_cache.dat" ]:
-				old_file_path = os.path.join(old_settings_dir, file_name)
-				new_file_path = os.path.join(CACHE_DIR, file_name)
-				if os.path.exists(old_file_path) and not os.path.exists(new_file_path):
-					os.makedirs(CACHE_DIR, exist_ok=True)
-					shutil.move(old_file_path, new_file_path)
-			for file_name in [ "session.dat" ]:
-				old_file_path = os.path.join(old_settings_dir, file_name)
-				new_file_path = os.path.join(DATA_DIR, file_name)
-				if os.path.exists(old_file_path) and not os.path.exists(new_file_path):
-					os.makedirs(DATA_DIR, exist_ok=True)
-					shutil.move(old_file_path, new_file_path)
-			shutil.move(old_settings_dir, SETTINGS_DIR)
-
-	# Exceptions uncatched on purpose.
-	os.makedirs(SETTINGS_DIR, exist_ok=True)
-	os.makedirs(CACHE_DIR, exist_ok=True)
-
-	SHADER_CACHE_FILE = os.path.join(CACHE_DIR, "shader_cache.dat")
-	SESSION_FILE = os.path.join(DATA_DIR, "session.dat")
-
 	@staticmethod
-	def progressDialog():
-		pd = QtWidgets.QProgressDialog("Loading available shaders ...", None, 0, 1)
+	def progressDialog(label = "Loading available shaders ..."):
+		pd = QtWidgets.QProgressDialog(label, None, 0, 1)
 		pd.show()
 		return pd
 
@@ -225,6 +210,11 @@ class ShaderTableModel(QtCore.QAbstractTableModel):
 		self.beginResetModel()
 		self.endResetModel()
 
+	def refresh(self):
+		"Updates every cell but keeps the rows, called as shaders get loaded."
+		if self.rowCount() > 0:
+			self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount() - 1, self.columns - 1))
+
 	def markChanged(self, row, newOnly):
 		if newOnly:
 			begin = 4
@@ -263,6 +253,9 @@ class ShaderTableModel(QtCore.QAbstractTableModel):
 		row = index.row()
 		col = index.column()
 
+		if col in (7, 8, 9):
+			self.__invalidateNewPreview(shader)
+
 		if   col == 7:
 			self.model.rules.setHScale(shader, value)
 			self.dataChanged.emit(index, index)
@@ -277,6 +270,14 @@ class ShaderTableModel(QtCore.QAbstractTableModel):
 
 		return True
 
+	def __invalidateNewPreview(self, shader):
+		rules = self.model.rules
+
+		self.model.shaders.invalidateTransformedPreview(
+			rules.getNewShader(shader), shader,
+			rules.getHScale(shader), rules.getVScale(shader), rules.getRotation(shader)
+		)
+
 	def data(self, index, role):
 		row = index.row()
 		col = index.column()
@@ -337,9 +338,10 @@ class ShaderTableModel(QtCore.QAbstractTableModel):
 
 
 class ShaderSourcesWizzard(QtWidgets.QWizard):
-	def __init__(self, model):
+	def __init__(self, view, model):
 		QtWidgets.QWizard.__init__(self)
 
+		self.view = view
 		self.model = model
 
 		old_basepath = self.model.shaders.getBasepath()
@@ -369,7 +371,7 @@ class ShaderSourcesWizzard(QtWidgets.QWizard):
 		self.addPage(self.ShaderSourcesWizzardPage1(self))
 
 	def accept(self):
-		self.model.loadShaders(Static.progressDialog(), self.basepathField.text(), self.homepathField.text(), self.pakdirField.text())
+		self.view.loadShaders(self.basepathField.text(), self.homepathField.text(), self.pakdirField.text())
 
 		self.close()
 
@@ -403,10 +405,13 @@ class ShaderSourcesWizzard(QtWidgets.QWizard):
 
 
 class ShaderPickerListModel(QtCore.QAbstractListModel):
-	def __init__(self, model, shaders):
+	def __init__(self, model, shaders, thumbnails):
 		QtCore.QAbstractListModel.__init__(self)
 		self.model = model
 		self.shaders = shaders
+		self.thumbnails = thumbnails
+
+		self.waiting = dict() # texture -> rows showing the loading image until its preview is decoded
 
 	def rowCount(self, index = None):
 		return len(self.shaders)
@@ -415,10 +420,34 @@ class ShaderPickerListModel(QtCore.QAbstractListModel):
 		shader = self.shaders[index.row()]
 
 		if role == QtCore.Qt.DecorationRole:
-			return self.model.shaders.getPreview(shader)
+			job = self.model.shaders.getPreviewJob(shader)
+
+			if job == None:
+				return self.model.shaders.getPreview(shader)
+
+			self.waiting.setdefault(job[0], set()).add(index.row())
+			self.thumbnails.request(job)
+
+			return self.model.shaders.getLoadingPreview()
 		elif role == QtCore.Qt.DisplayRole:
 			return shader.split("/", 1)[-1]
 
+	def getPreviewJobs(self, first, last):
+		"Returns the jobs of the rows from first to last whose preview isn't decoded yet."
+		jobs = [self.model.shaders.getPreviewJob(shader) for shader in self.shaders[first:last + 1]]
+
+		return [job for job in jobs if job != None]
+
+	def updatePreviews(self, textures):
+		"Updates the rows waiting for the previews of textures, adjacent rows by a single dataChanged."
+		rows = sorted(row for texture in textures for row in self.waiting.pop(texture, ()))
+
+		start = 0
+		for end in range(1, len(rows) + 1):
+			if end == len(rows) or rows[end] != rows[end - 1] + 1:
+				self.dataChanged.emit(self.index(rows[start]), self.index(rows[end - 1]), [QtCore.Qt.DecorationRole])
+				start = end
+
 
 class ShaderPicker(QtWidgets.QDialog):
 	def __init__(self, view, model, old_shader):
@@ -439,6 +468,8 @@ class ShaderPicker(QtWidgets.QDialog):
 
 		self.setname2item = dict()
 
+		self.thumbnails = ThumbnailProvider(self.model.shaders)
+
 		# configure window
 		self.setWindowTitle("Pick a replacement for " + self.old_shader)
 
@@ -466,6 +497,25 @@ class ShaderPicker(QtWidgets.QDialog):
 		self.new_data_label.setMinimumWidth(256)
 		self.new_data_label.setMaximumWidth(256)
 
+		self.search_edit = QtWidgets.QLineEdit(self)
+		self.search_edit.setPlaceholderText("Search all sets")
+		self.search_edit.setClearButtonEnabled(True)
+		self.search_edit.setMinimumWidth(180)
+		self.search_edit.setMaximumWidth(180)
+
+		self.similar_button = QtWidgets.QPushButton("Find similar", self)
+		self.similar_button.setCheckable(True)
+		self.__updateSimilarButton()
+		self.similar_button.setMinimumWidth(180)
+		self.similar_button.setMaximumWidth(180)
+
+		self.undecoded = 0 # textures left out of the similarity ranking, their previews aren't decoded
+		self.similar_label = QtWidgets.QLabel(self)
+		self.similar_label.setWordWrap(True)
+		self.similar_label.setMinimumWidth(180)
+		self.similar_label.setMaximumWidth(180)
+		self.similar_label.hide()
+
 		self.set_list = QtWidgets.QListWidget(self)
 		self.set_list.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
 		self.set_list.setMinimumWidth(180)
@@ -489,8 +539,14 @@ class ShaderPicker(QtWidgets.QDialog):
 		toplayout.addWidget(self.new_preview_label)
 		toplayout.addWidget(self.new_data_label)
 
+		leftlayout = QtWidgets.QVBoxLayout()
+		leftlayout.addWidget(self.search_edit)
+		leftlayout.addWidget(self.similar_button)
+		leftlayout.addWidget(self.similar_label)
+		leftlayout.addWidget(self.set_list)
+
 		centerlayout = QtWidgets.QHBoxLayout()
-		centerlayout.addWidget(self.set_list)
+		centerlayout.addLayout(leftlayout)
 		centerlayout.addWidget(self.shader_list)
 
 		bottomlayout = QtWidgets.QHBoxLayout()
@@ -506,8 +562,12 @@ class ShaderPicker(QtWidgets.QDialog):
 		self.setLayout(rootlayout)
 
 		# connect signals
+		self.search_edit.textChanged.connect(self.__handleSearch)
+		self.similar_button.clicked.connect(self.__handleSimilar)
 		self.set_list.itemSelectionChanged.connect(self.__handleSelectedSets)
 		self.shader_list.clicked.connect(self.__handleClickedShader)
+		self.shader_list.verticalScrollBar().valueChanged.connect(self.__prioritizeVisibleRows)
+		self.thumbnails.previewsDecoded.connect(self.__handlePreviewsDecoded)
 		self.replace_button.clicked.connect(self.__handleReplace)
 		self.cancel_button.clicked.connect(self.__handleCancel)
 		self.clear_button.clicked.connect(self.__handleClear)
@@ -541,18 +601,87 @@ class ShaderPicker(QtWidgets.QDialog):
 	def resizeEvent(self, event):
 		self.shader_list.reset()
 
+	def hideEvent(self, event):
+		# closing and Escape both hide the dialog
+		self.thumbnails.cancel()
+
+		QtWidgets.QDialog.hideEvent(self, event)
+
+	def refresh(self):
+		"Updates the sets and the listed shaders, called as shaders get loaded."
+		setnames = self.model.shaders.getSets()
+		lastsets = self.view.session.getLastShaderSets() or list()
+
+		# the selection of sets not loaded yet is kept in the session
+		self.set_list.blockSignals(True)
+
+		for setname in set(self.setname2item).difference(setnames):
+			self.set_list.takeItem(self.set_list.row(self.setname2item.pop(setname)))
+
+		# both are sorted
+		for row in range(len(setnames)):
+			if setnames[row] not in self.setname2item:
+				item = QtWidgets.QListWidgetItem(setnames[row])
+				self.set_list.insertItem(row, item)
+				self.setname2item[setnames[row]] = item
+				item.setSelected(setnames[row] in lastsets)
+
+		self.set_list.blockSignals(False)
+
+		self.__updateSimilarButton()
+
+		self.__updateShaders()
+
+	def __updateSimilarButton(self):
+		# the trigram index is only rebuilt once all sources are loaded
+		self.similar_button.setEnabled(self.old_shader in self.model.shaders and not self.view.isLoadingShaders())
+
+	def __handleSearch(self, text):
+		# typing leaves the similarity ranking
+		self.similar_button.setChecked(False)
+
+		self.__updateShaders()
+
+	def __handleSimilar(self, checked):
+		if checked:
+			# nothing can be ranked without the look of the old shader
+			self.view.loadDescriptors([self.old_shader])
+			self.undecoded = self.view.loadDescriptors()
+
+		self.__updateShaders()
+
 	def __handleSelectedSets(self):
 		setnames = [setname.text() for setname in self.set_list.selectedItems()]
 		setnames.sort()
 
 		self.view.session.setLastShaderSets(setnames)
 
-		self.selected_shaders.clear()
+		self.__updateShaders()
+
+	def __updateShaders(self):
+		"Shows the similarity ranking, the search results or the selected sets, in that order."
+		# a ranking of part of the shaders says so
+		self.similar_label.setText(str(self.undecoded) + " textures are not ranked, their previews were not decoded.")
+		self.similar_label.setVisible(self.similar_button.isChecked() and self.undecoded > 0)
+
+		if self.similar_button.isChecked():
+			shaders = [
+				shader for shader in self.model.shaders.getSimilarShaders(self.old_shader, Static.SIMILAR_SHADER_COUNT + 1)
+				if shader != self.old_shader
+			]
+		elif self.search_edit.text() != "":
+			shaders = self.model.shaders.searchShaders(self.search_edit.text())
+		else:
+			shaders = list()
+
+			for setname in sorted(setname.text() for setname in self.set_list.selectedItems()):
+				shaders.extend(self.model.shaders.getShadersForSet(setname))
 
-		for setname in setnames:
-			for shader in self.model.shaders.getShadersForSet(setname):
-				self.selected_shaders.append(shader)
+		# refreshing while shaders are loaded keeps the scroll position when nothing changed
+		if shaders == self.selected_shaders and self.shader_list.model() != None:
+			return
 
+		self.selected_shaders = shaders
 		self.__showShaders(self.selected_shaders)
 
 	def __handleClickedShader(self, index):
@@ -567,7 +696,46 @@ class ShaderPicker(QtWidgets.QDialog):
 		self.new_preview_label.setPixmap(self.model.shaders.getPreview(shader))
 
 	def __showShaders(self, shaders):
-		self.shader_list.setModel(ShaderPickerListModel(self.model, shaders))
+		# previews of the shaders shown before aren't needed anymore
+		self.thumbnails.clear()
+
+		self.shader_list.setModel(ShaderPickerListModel(self.model, shaders, self.thumbnails))
+
+	def __handlePreviewsDecoded(self, textures):
+		if self.shader_list.model() != None:
+			self.shader_list.model().updatePreviews(textures)
+
+	def __prioritizeVisibleRows(self):
+		"Lets the previews of the rows scrolled to be decoded before the others."
+		model = self.shader_list.model()
+
+		if model == None or model.rowCount() == 0:
+			return
+
+		height = self.shader_list.viewport().height()
+
+		first = self.__findRow(lambda rect: rect.bottom() >= 0)
+		last = self.__findRow(lambda rect: rect.top() > height) - 1
+
+		self.thumbnails.prioritize(model.getPreviewJobs(first, last))
+
+	def __findRow(self, predicate):
+		"""Returns the first row whose rectangle in the viewport fulfills predicate by a binary search,
+		rows are laid out from top to bottom so predicate holds for the rows after it as well."""
+		model = self.shader_list.model()
+
+		low = 0
+		high = model.rowCount()
+
+		while low < high:
+			middle = (low + high) // 2
+
+			if predicate(self.shader_list.visualRect(model.index(middle))):
+				high = middle
+			else:
+				low = middle + 1
+
+		return low
 
 	def __handleReplace(self):
 		self.accepted = True
@@ -591,6 +759,57 @@ class ShaderPicker(QtWidgets.QDialog):
 		QtWidgets.QDialog.close(self)
 
 
+class SuggestRulesDialog(QtWidgets.QDialog):
+	"Asks which sets the replacements suggested for the map shaders without a rule are taken from."
+
+	def __init__(self, view, model):
+		QtWidgets.QDialog.__init__(self, view)
+		self.view = view
+		self.model = model
+
+		self.setWindowTitle("Suggest rules")
+
+		# create widgets
+		self.help_label = QtWidgets.QLabel(
+			"Replacements are taken from the selected sets, from all sets if none is selected.\n"
+			"The sets selected in the shader picker are selected to begin with.", self
+		)
+
+		self.set_list = QtWidgets.QListWidget(self)
+		self.set_list.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+
+		lastsets = self.view.session.getLastShaderSets() or list()
+		for setname in self.model.shaders.getSets():
+			item = QtWidgets.QListWidgetItem(setname)
+			self.set_list.addItem(item)
+			item.setSelected(setname in lastsets)
+
+		self.skip_own_set_box = QtWidgets.QCheckBox("Skip the shaders of the set the map shader belongs to", self)
+		self.skip_own_set_box.setChecked(True)
+
+		self.button_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel, self)
+
+		# assemble layout
+		rootlayout = QtWidgets.QVBoxLayout()
+		rootlayout.addWidget(self.help_label)
+		rootlayout.addWidget(self.set_list)
+		rootlayout.addWidget(self.skip_own_set_box)
+		rootlayout.addWidget(self.button_box)
+
+		self.setLayout(rootlayout)
+
+		# connect signals
+		self.button_box.accepted.connect(self.accept)
+		self.button_box.rejected.connect(self.reject)
+
+	def getSetNames(self):
+		"Returns the selected sets, sorted, an empty list stands for all sets."
+		return sorted(item.text() for item in self.set_list.selectedItems())
+
+	def getSkipOwnSet(self):
+		return self.skip_own_set_box.isChecked()
+
+
 class View(QtWidgets.QMainWindow):
 	def __init__(self, model):
 		QtWidgets.QWidget.__init__(self)
@@ -613,6 +832,8 @@ class View(QtWidgets.QMainWindow):
 		self.actionSaveRules.setEnabled(False)
 		self.actionClearRules = self.menuRules.addAction("Clear rules", self.__handleClearRules)
 		self.actionClearRules.setEnabled(False)
+		self.actionSuggestRules = self.menuRules.addAction("Suggest rules", self.__handleSuggestRules)
+		self.actionSuggestRules.setEnabled(False)
 
 		self.menuShaders = QtWidgets.QMenu("Shaders", self)
 		self.actionReloadShaders = self.menuShaders.addAction("Reload shaders", self.__handleReloadShaders, "Ctrl+R")
@@ -620,6 +841,12 @@ class View(QtWidgets.QMainWindow):
 
 		self.statusLabel = QtWidgets.QLabel("", self)
 
+		# shown while shaders are loaded
+		self.loadingBar = QtWidgets.QProgressBar(self)
+		self.loadingBar.hide()
+		self.cancelLoadingButton = QtWidgets.QPushButton("Cancel", self)
+		self.cancelLoadingButton.hide()
+
 		self.tableView = QtWidgets.QTableView()
 		self.tableModel = ShaderTableModel(self.model)
 		self.tableView.setModel(self.tableModel)
@@ -632,6 +859,8 @@ class View(QtWidgets.QMainWindow):
 
 		bottomlayout = QtWidgets.QHBoxLayout()
 		bottomlayout.addWidget(self.statusLabel)
+		bottomlayout.addWidget(self.loadingBar)
+		bottomlayout.addWidget(self.cancelLoadingButton)
 
 		rootlayout = QtWidgets.QVBoxLayout()
 		rootlayout.addWidget(self.tableView)
@@ -645,17 +874,124 @@ class View(QtWidgets.QMainWindow):
 
 		# connect signals
 		self.tableView.clicked.connect(self.__handleTableClicked)
+		self.cancelLoadingButton.clicked.connect(self.__handleCancelLoading)
+
+		self.cacheReader = None
+		self.shaderLoader = None
+		self.picker = None # shown while shaders are loaded, refreshed with the table
+		self.startupBenchmark = False
+		self.startupLimits = (None, None) # seconds to show the window and to read the cache, None for no limit
+		self.startupTooSlow = False
+
+	def start(self, benchmark = False, limits = (None, None)):
+		"""Called by __main__ once the window is shown, moves the settings of older versions, restores the
+		session and reads the shader cache in the background. A benchmark prints the startup times and quits,
+		with exit status 1 if the window or the cache took longer than the given limits."""
+		self.startupBenchmark = benchmark
+		self.startupLimits = limits
+
+		if benchmark:
+			self.__printStartupTime("Window shown", self.startupLimits[0])
+
+		Static.makeDirs()
+		self.restoreSession()
+
+		# shaders can't be loaded while the cache is read
+		self.actionReloadShaders.setEnabled(False)
+		self.actionSettings.setEnabled(False)
+		self.setStatus("Loading shaders from cache ...")
+
+		self.cacheReader = CacheReader(self.model.shaders.cache)
+		self.cacheReader.finished.connect(self.__handleCacheRead)
+		self.cacheReader.start()
+
+	def __printStartupTime(self, step, limit, details = ""):
+		seconds = time.perf_counter() - STARTUP_TIME
+		print("%s after %.3f s%s." % (step, seconds, details))
+
+		if limit != None and seconds > limit:
+			print("%s after more than %.3f s." % (step, limit), file = sys.stderr)
+			self.startupTooSlow = True
 
 	def setStatus(self, status):
 		"Called by Model.* to display stuff in the status bar."
 		self.statusLabel.setText(status)
 
 	def askSettings(self):
-		"Called by __main__ to show configuration dialog."
-		sw = ShaderSourcesWizzard(self.model)
+		"Called once no shader cache was found and from the menu to show configuration dialog."
+		sw = ShaderSourcesWizzard(self, self.model)
 		sw.exec_()
 
-		self.__updateTable()
+	def loadShaders(self, basepath, homepath, pakdir, reload = False):
+		"""Called by ShaderSourcesWizzard and to reload shaders, loads them in the background.
+		Shaders show up in the table and the picker as their sources get scanned."""
+		self.actionReloadShaders.setEnabled(False)
+		self.actionSettings.setEnabled(False)
+
+		self.setStatus("Loading shaders ...")
+		self.loadingBar.setRange(0, 0)
+		self.loadingBar.show()
+		self.cancelLoadingButton.setEnabled(True)
+		self.cancelLoadingButton.show()
+
+		self.shaderLoader = ShaderLoader(self.model.shaders, basepath, homepath, pakdir, reload)
+		self.shaderLoader.progressChanged.connect(self.__handleLoadingProgress)
+		self.shaderLoader.recordsScanned.connect(self.__handleRecordsScanned)
+		self.shaderLoader.finished.connect(self.__handleShadersLoaded)
+		self.shaderLoader.start()
+
+		self.__updateSuggestRulesAction()
+
+	def isLoadingShaders(self):
+		"Whether shaders are loaded in the background, the search indexes are incomplete until they are."
+		return self.shaderLoader != None
+
+	def loadDescriptors(self, shaders = None):
+		"""Called by ShaderPicker and before suggesting rules, decodes the previews of shaders, all shaders
+		by default, that weren't decoded yet on the threads of a ThumbnailProvider. Canceling keeps the
+		descriptors computed so far. Returns the number of previews that are still not decoded."""
+		jobs = [self.model.shaders.getPreviewJob(texture) for texture in self.model.shaders.getTexturesWithoutDescriptor(shaders)]
+		jobs = [job for job in jobs if job != None]
+
+		if len(jobs) == 0:
+			return 0
+
+		if len(jobs) > Static.DESCRIPTOR_CONFIRM_COUNT:
+			answer = QtWidgets.QMessageBox.question(
+				self, Static.APP_TITLE,
+				"Comparing looks needs the previews of " + str(len(jobs)) + " textures that were not decoded yet, "
+				"this can take a while. Decode them now?\n"
+				"Textures whose preview is not decoded are compared by name and size only or not at all."
+			)
+
+			if answer != QtWidgets.QMessageBox.Yes:
+				return len(jobs)
+
+		thumbnails = ThumbnailProvider(self.model.shaders)
+		loop = QtCore.QEventLoop()
+
+		pd = QtWidgets.QProgressDialog("Decoding previews ...", "Cancel", 0, len(jobs), self)
+		pd.setWindowModality(QtCore.Qt.WindowModal)
+		pd.setMinimumDuration(0)
+		pd.canceled.connect(loop.quit)
+
+		thumbnails.previewsDecoded.connect(lambda textures: self.__handleDescriptorsDecoded(thumbnails, pd, loop))
+
+		for job in jobs:
+			thumbnails.request(job)
+
+		loop.exec_()
+
+		thumbnails.cancel()
+		pd.close()
+
+		return len(self.model.shaders.getTexturesWithoutDescriptor(shaders))
+
+	def __handleDescriptorsDecoded(self, thumbnails, pd, loop):
+		pd.setValue(thumbnails.done)
+
+		if thumbnails.isIdle():
+			loop.quit()
 
 	def restoreSession(self):
 		"Tries to read session data from filesystem."
@@ -670,6 +1006,15 @@ class View(QtWidgets.QMainWindow):
 			return True
 
 	def closeEvent(self, event):
+		# reading SQLite can't be interrupted
+		if self.cacheReader != None:
+			self.cacheReader.wait()
+
+		# the sources being scanned are still waited for
+		if self.shaderLoader != None:
+			self.shaderLoader.cancel()
+			self.shaderLoader.wait()
+
 		try:
 			self.session.saveSession(Static.SESSION_FILE)
 		except BaseException as e:
@@ -713,10 +1058,11 @@ class View(QtWidgets.QMainWindow):
 		if index.column() == 4: # new old_shader preview
 			old_shader = self.model.map.indexToShader(index.row())
 
-			picker = ShaderPicker(self, self.model, old_shader)
-			picker.exec_()
-			new_shader = picker.getNewShader()
-			clear = picker.getClear()
+			self.picker = ShaderPicker(self, self.model, old_shader)
+			self.picker.exec_()
+			new_shader = self.picker.getNewShader()
+			clear = self.picker.getClear()
+			self.picker = None
 
 			if clear:
 				self.model.rules.delRule(old_shader)
@@ -728,6 +1074,10 @@ class View(QtWidgets.QMainWindow):
 			self.__updateTable(old_shader)
 			self.__updateRulesButton()
 
+	def __updateSuggestRulesAction(self):
+		# suggestions need a map and the trigram index, which is only rebuilt once all sources are loaded
+		self.actionSuggestRules.setEnabled(self.actionSaveMap.isEnabled() and not self.isLoadingShaders())
+
 	def __handleOpenMap(self):
 		path, _filter = QtWidgets.QFileDialog.getOpenFileName(
 			self,
@@ -742,6 +1092,7 @@ class View(QtWidgets.QMainWindow):
 
 			self.setWindowTitle(Static.APP_TITLE + " - " + os.path.basename(path))
 			self.actionSaveMap.setEnabled(True)
+			self.__updateSuggestRulesAction()
 			self.__updateTable()
 
 	def __handleSaveMap(self):
@@ -753,7 +1104,42 @@ class View(QtWidgets.QMainWindow):
 		if path != "":
 			if not path.endswith(Static.MAP_FILE_EXTENSION):
 				path += Static.MAP_FILE_EXTENSION
-			self.model.saveMap(path)
+
+			# faces are copied from the opened map, which can be changed, moved or deleted meanwhile
+			try:
+				self.model.saveMap(path)
+			except (OSError, ValueError) as e:
+				self.__handleSaveMapFailure(path, e)
+				return
+
+			self.__updateTable()
+
+	def __handleSaveMapFailure(self, path, e):
+		"Reports a map that could not be saved and offers to open the map again, the rules are kept."
+		self.setStatus("Failed to save map " + path + ".")
+		message = "Failed to save map " + path + ":\n" + str(e) + "\n\n"
+
+		if not os.path.isfile(self.model.map.path):
+			QtWidgets.QMessageBox.warning(self, Static.APP_TITLE, message +
+				"The opened map " + self.model.map.path + " is gone. The rules are kept, save them or open another map.")
+			return
+
+		if isinstance(e, MapModifiedError):
+			message += "The opened map was changed by another program since it was opened."
+		else:
+			message += "Nothing was written."
+
+		answer = QtWidgets.QMessageBox.question(self, Static.APP_TITLE, message + "\nOpen the map again? The rules are kept.")
+
+		if answer != QtWidgets.QMessageBox.Yes:
+			return
+
+		try:
+			self.model.openMap(self.model.map.path)
+		except (OSError, ValueError) as e:
+			self.setStatus("Failed to open map " + self.model.map.path + ": " + str(e))
+
+		self.__updateTable()
 
 	def __handleOpenRules(self):
 		path, _filter = QtWidgets.QFileDialog.getOpenFileName(
@@ -776,6 +1162,25 @@ class View(QtWidgets.QMainWindow):
 		self.__updateTable()
 		self.setStatus("Rules cleared.")
 
+	def __handleSuggestRules(self):
+		dialog = SuggestRulesDialog(self, self.model)
+
+		if not dialog.exec_():
+			return
+
+		old_shaders = self.model.getShadersWithoutRule()
+		candidates = self.model.getCandidates(dialog.getSetNames())
+
+		# only the looks of the shaders compared are needed
+		undecoded = self.loadDescriptors(old_shaders + candidates)
+
+		pd = Static.progressDialog("Suggesting rules ...")
+		self.model.suggestRules(pd, old_shaders, candidates, dialog.getSkipOwnSet(), undecoded)
+		pd.close()
+
+		self.__updateRulesButton()
+		self.__updateTable()
+
 	def __handleSaveRules(self):
 		path, _filter = QtWidgets.QFileDialog.getSaveFileName(
 			self,
@@ -789,899 +1194,1824 @@ class View(QtWidgets.QMainWindow):
 			self.model.saveRules(path)
 
 	def __handleReloadShaders(self):
-		self.model.reloadShaders(Static.progressDialog())
+		shaders = self.model.shaders
 
-		self.__updateTable()
+		self.loadShaders(shaders.getBasepath(), shaders.getHomepath(), shaders.getPakdir(), True)
 
 	def __handleSettings(self):
 		self.askSettings()
 
+	def __handleCancelLoading(self):
+		self.shaderLoader.cancel()
 
-class Shaders():
-	def __init__(self):
-		self.basepath = None
-		self.homepath = None
-		self.pakdir = None
-		self.shader_sources = list() # dirs/pk3s inside self.basepath/self.homepath
-		self.shaders = dict() # shader name -> property -> value
-
-		painter = QtGui.QPainter()
-
-		# build NO PREVIEW image
-		self.pixmap_not_found = QtGui.QPixmap(128, 128)
-		self.pixmap_not_found.fill(QtCore.Qt.black)
-		painter.begin(self.pixmap_not_found)
-		painter.setPen(QtCore.Qt.red)
-		painter.drawText(QtCore.QPointF(24, 67), "NOT FOUND")
-		painter.end()
-
-		# build UNSUPPORTED image
-		self.pixmap_unsupported = QtGui.QPixmap(128, 128)
-		self.pixmap_unsupported.fill(QtCore.Qt.black)
-		painter.begin(self.pixmap_unsupported)
-		painter.setPen(QtCore.Qt.yellow)
-		painter.drawText(QtCore.QPointF(13, 67), "UNSUPPORTED")
-		painter.end()
-
-		# build REPLACE image
-		self.pixmap_replace = QtGui.QPixmap(128, 128)
-		self.pixmap_replace.fill(QtCore.Qt.black)
-		painter.begin(self.pixmap_replace)
-		painter.setPen(QtCore.Qt.white)
-		painter.drawText(QtCore.QPointF(32, 67), "REPLACE")
-		painter.end()
-
-	def __contains__(self, shader):
-		return shader in self.shaders
-
-	def __len__(self):
-		return len(self.shaders)
+		self.cancelLoadingButton.setEnabled(False)
+		self.setStatus("Canceling, waiting for the sources being scanned ...")
 
-	def emtpy(self):
-		return len(self) == 0
+	def __handleLoadingProgress(self, value, maximum):
+		self.loadingBar.setRange(0, maximum)
+		self.loadingBar.setValue(value)
 
-	def writeCache(self, path):
-		with open(path, "wb") as f:
-			state = (self.basepath, self.homepath, self.shader_sources, self.shaders)
-			pickle.dump(state, f)
+	def __handleRecordsScanned(self, sources_records):
+		self.model.shaders.addScannedRecords(sources_records)
 
-	def readCache(self, path):
-		with open(path, "rb") as f:
-			state = pickle.load(f)
-			(self.basepath, self.homepath, self.shader_sources, self.shaders) = state
+		self.tableModel.refresh()
 
-	def getPath(self, shader):
-		if shader in self.shaders and not self.shaders[shader]["is_shader"]:
-			return self.shaders[shader]["path"]
-		else:
-			return ""
+		if self.picker != None:
+			self.picker.refresh()
 
-	def getPreviewScale(self, shader):
-		if shader in self.shaders:
-			if self.shaders[shader]["is_shader"]:
-				preview_source = self.shaders[shader]["preview_source"]
-				if preview_source in self.shaders \
-				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
-					return self.getPreviewScale(preview_source)
-				else:
-					return 1.0
-			else:
-				return self.shaders[shader]["preview_scale"]
-		else:
-			return 1.0
+		if self.cancelLoadingButton.isEnabled():
+			self.setStatus("Loading shaders, " + str(len(self.model.shaders)) + " found so far ...")
 
-	def getPreview(self, shader = None, old_shader = None, hscale = None, vscale = None, rot = None):
-		if shader == None:
-			return self.pixmap_replace
-		elif shader in self.shaders:
-			if self.shaders[shader]["is_shader"]:
-				preview_source = self.shaders[shader]["preview_source"]
-				if preview_source in self.shaders \
-				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
-					return self.getPreview(preview_source, old_shader, hscale, vscale, rot)
-				else:
-					return self.pixmap_not_found
-			else:
-				if self.shaders[shader]["width"] == self.shaders[shader]["height"] == 0:
-					return self.pixmap_unsupported
-				else:
-					if old_shader in self.shaders and hscale != None and vscale != None and rot != None:
-						scale = self.getPreviewScale(shader) / self.getPreviewScale(old_shader)
-						hscale /= scale
-						vscale /= scale
-						trans_scale = QtGui.QTransform().scale(hscale, vscale)
-						trans_rot = QtGui.QTransform().rotate(rot)
-						preview = self.convertQByteArrayToQPixmap(self.shaders[shader]["preview"])
-						return preview.transformed(trans_scale).transformed(trans_rot)
-					else:
-						preview = self.convertQByteArrayToQPixmap(self.shaders[shader]["preview"])
-						return preview
-		else:
-			return self.pixmap_not_found
+	def __handleShadersLoaded(self):
+		# finished is emitted right before the thread ends
+		self.shaderLoader.wait()
 
-	def getWidth(self, shader):
-		if shader in self.shaders:
-			if self.shaders[shader]["is_shader"]:
-				preview_source = self.shaders[shader]["preview_source"]
-				if preview_source in self.shaders \
-				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
-					return self.getWidth(preview_source)
-				else:
-					return 0
-			else:
-				return self.shaders[shader]["width"]
-		else:
-			return 0
+		self.model.loadShaders(self.shaderLoader)
+		self.shaderLoader = None
 
-	def getHeight(self, shader):
-		if shader in self.shaders:
-			if self.shaders[shader]["is_shader"]:
-				preview_source = self.shaders[shader]["preview_source"]
-				if preview_source in self.shaders \
-				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
-					return self.getHeight(preview_source)
-				else:
-					return 0
-			else:
-				return self.shaders[shader]["height"]
-		else:
-			return 0
+		self.loadingBar.hide()
+		self.cancelLoadingButton.hide()
+		self.actionReloadShaders.setEnabled(True)
+		self.actionSettings.setEnabled(True)
+		self.__updateSuggestRulesAction()
 
-	def sizeKnown(self, shader):
-		return self.getWidth(shader) > 0 and self.getHeight(shader) > 0
+		self.__updateTable()
 
-	def getResolution(self, shader):
-		return str(self.getWidth(shader)) + " x " + str(self.getHeight(shader))
+		if self.picker != None:
+			self.picker.refresh()
 
-	def loadShaders(self, pd, basepath, homepath, pakdir, reload = False):
-		"Updates self.basepath and self.homepath and loads shader data from disk if the pathes have changed."
-		if self.basepath != basepath or self.homepath != homepath or reload:
-			necessary = True
-		else:
-			necessary = False
+	def __handleCacheRead(self):
+		# finished is emitted right before the thread ends
+		self.cacheReader.wait()
 
-		self.basepath = basepath
-		self.homepath = homepath
-		self.pakdir = pakdir
+		read = self.model.readCache(self.cacheReader)
+		outdated = self.cacheReader.isOutdated()
+		self.cacheReader = None
 
-		if necessary:
-			self.__updateShaderSources(pd)
-			self.__updateShaderData(pd)
+		self.actionReloadShaders.setEnabled(True)
+		self.actionSettings.setEnabled(True)
 
-		return necessary
+		if self.startupBenchmark:
+			self.__printStartupTime("Shader cache read", self.startupLimits[1], ", " + str(len(self.model.shaders)) + " shaders")
+			QtWidgets.QApplication.exit(1 if self.startupTooSlow else 0)
+		elif read:
+			self.__updateTable()
+		else:
+			self.setStatus("")
+
+			# nothing was discarded yet, the cache is replaced once shaders are loaded
+			if outdated:
+				QtWidgets.QMessageBox.information(
+					self, Static.APP_TITLE,
+					"The shader cache was written by another version of " + Static.APP_TITLE + ".\n"
+					"Shaders have to be loaded from disk again, the old cache is replaced once they are."
+				)
 
-	def reloadShaders(self, pd):
-		"Reloads shader data from disk."
-		self.loadShaders(pd, self.basepath, self.homepath, self.pakdir, True)
+			self.askSettings()
 
-	def getBasepath(self):
-		return self.basepath
 
-	def getHomepath(self):
-		return self.homepath
+class PixmapCache():
+	"Least recently used cache of decoded QPixmaps, bounded by the memory their pixels take."
 
-	def getPakdir(self):
-		return self.pakdir
+	def __init__(self, budget):
+		self.budget = budget # bytes
+		self.size = 0
+		self.pixmaps = collections.OrderedDict() # key -> (pixmap, cost)
 
-	# TODO: cache getSets answer?
-	def getSets(self):
-		sets = set()
+		self.hits = 0
+		self.misses = 0
 
-		for shader in self.shaders.keys():
-			sets.add(shader.split("/", 1)[0])
+	def __contains__(self, key):
+		return key in self.pixmaps
 
-		sorted_sets = list(sets)
-		sorted_sets.sort()
+	def __len__(self):
+		return len(self.pixmaps)
+
+	def get(self, key):
+		"Returns the pixmap cached for key or None, counting hits and misses."
+		if key in self.pixmaps:
+			self.pixmaps.move_to_end(key)
+			self.hits += 1
+			return self.pixmaps[key][0]
+		else:
+			self.misses += 1
+			return None
 
-		return sorted_sets
+	def put(self, key, pixmap):
+		self.remove(key)
 
-	# TODO: cache getShadersForSets answer?
-	def getShadersForSet(self, setname):
-		shaders = [shader for shader in self.shaders.keys() if shader.startswith(setname +  "/")]
-		shaders.sort()
+		cost = pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
 
-		return shaders
+		self.pixmaps[key] = (pixmap, cost)
+		self.size += cost
 
-	def __updateShaderSources(self, pd):
-		"""Writes pathes of mod directories and their pak files/dirs inside self.basepath
-		and self.homepath into self.shader_sources."""
-		self.shader_sources.clear()
+		# always keep the latest pixmap, even if it exceeds the budget on its own
+		while self.size > self.budget and len(self.pixmaps) > 1:
+			(pixmap, cost) = self.pixmaps.popitem(last = False)[1]
+			self.size -= cost
 
-		for path in (self.basepath, self.homepath):
-			if path != None:
-				path = os.path.expanduser(path).rstrip(os.sep)
+	def remove(self, key):
+		if key in self.pixmaps:
+			self.size -= self.pixmaps.pop(key)[1]
 
-				if not os.path.isdir(path):
-					continue
+	def clear(self):
+		self.pixmaps.clear()
+		self.size = 0
 
-				mods = list()
-				for node in os.listdir(path):
-					if self.pakdir in ["", node]:
-						if os.path.isdir(path + os.sep + node):
-							mods.append(node)
 
-				for mod in mods:
-					mod_path = path + os.sep + mod
-					self.shader_sources.append(mod_path)
+class TextureProbe():
+	"Reads texture dimensions from file headers without decoding the image."
 
-					for node in os.listdir(mod_path):
-						for pak_type in ["pk3", "dpk"]:
-							if node.endswith(os.extsep + pak_type) or node.endswith(os.extsep + pak_type + "dir"):
-								self.shader_sources.append(mod_path + os.sep + node)
+	KTX_IDENTIFIER = b"\xabKTX 11\xbb\r\n\x1a\n"
+	KTX2_IDENTIFIER = b"\xabKTX 20\xbb\r\n\x1a\n"
 
-		pd.setMaximum(len(self.shader_sources))
+	# start of frame markers, DHT, JPG and DAC share the range
+	JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
 
-	def __PIL2QPixmap(self, pilImage):
-		(r,g,b,a) = pilImage.convert("RGBA").split()
-		rawImage  = Image.merge("RGBA", (b,g,r,a)).tobytes("raw", "RGBA")
-		qImage    = QtGui.QImage(rawImage, pilImage.size[0], pilImage.size[1], QtGui.QImage.Format_ARGB32)
-		qPixmap   = QtGui.QPixmap.fromImage(qImage)
-		return qPixmap
-
-	def __crunchToTgaBytes(self, ext, path, content):
-		if content:
-			crunchFileHandle, crunchFilePath = tempfile.mkstemp(suffix = "." + ext)
-			os.write(crunchFileHandle, content)
-			os.close(crunchFileHandle)
-		else:
-			crunchFilePath = path
+	@staticmethod
+	def getSize(f):
+		"Returns (width, height) of the texture in the binary file object f or None if the header is unknown."
+		header = f.read(64)
 
 		try:
-			tgaFileHandle, tgaFilePath = tempfile.mkstemp(suffix = ".tga")
-			os.close(tgaFileHandle)
+			if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+				return struct.unpack(">II", header[16:24])
+			elif header.startswith(b"\xff\xd8"):
+				return TextureProbe.__getJpegSize(header[2:], f)
+			elif header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+				return TextureProbe.__getWebpSize(header)
+			elif header.startswith(b"DDS "):
+				(height, width) = struct.unpack("<II", header[12:20])
+				return (width, height)
+			elif header.startswith(TextureProbe.KTX_IDENTIFIER):
+				# the endianness field holds 0x04030201 in the byte order of the file
+				if header[12:16] == b"\x04\x03\x02\x01":
+					(width, height) = struct.unpack(">II", header[36:44])
+				else:
+					(width, height) = struct.unpack("<II", header[36:44])
+				# height is 0 for 1D textures
+				return (width, max(height, 1))
+			elif header.startswith(TextureProbe.KTX2_IDENTIFIER):
+				(width, height) = struct.unpack("<II", header[20:28])
+				return (width, max(height, 1))
+			elif header.startswith(b"Hx"):
+				# crnlib header, all fields are big endian
+				return struct.unpack(">HH", header[12:16])
+			else:
+				return TextureProbe.__getTgaSize(header)
+		except struct.error:
+			# truncated header
+			return None
 
-			cmdList = [ "crunch", "-quiet", "-file", crunchFilePath, "-out", tgaFilePath ]
-			subprocess.call(cmdList, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	@staticmethod
+	def __getJpegSize(data, f):
+		"Walks the JPEG segments up to the first start of frame, data holds what was read past SOI."
+		while True:
+			while len(data) < 9:
+				chunk = f.read(4096)
+				if not chunk:
+					return None
+				data += chunk
+
+			if data[0] != 0xff:
+				return None
 
-			tgaFileObject = open(tgaFilePath, "rb")
-			tgaFileContent = tgaFileObject.read()
-			tgaFileObject.close()
-			os.remove(tgaFilePath)
-		except:
-			print("Failed to run crunch executable", file = sys.stderr)
-			tgaFileContent = None
+			marker = data[1]
 
-		if content:
-			os.remove(crunchFilePath)
+			if marker == 0xff: # fill byte
+				data = data[1:]
+			elif marker in TextureProbe.JPEG_SOF_MARKERS:
+				(height, width) = struct.unpack(">HH", data[5:9])
+				return (width, height)
+			elif marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+				data = data[2:]
+			elif marker == 0xd9: # end of image
+				return None
+			else:
+				skip = 2 + struct.unpack(">H", data[2:4])[0]
 
-		return tgaFileContent
+				if skip <= len(data):
+					data = data[skip:]
+				else:
+					skip -= len(data)
+					data = b""
+					while skip > 0:
+						chunk = f.read(min(skip, 65536))
+						if not chunk:
+							return None
+						skip -= len(chunk)
+
+	@staticmethod
+	def __getWebpSize(header):
+		chunk = header[12:16]
+
+		if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+			(width, height) = struct.unpack("<HH", header[26:30])
+			return (width & 0x3fff, height & 0x3fff)
+		elif chunk == b"VP8L" and header[20] == 0x2f:
+			bits = struct.unpack("<I", header[21:25])[0]
+			return (1 + (bits & 0x3fff), 1 + ((bits >> 14) & 0x3fff))
+		elif chunk == b"VP8X":
+			width = 1 + int.from_bytes(header[24:27], "little")
+			height = 1 + int.from_bytes(header[27:30], "little")
+			return (width, height)
+		else:
+			return None
+
+	@staticmethod
+	def __getTgaSize(header):
+		"TGA has no magic number so the header fields are validated instead."
+		if len(header) < 18:
+			return None
+
+		(colormap_type, image_type) = struct.unpack("<BB", header[1:3])
+		(width, height, depth) = struct.unpack("<HHB", header[12:17])
+
+		if colormap_type in (0, 1) and image_type in (1, 2, 3, 9, 10, 11) \
+		and depth in (8, 15, 16, 24, 32) and width > 0 and height > 0:
+			return (width, height)
+		else:
+			return None
+
+
+class CrunchDecoder():
+	"""Decodes crunch, DDS and KTX textures to TGA using the crunch executable. Many textures
+	are decoded per invocation and several invocations run at once, inside a RAM backed
+	scratch directory if there is one."""
+
+	def __init__(self, processes = None, batch_size = None):
+		self.processes = processes if processes != None else Static.CRUNCH_PROCESSES
+		self.batch_size = batch_size if batch_size != None else Static.CRUNCH_BATCH_SIZE
+
+	@staticmethod
+	def getScratchParentDir():
+		"Returns a tmpfs directory if there is a writable one, otherwise None for the default temporary directory."
+		for directory in ("/dev/shm", os.environ.get("XDG_RUNTIME_DIR")):
+			if directory and os.path.isdir(directory) and os.access(directory, os.W_OK):
+				return directory
+
+		return None
+
+	def decode(self, textures):
+		"""Takes a list of (path, content) tuples and returns the decoded TGA contents in the same order.
+		Textures that couldn't be decoded are reported and returned as None."""
+		results = [None] * len(textures)
+
+		if len(textures) == 0:
+			return results
+
+		try:
+			scratch_dir = tempfile.mkdtemp(prefix = "chameleon-", dir = self.getScratchParentDir())
+		except OSError as e:
+			print("Failed to create a scratch directory for crunch: " + str(e), file = sys.stderr)
+			return results
+
+		try:
+			out_dir = os.path.join(scratch_dir, "out")
+			os.mkdir(out_dir)
+
+			# inputs are numbered as names inside different paks or dirs may collide
+			input_paths = list()
+			for position in range(len(textures)):
+				(path, content) = textures[position]
+				input_path = os.path.join(scratch_dir, str(position) + "." + path.rsplit(".", 1)[-1].lower())
+
+				with open(input_path, "wb") as f:
+					f.write(content)
+
+				input_paths.append(input_path)
+
+			batches = [
+				list(range(start, min(start + self.batch_size, len(textures))))
+				for start in range(0, len(textures), self.batch_size)
+			]
+
+			with concurrent.futures.ThreadPoolExecutor(self.processes) as executor:
+				for batch_results in executor.map(lambda batch: self.__decodeBatch(input_paths, out_dir, batch), batches):
+					for (position, content) in batch_results.items():
+						results[position] = content
+		except FileNotFoundError:
+			print("Failed to run crunch executable", file = sys.stderr)
+			return results
+		finally:
+			shutil.rmtree(scratch_dir, ignore_errors = True)
+
+		for position in range(len(textures)):
+			if results[position] == None:
+				print("Failed to decode image " + textures[position][0] + " with crunch", file = sys.stderr)
+
+		return results
+
+	def __runCrunch(self, input_paths, out_dir):
+		cmdList = [ "crunch", "-quiet", "-fileformat", "tga", "-outdir", out_dir ]
+		for input_path in input_paths:
+			cmdList += [ "-file", input_path ]
+
+		import subprocess
+
+		subprocess.call(cmdList, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	def __readOutput(self, input_path, out_dir):
+		output_path = os.path.join(out_dir, os.path.basename(input_path).rsplit(".", 1)[0] + ".tga")
+
+		try:
+			with open(output_path, "rb") as f:
+				content = f.read()
+		except FileNotFoundError:
+			return None
+
+		os.remove(output_path)
+
+		return content
+
+	def __decodeBatch(self, input_paths, out_dir, batch):
+		"Returns position -> TGA content for the textures of batch that were decoded."
+		self.__runCrunch([input_paths[position] for position in batch], out_dir)
+
+		results = dict()
+		failed = list()
+		for position in batch:
+			content = self.__readOutput(input_paths[position], out_dir)
+
+			if content != None:
+				results[position] = content
+			else:
+				failed.append(position)
+
+		# crunch may give up on the remaining files after a broken one, retry them one by one
+		if len(batch) > 1:
+			for position in failed:
+				self.__runCrunch([input_paths[position]], out_dir)
+
+				content = self.__readOutput(input_paths[position], out_dir)
+				if content != None:
+					results[position] = content
+
+		return results
+
+
+class ImageDescriptor():
+	"""Compact visual fingerprint of a preview, a 64 bit difference hash of its brightness
+	gradients followed by a 4x4x4 bin RGB histogram, 72 bytes in total. Descriptors of the
+	whole database are compared at once as NumPy arrays."""
+
+	HASH_SIZE = 8 # bytes
+	HISTOGRAM_LEVELS = 4 # per channel
+	HISTOGRAM_SIZE = HISTOGRAM_LEVELS ** 3
+	SIZE = HASH_SIZE + HISTOGRAM_SIZE
+
+	# share of the hash in the distance, the histogram makes up the rest
+	HASH_WEIGHT = 0.5
+
+	@staticmethod
+	def compute(image):
+		"Returns the descriptor of a QImage as bytes, None if the image is null."
+		if image.isNull():
+			return None
+
+		# 9x8 brightness samples give 8x8 horizontal gradients
+		gray = ImageDescriptor.__getPixels(image, 9, 8, QtGui.QImage.Format_Grayscale8, 1)[:, :, 0]
+		image_hash = numpy.packbits(gray[:, 1:] > gray[:, :-1])
+
+		rgba = ImageDescriptor.__getPixels(image, 32, 32, QtGui.QImage.Format_RGBA8888, 4)
+		levels = rgba[:, :, :3] // (256 // ImageDescriptor.HISTOGRAM_LEVELS)
+		bins = (levels[:, :, 0] * ImageDescriptor.HISTOGRAM_LEVELS + levels[:, :, 1]) * ImageDescriptor.HISTOGRAM_LEVELS + levels[:, :, 2]
+		counts = numpy.bincount(bins.ravel(), minlength = ImageDescriptor.HISTOGRAM_SIZE)
+
+		# normalized to sum up to about 255, so a bin fits into a byte
+		histogram = numpy.round(counts * 255 / counts.sum()).astype(numpy.uint8)
+
+		return image_hash.tobytes() + histogram.tobytes()
+
+	@staticmethod
+	def __getPixels(image, width, height, image_format, channels):
+		"Scales image to width x height and returns its pixels as a (height, width, channels) array."
+		image = image.scaled(width, height, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation).convertToFormat(image_format)
+
+		# lines are padded to 32 bits
+		pixels = numpy.frombuffer(image.constBits().asstring(image.bytesPerLine() * height), numpy.uint8)
+		pixels = pixels.reshape(height, image.bytesPerLine())[:, :width * channels]
+
+		return pixels.reshape(height, width, channels)
+
+	@staticmethod
+	def toArrays(descriptors):
+		"""Unpacks a list of descriptors into the arrays getDistances works on, the hash bits
+		as -1 and 1, the histograms and their squared norms."""
+		matrix = numpy.frombuffer(b"".join(descriptors), numpy.uint8).reshape(len(descriptors), ImageDescriptor.SIZE)
+
+		bits = numpy.unpackbits(matrix[:, :ImageDescriptor.HASH_SIZE], axis = 1).astype(numpy.float32) * 2 - 1
+		histograms = matrix[:, ImageDescriptor.HASH_SIZE:].astype(numpy.float32)
+		norms = (histograms * histograms).sum(axis = 1)
+
+		return (bits, histograms, norms)
+
+	@staticmethod
+	def getDistances(descriptors, arrays):
+		"""Returns the distances from 0 to 1 between a list of descriptors and all descriptors in
+		arrays as a matrix with a row per descriptor, using two matrix products."""
+		(query_bits, query_histograms, query_norms) = ImageDescriptor.toArrays(descriptors)
+		(bits, histograms, norms) = arrays
+
+		# equal bits multiply to 1 and different bits to -1
+		hash_bits = 8 * ImageDescriptor.HASH_SIZE
+		hash_distances = (hash_bits - numpy.dot(query_bits, bits.T)) / (2 * hash_bits)
+
+		# euclidean distance of the histograms, both sum up to about 255
+		squared = query_norms[:, numpy.newaxis] + norms - 2 * numpy.dot(query_histograms, histograms.T)
+		histogram_distances = numpy.sqrt(numpy.maximum(squared, 0)) / (255 * math.sqrt(2))
+
+		return ImageDescriptor.HASH_WEIGHT * hash_distances + (1 - ImageDescriptor.HASH_WEIGHT) * histogram_distances
+
+
+class ShaderScriptParser():
+	"""Brace aware parser for .shader scripts working on their raw bytes. Comments are
+	blanked out, the braces are walked once to find the top level blocks and the
+	statements are looked up inside every block, so no Python code runs per line."""
+
+	COMMENT_PATTERN = re.compile(rb"//[^\n]*|/\*.*?(?:\*/|\Z)", re.S)
+	BRACE_PATTERN = re.compile(rb"[{}]")
+
+	@staticmethod
+	def parse(content):
+		"""Yields (name, editor image, diffuse map, stage map, text) for every named top level
+		block of the bytes object content, the maps are None if unset. The stage map is the
+		last map below textures/, so $lightmap and the like are skipped."""
+		if b"//" in content or b"/*" in content:
+			# keep offsets so that the text of a block can be sliced from content
+			content = ShaderScriptParser.COMMENT_PATTERN.sub(lambda match: b" " * len(match.group()), content)
+
+		# same offsets, but keywords are case insensitive
+		lowered = content.lower()
+
+		depth = 0
+		header_start = 0 # text between two top level blocks, ends with the name
+		block_start = 0
+
+		for match in ShaderScriptParser.BRACE_PATTERN.finditer(content):
+			pos = match.start()
+
+			if content[pos] == 0x7b: # {
+				if depth == 0:
+					block_start = pos
+
+				depth += 1
+			elif depth == 0:
+				# stray closing brace
+				header_start = pos + 1
+			else:
+				depth -= 1
+
+				if depth == 0:
+					block = ShaderScriptParser.__parseBlock(content, lowered, header_start, block_start, pos + 1)
+
+					if block != None:
+						yield block
+
+					header_start = pos + 1
+
+		# be lenient about a missing closing brace at the end of the script
+		if depth > 0:
+			block = ShaderScriptParser.__parseBlock(content, lowered, header_start, block_start, len(content))
+
+			if block != None:
+				yield block
+
+	@staticmethod
+	def __parseBlock(content, lowered, header_start, block_start, block_end):
+		words = content[header_start:block_start].split()
+
+		if len(words) == 0:
+			return None
+
+		name = words[-1]
+		name_start = content.rindex(name, header_start, block_start)
+
+		return (
+			name.strip(b'"'),
+			ShaderScriptParser.__findArgument(lowered, content, b"qer_editorimage", block_start, block_end),
+			ShaderScriptParser.__findArgument(lowered, content, b"diffusemap", block_start, block_end),
+			ShaderScriptParser.__findArgument(lowered, content, b"map", block_start, block_end, b"textures/"),
+			content[name_start:block_end]
+		)
+
+	@staticmethod
+	def __findArgument(lowered, content, keyword, start, end, required = None):
+		"""Returns the argument of the last statement between start and end that begins with
+		keyword and whose argument contains required, None if there is none."""
+		while True:
+			pos = lowered.rfind(keyword, start, end)
+
+			if pos < 0:
+				return None
+
+			before = pos - 1
+			while before > start and lowered[before] in b" \t":
+				before -= 1
+
+			after = pos + len(keyword)
+
+			# the keyword has to be a word of its own at the start of a statement
+			if lowered[before] in b"\n\r{}" and after < end and lowered[after] in b" \t":
+				argument = content[after:end].split(None, 1)
+
+				if len(argument) > 0:
+					argument = argument[0].split(b"}", 1)[0].split(b"{", 1)[0].strip(b'"')
+
+					if len(argument) > 0 and (required == None or required in argument):
+						return argument
+
+			end = pos
+
+
+class ShaderScanner():
+	"""Collects the textures and shaders of a single shader source as a list of records.
+	Doesn't touch QPixmap or any other GUI class so it can run inside worker processes."""
+
+	def __init__(self, cache = None, lazy = False, crunch_processes = None):
+		self.records = list()
+		self.cache = cache
+		self.lazy = lazy # only read dimensions of textures missing in the store, no previews
+		self.crunch_processes = crunch_processes if crunch_processes != None else Static.CRUNCH_PROCESSES
+		self.thumbnails = dict() # content key -> thumbnail, all thumbnails of this scan
+		self.new_thumbnails = dict() # content key -> thumbnail and descriptor, thumbnails missing in the store
+		self.scripts = dict() # content key -> shaders, all scripts of this scan
+		self.new_scripts = dict() # content key -> shaders, scripts missing in the store
+		self.crunch_queue = dict() # content key -> (path, content), textures waiting for crunch
+		self.pending_records = list() # positions of records waiting for crunch
+
+	@staticmethod
+	def scanSource(path, cache_paths = None, lazy = False, crunch_processes = None):
+		"""Returns the records of the dir/pk3 at path and the thumbnails and scripts that had to be
+		decoded and parsed because they were missing in the cache at cache_paths, a tuple of index
+		and blob path. Also used as the worker process entry point, so new thumbnails and scripts
+		are written by the caller. Workers running side by side share Static.CRUNCH_PROCESSES by
+		passing their part as crunch_processes."""
+		if cache_paths != None:
+			scanner = ShaderScanner(ShaderCache(*cache_paths, read_only = True), lazy, crunch_processes)
+		else:
+			scanner = ShaderScanner(None, lazy, crunch_processes)
+
+		if os.path.isdir(path):
+			scanner.__getShaderDataFromDir(path)
+		elif os.path.isfile(path):
+			scanner.__getShaderDataFromPk3(path)
+
+		scanner.__decodeCrunchQueue()
+
+		if scanner.cache != None:
+			scanner.cache.close()
+
+		return (scanner.records, scanner.new_thumbnails, scanner.new_scripts)
+
+	@staticmethod
+	def createThumbnail(path, content):
+		"Decodes a single texture into (preview, preview width, width, height, descriptor)."
+		scanner = ShaderScanner()
+
+		thumbnail = scanner.__createThumbnail(path, content)
+
+		if thumbnail == None:
+			content = CrunchDecoder().decode([(path, content)])[0]
+			thumbnail = scanner.__createThumbnailFromImage(*scanner.__createCrunchedImage(path, content))
+
+		return thumbnail
+
+	def __getPreviewSize(self, width, height):
+		"Fits width x height into the preview size, rounding like QSize.scaled with KeepAspectRatio."
+		scaled_width = Static.PREVIEW_HEIGHT * width // height
+
+		if scaled_width <= Static.PREVIEW_WIDTH:
+			return (max(scaled_width, 1), Static.PREVIEW_HEIGHT)
+		else:
+			return (Static.PREVIEW_WIDTH, max(Static.PREVIEW_WIDTH * height // width, 1))
+
+	def __PIL2QImage(self, pilImage):
+		"""Decodes pilImage straight to preview size and returns (preview, width, height).
+		Full size pixel data is only touched by the decoder and a single box filter pass."""
+		from PIL import Image
+
+		(width, height) = pilImage.size
+		(preview_width, preview_height) = self.__getPreviewSize(width, height)
+
+		# lets the JPEG decoder scale down by up to 1/8 while decoding
+		pilImage.draft(pilImage.mode, (preview_width, preview_height))
+
+		if pilImage.mode not in ("RGB", "RGBA"):
+			pilImage = pilImage.convert("RGBA")
+
+		factor = min(pilImage.size[0] // preview_width, pilImage.size[1] // preview_height)
+		if factor > 1:
+			pilImage = pilImage.reduce(factor)
+
+		pilImage = pilImage.convert("RGBA").resize((preview_width, preview_height), Image.BILINEAR)
+
+		# RGBA8888 matches the byte order of PIL, no need to swap channels
+		rawImage = pilImage.tobytes("raw", "RGBA")
+		qImage   = QtGui.QImage(rawImage, preview_width, preview_height, preview_width * 4, QtGui.QImage.Format_RGBA8888)
+
+		# QImage doesn't own rawImage
+		return (qImage.copy(), width, height)
+
+	def __createImage(self, path, content):
+		"Returns (preview, width, height), the preview is a null image if content can't be decoded."
+		from PIL import Image
+
+		try:
+			pilImage = Image.open(BytesIO(content))
+
+			return self.__PIL2QImage(pilImage)
+		except OSError:
+			# this usually means unsupported image format
+			print("Failed to load image " + path, file = sys.stderr)
+			return (QtGui.QImage(), 0, 0)
+
+	def __getShaderDataFromDir(self, path):
+		ls = os.listdir(path)
+
+		if "scripts" in ls:
+			for shader in [
+				path + os.sep + "scripts" + os.sep + node
+				for node in os.listdir(path + os.sep + "scripts")
+				if node.endswith(".shader")
+			]:
+				with open(shader, "rb") as f:
+					content = f.read()
+
+				self.__parseShaderFile(shader, ShaderCache.getContentKey(content), lambda: content)
+
+		if "textures" in ls:
+			for directory in [
+				path + os.sep + "textures" + os.sep + node
+				for node in os.listdir(path + os.sep + "textures")
+				if os.path.isdir(path + os.sep + "textures" + os.sep + node)
+			]:
+				self.__parseTextureDir(directory)
+
+	def __getShaderDataFromPk3(self, path):
+		import zipfile
+
+		try:
+			pk3 = zipfile.ZipFile(path)
+		except zipfile.BadZipFile:
+			return
+
+		for info in pk3.infolist():
+			pk3_path = info.filename
+			combined_path = path + ":" + pk3_path
+
+			if  pk3_path.startswith("textures/") \
+			and pk3_path.rsplit(".", 1)[-1].lower() in Static.TEXTURE_EXTENSIONS:
+				name = pk3_path[9:].rsplit(".", 1)[0]
+				key = ShaderCache.getKey(info.CRC, info.file_size)
+
+				self.__addTexture(name, combined_path, key, lambda: pk3.open(info))
+
+			elif pk3_path.startswith("scripts/") and pk3_path.endswith(".shader"):
+				key = ShaderCache.getKey(info.CRC, info.file_size)
+
+				self.__parseShaderFile(combined_path, key, lambda: pk3.read(info))
+
+	def __parseShaderFile(self, path, key, read):
+		"Adds the shaders of a script, read returns its content and is only called if the script wasn't parsed before."
+		if key in self.scripts:
+			shaders = self.scripts[key]
+		else:
+			shaders = None
+
+			if self.cache != None:
+				shaders = self.cache.getScriptShaders(key)
+
+			if shaders == None:
+				shaders = self.__parseShaderFileContent(path, read())
+				self.new_scripts[key] = shaders
+
+			self.scripts[key] = shaders
+
+		for (name, preview_source, text) in shaders:
+			self.__addShader(name, path, preview_source, text)
+
+	def __parseShaderFileContent(self, path, content):
+		"Returns (name, preview source, text) of every shader in content."
+		print("Parsing shader file " + path)
+
+		shaders = list()
+
+		for (name, editorimage, diffusemap, stage_map, text) in ShaderScriptParser.parse(content):
+			# only shaders below textures/ can be used on brushes
+			if not name.startswith(b"textures/"):
+				continue
+
+			if editorimage != None:
+				preview_source = editorimage
+			elif diffusemap != None:
+				preview_source = diffusemap
+			elif stage_map != None:
+				preview_source = stage_map
+			else:
+				continue
+
+			preview_source = preview_source.decode("latin-1").split("/", 1)[-1].rsplit(".", 1)[0]
+			shaders.append((name[9:].decode("latin-1"), preview_source, text.decode("latin-1")))
+
+		return shaders
+
+	def __parseTextureDir(self, directory):
+		for node in [
+			node
+			for node in os.listdir(directory)
+			if os.path.isfile(directory + os.sep + node)
+			and node.rsplit(".", 1)[-1].lower() in Static.TEXTURE_EXTENSIONS
+		]:
+			name = os.path.basename(directory) + "/" + node.rsplit(".", 1)[0]
+			path = directory + os.sep + node
+
+			with open(path, "rb") as f:
+				content = f.read()
+
+			key = ShaderCache.getContentKey(content)
+
+			self.__addTexture(name, path, key, lambda: BytesIO(content))
+
+	# It's not possible to run copy.deepcopy and pickle.dump on a QPixmap
+	def __convertQImageToQByteArray(self, qimage):
+		qbytearray = QtCore.QByteArray()
+		qbuffer = QtCore.QBuffer(qbytearray)
+		qbuffer.open(QtCore.QIODevice.WriteOnly)
+		qimage.save(qbuffer, "JPG", 100)
+		qbuffer.close()
+		return qbytearray
+
+	def __createCrunchedImage(self, path, content):
+		"Decodes the TGA content crunch produced, None if crunch failed which was already reported."
+		if content != None:
+			return self.__createImage(path, content)
+		else:
+			return (QtGui.QImage(), 0, 0)
+
+	def __createThumbnail(self, path, content):
+		"Returns (preview, preview width, width, height, descriptor) or None if the texture has to go through crunch first."
+		print("Loading image file " + path)
+
+		from PIL import Image
+
+		ext = path.rsplit(".", 1)[-1].lower()
+
+		if ext in Static.TEXTURE_CRUNCH_EXTENSION:
+			# Pillow reads most DDS files natively
+			if ext != "dds":
+				return None
+
+			try:
+				image = self.__PIL2QImage(Image.open(BytesIO(content)))
+			except (OSError, NotImplementedError, ValueError):
+				return None
+		else:
+			image = self.__createImage(path, content)
+
+		return self.__createThumbnailFromImage(*image)
+
+	def __createThumbnailFromImage(self, preview, width, height):
+		return (bytes(self.__convertQImageToQByteArray(preview)), preview.width(), width, height, ImageDescriptor.compute(preview))
+
+	def __probeThumbnail(self, path, open_):
+		"Reads the dimensions of a texture without decoding it, the preview is left out."
+		from PIL import Image
+
+		try:
+			with open_() as f:
+				size = TextureProbe.getSize(f)
+
+			if size == None:
+				with open_() as f:
+					# Image.open only parses the header
+					size = Image.open(f).size
+		except OSError:
+			return None
+
+		(width, height) = size
+
+		return (None, 0, width, height)
+
+	def __getThumbnail(self, key, path, open_):
+		"Returns the thumbnail of the texture with the given content key, open_ returns a file object of the texture."
+		if key in self.thumbnails:
+			return self.thumbnails[key]
+
+		thumbnail = None
+
+		if self.cache != None:
+			thumbnail = self.cache.getThumbnail(key)
+
+		if thumbnail == None and self.lazy:
+			thumbnail = self.__probeThumbnail(path, open_)
+
+		if thumbnail == None:
+			with open_() as f:
+				content = f.read()
+
+			thumbnail = self.__createThumbnail(path, content)
+
+			if thumbnail == None:
+				self.crunch_queue[key] = (path, content)
+				return None
+
+			self.__addNewThumbnail(key, thumbnail)
+		else:
+			self.thumbnails[key] = thumbnail
+
+		return self.thumbnails[key]
+
+	def __addNewThumbnail(self, key, thumbnail):
+		"Remembers a decoded thumbnail, the descriptor only goes to the store and not into the records."
+		self.thumbnails[key] = thumbnail[:4]
+
+		# don't remember failures, crunch might just be missing
+		if thumbnail[2] > 0:
+			self.new_thumbnails[key] = thumbnail
+
+	def __decodeCrunchQueue(self):
+		"Decodes all queued textures with crunch at once and completes the records waiting for them."
+		keys = list(self.crunch_queue.keys())
+		contents = CrunchDecoder(self.crunch_processes).decode([self.crunch_queue[key] for key in keys])
+
+		for (key, content) in zip(keys, contents):
+			image = self.__createCrunchedImage(self.crunch_queue[key][0], content)
+			self.__addNewThumbnail(key, self.__createThumbnailFromImage(*image))
+
+		self.crunch_queue.clear()
+
+		for position in self.pending_records:
+			record = self.records[position]
+			self.records[position] = record + self.thumbnails[record[3]]
+
+		self.pending_records.clear()
+
+	def __addTexture(self, name, path, key, open_):
+		if key in self.crunch_queue:
+			thumbnail = None
+		else:
+			thumbnail = self.__getThumbnail(key, path, open_)
+
+		if thumbnail != None:
+			self.records.append(("texture", name, path, key) + thumbnail)
+		else:
+			# completed once the crunch queue is decoded
+			self.pending_records.append(len(self.records))
+			self.records.append(("texture", name, path, key))
+
+			if len(self.crunch_queue) >= Static.CRUNCH_BATCH_SIZE * self.crunch_processes:
+				self.__decodeCrunchQueue()
+
+	def __addShader(self, name, path, preview_source, text):
+		self.records.append(("shader", name, path, preview_source, text))
+
+
+class CacheReader(QtCore.QThread):
+	"Reads the shader cache into a new ShaderIndex, the window shows up and stays responsive meanwhile."
+
+	def __init__(self, cache):
+		QtCore.QThread.__init__(self)
+
+		# SQLite connections can't be shared between threads, the index gets its own. Reading only
+		# leaves a cache of another version alone until the user agreed to rescan the shaders.
+		self.cache = ShaderCache(cache.index_path, cache.blob_path, read_only = True)
+		self.index = None
+		self.error = None
+
+	def run(self):
+		index = ShaderIndex(self.cache)
+
+		try:
+			index.readCache()
+		except BaseException as e:
+			self.error = e
+		else:
+			self.index = index
+		finally:
+			self.cache.close()
+
+	def getIndex(self):
+		"Returns the index read, or raises what was raised while reading it."
+		if self.error != None:
+			raise self.error
+
+		return self.index
+
+	def isOutdated(self):
+		"Returns True if the cache was written with another schema version and shaders have to be rescanned."
+		return isinstance(self.error, ShaderCacheVersionError)
+
+
+class ShaderLoader(QtCore.QThread):
+	"""Loads shaders from disk into a new Shaders instance, the shaders shown meanwhile stay untouched.
+	It stands in for the progress dialog, progress and scanned records are passed on by signals at
+	most every Static.LOADING_UPDATE_INTERVAL seconds."""
+
+	progressChanged = QtCore.pyqtSignal(int, int) # value, maximum
+	recordsScanned = QtCore.pyqtSignal(object) # records of every source scanned since the last signal
+
+	def __init__(self, shaders, basepath, homepath, pakdir, reload = False):
+		QtCore.QThread.__init__(self)
+
+		# SQLite connections can't be shared between threads, the copy gets its own
+		self.shaders = Shaders(ShaderCache(shaders.cache.index_path, shaders.cache.blob_path, shaders.cache.read_only))
+		self.shaders.basepath = shaders.basepath
+		self.shaders.homepath = shaders.homepath
+		self.shaders.pakdir = shaders.pakdir
+		self.shaders.shader_sources = list(shaders.shader_sources)
+		self.shaders.source_records = dict(shaders.source_records)
+		self.shaders.dirty_sources = set(shaders.dirty_sources)
+
+		self.basepath = basepath
+		self.homepath = homepath
+		self.pakdir = pakdir
+		self.reload = reload
+
+		self.changed = False
+		self.canceled = False
+		self.error = None
+
+		self.value = 0
+		self.maximum = 0
+		self.scanned = list()
+		self.last_update = 0.0
+
+	def run(self):
+		try:
+			self.changed = self.shaders.loadShaders(self, self.basepath, self.homepath, self.pakdir, self.reload, self.__addScanned)
+		except BaseException as e:
+			self.error = e
+		else:
+			if self.changed:
+				try:
+					self.shaders.writeCache()
+				except BaseException as e:
+					print("Failed to write cache file " + self.shaders.cache.index_path + ": " + str(e), file = sys.stderr)
+		finally:
+			self.shaders.cache.close()
+
+			# the records scanned last are shown with all the others
+			self.progressChanged.emit(self.value, self.maximum)
+
+	def setMaximum(self, maximum):
+		self.maximum = maximum
+		self.__update()
+
+	def setValue(self, value):
+		self.value = value
+		self.__update()
+
+	def wasCanceled(self):
+		return self.canceled
+
+	def cancel(self):
+		"Stops scanning, the sources scanned so far are kept."
+		self.canceled = True
+
+	def getShaders(self):
+		"Returns the shaders loaded, or raises what was raised while loading them."
+		if self.error != None:
+			raise self.error
+
+		return self.shaders
+
+	def __addScanned(self, records):
+		self.scanned.append(records)
+		self.__update()
+
+	def __update(self):
+		now = time.perf_counter()
+
+		if now - self.last_update < Static.LOADING_UPDATE_INTERVAL:
+			return
+
+		self.last_update = now
+
+		self.progressChanged.emit(self.value, self.maximum)
+
+		if len(self.scanned) > 0:
+			self.recordsScanned.emit(self.scanned)
+			self.scanned = list()
+
+
+class ThumbnailProvider(QtCore.QObject):
+	"""Reads and decodes the previews shown by the shader picker on a pool of threads, so it doesn't wait
+	for them. Jobs are taken in the order requested unless prioritized, decoded previews are passed to the
+	shaders and passed on by previewsDecoded at most every Static.THUMBNAIL_UPDATE_INTERVAL seconds."""
+
+	previewsDecoded = QtCore.pyqtSignal(object) # textures whose preview was decoded since the last signal
+	jobDone = QtCore.pyqtSignal(object) # (texture, key, thumbnail, new thumbnail, image), emitted by the threads
+
+	def __init__(self, shaders):
+		QtCore.QObject.__init__(self)
+		self.shaders = shaders
+
+		self.pool = QtCore.QThreadPool(self)
+		self.pool.setMaxThreadCount(Static.THUMBNAIL_THREADS)
+
+		# shared with the threads
+		self.lock = threading.Lock()
+		self.jobs = collections.OrderedDict() # texture -> job, in the order they are taken
+		self.running = set() # textures being decoded
+		self.readers = 0
+
+		self.done = 0 # jobs done, including those whose texture was reloaded meanwhile
+
+		self.decoded = list()
+		self.timer = QtCore.QTimer(self)
+		self.timer.setSingleShot(True)
+		self.timer.setInterval(int(Static.THUMBNAIL_UPDATE_INTERVAL * 1000))
+
+		self.jobDone.connect(self.__handleJobDone)
+		self.timer.timeout.connect(self.__handleTimeout)
+
+	def request(self, job):
+		"Queues a job returned by Shaders.getPreviewJob, unless the same texture is queued or decoded already."
+		with self.lock:
+			if job[0] in self.jobs or job[0] in self.running:
+				return
+
+			self.jobs[job[0]] = job
+
+		self.__startReaders()
+
+	def prioritize(self, jobs):
+		"Moves jobs to the front of the queue in the order given, queuing them if necessary."
+		with self.lock:
+			for job in reversed(jobs):
+				if job[0] not in self.running:
+					self.jobs[job[0]] = job
+					self.jobs.move_to_end(job[0], last = False)
+
+		self.__startReaders()
+
+	def clear(self):
+		"Drops the queued jobs, the previews being decoded are still passed on."
+		with self.lock:
+			self.jobs.clear()
+
+	def cancel(self):
+		"Drops the queued jobs and waits for the previews being decoded."
+		self.clear()
+		self.pool.waitForDone()
+
+	def isIdle(self):
+		"Returns True once every job was done or dropped."
+		with self.lock:
+			return len(self.jobs) == 0 and len(self.running) == 0
+
+	def takeJob(self):
+		"Called by the threads, returns the next job or None if there is none left and the thread ends."
+		with self.lock:
+			if len(self.jobs) == 0:
+				self.readers -= 1
+				return None
+
+			job = self.jobs.popitem(last = False)[1]
+			self.running.add(job[0])
+
+			return job
+
+	def __startReaders(self):
+		with self.lock:
+			count = max(min(len(self.jobs), Static.THUMBNAIL_THREADS - self.readers), 0)
+			self.readers += count
+
+		for i in range(count):
+			self.pool.start(ThumbnailReader(self, self.shaders.cache))
+
+	def __handleJobDone(self, result):
+		with self.lock:
+			self.running.discard(result[0])
+
+		self.done += 1
+
+		if self.shaders.setDecodedPreview(*result):
+			self.decoded.append(result[0])
+
+		# also signals progress if the texture was reloaded meanwhile
+		if not self.timer.isActive():
+			self.timer.start()
+
+	def __handleTimeout(self):
+		decoded = self.decoded
+		self.decoded = list()
+
+		self.previewsDecoded.emit(decoded)
+
+
+class ThumbnailReader(QtCore.QRunnable):
+	"Takes jobs from a ThumbnailProvider until none are left, runs on one of its threads."
+
+	def __init__(self, provider, cache):
+		QtCore.QRunnable.__init__(self)
+		self.provider = provider
+
+		# SQLite connections and ZipFiles can't be shared between threads, every reader opens its own
+		self.cache = ShaderCache(cache.index_path, cache.blob_path, read_only = True)
+		self.open_paks = dict() # pk3 path -> ZipFile
+
+	def run(self):
+		try:
+			job = self.provider.takeJob()
+
+			while job != None:
+				self.provider.jobDone.emit(self.__decode(*job))
+
+				job = self.provider.takeJob()
+		finally:
+			self.cache.close()
+
+			for pk3 in self.open_paks.values():
+				pk3.close()
+
+	def __decode(self, texture, key, path, preview):
+		"Returns the arguments of Shaders.setDecodedPreview, preview is None if it has to be read first."
+		thumbnail = None
+		new_thumbnail = None
+
+		try:
+			if preview == None:
+				(thumbnail, new_thumbnail) = Shaders.readThumbnail(self.cache, self.open_paks, key, path)
+
+				if thumbnail != None:
+					preview = thumbnail[0]
+				else:
+					preview = b""
+
+			# QImage, unlike QPixmap, can be used outside the GUI thread
+			image = QtGui.QImage.fromData(preview)
+		except Exception as e:
+			# exceptions must not leave the thread
+			print("Failed to decode preview of " + texture + ": " + str(e), file = sys.stderr)
+			image = QtGui.QImage()
+
+		return (texture, key, thumbnail, new_thumbnail, image)
+
+
+class Shaders(ShaderIndex):
+	# placeholder text -> (color, position)
+	PLACEHOLDERS = {
+		"NOT FOUND": (QtCore.Qt.red, QtCore.QPointF(24, 67)),
+		"UNSUPPORTED": (QtCore.Qt.yellow, QtCore.QPointF(13, 67)),
+		"REPLACE": (QtCore.Qt.white, QtCore.QPointF(32, 67)),
+		"LOADING": (QtCore.Qt.gray, QtCore.QPointF(32, 67)),
+	}
+
+	def __init__(self, cache = None):
+		super().__init__(cache)
+
+		self.descriptors = None # content key -> image descriptor, read from the cache when first needed
+		self.similarity_index = None # (shader names, descriptor arrays) of all shaders with a descriptor
+		self.open_paks = dict() # pk3 path -> ZipFile, to read textures whose preview is decoded on demand
+		self.preview_cache = PixmapCache(Static.PREVIEW_CACHE_BUDGET) # texture -> decoded preview
+		self.transformed_preview_cache = PixmapCache(Static.TRANSFORMED_PREVIEW_CACHE_BUDGET) # (texture, scale ratio, hscale, vscale, rot) -> preview
+
+		self.placeholders = dict() # placeholder -> pixmap, drawn when first shown so no GUI is needed before
+
+	def __getPlaceholder(self, placeholder):
+		"Returns the NOT FOUND, UNSUPPORTED, REPLACE or LOADING image."
+		if placeholder not in self.placeholders:
+			(color, position) = Shaders.PLACEHOLDERS[placeholder]
+
+			pixmap = QtGui.QPixmap(128, 128)
+			pixmap.fill(QtCore.Qt.black)
+
+			painter = QtGui.QPainter()
+			painter.begin(pixmap)
+			painter.setPen(color)
+			painter.drawText(position, placeholder)
+			painter.end()
+
+			self.placeholders[placeholder] = pixmap
+
+		return self.placeholders[placeholder]
+
+	def getPreviewScale(self, shader):
+		if shader in self.shaders:
+			if self.shaders[shader]["is_shader"]:
+				preview_source = self.shaders[shader]["preview_source"]
+				if preview_source in self.shaders \
+				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
+					return self.getPreviewScale(preview_source)
+				else:
+					return 1.0
+			else:
+				self.__loadPreview(shader)
+				return self.shaders[shader]["preview_scale"]
+		else:
+			return 1.0
 
-	def __createPixmap(self, path, content):
-		print("Loading image file " + path)
+	def getPreview(self, shader = None, old_shader = None, hscale = None, vscale = None, rot = None):
+		if shader == None:
+			return self.__getPlaceholder("REPLACE")
+		elif shader in self.shaders:
+			if self.shaders[shader]["is_shader"]:
+				preview_source = self.shaders[shader]["preview_source"]
+				if preview_source in self.shaders \
+				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
+					return self.getPreview(preview_source, old_shader, hscale, vscale, rot)
+				else:
+					return self.__getPlaceholder("NOT FOUND")
+			else:
+				if self.shaders[shader]["width"] == self.shaders[shader]["height"] == 0:
+					return self.__getPlaceholder("UNSUPPORTED")
+				else:
+					if old_shader in self.shaders and hscale != None and vscale != None and rot != None:
+						scale = self.getPreviewScale(shader) / self.getPreviewScale(old_shader)
+						key = (shader, scale, hscale, vscale, rot)
 
-		try:
-			for ext in Static.TEXTURE_CRUNCH_EXTENSION:
-				if path.lower().endswith("." + ext):
-					content = self.__crunchToTgaBytes(ext, path, content)
-					break
+						preview = self.transformed_preview_cache.get(key)
 
-			# if content is b'' it's an empty file
-			if content != None:
-				pilImage = Image.open(BytesIO(content))
-			else:
-				pilImage = Image.open(path)
+						if preview == None:
+							# scale first, then rotate, in a single pass
+							transform = QtGui.QTransform().scale(hscale / scale, vscale / scale) * QtGui.QTransform().rotate(rot)
+							preview = self.__getPreviewPixmap(shader).transformed(transform)
+							self.transformed_preview_cache.put(key, preview)
 
-			return self.__PIL2QPixmap(pilImage)
-		except OSError:
-			# this usually means unsupported image format
-			print("Failed to load image " + path, file = sys.stderr)
-			return QtGui.QPixmap()
+						return preview
+					else:
+						preview = self.__getPreviewPixmap(shader)
+						return preview
+		else:
+			return self.__getPlaceholder("NOT FOUND")
 
-	def __updateShaderData(self, pd):
-		"Writes database of shaders inside self.shader_sources into self.shaders."
-		self.shaders.clear()
+	def invalidateTransformedPreview(self, shader, old_shader, hscale, vscale, rot):
+		"Drops the preview getPreview cached for the same arguments, called before the rule behind them changes."
+		if shader in self.shaders and self.shaders[shader]["is_shader"]:
+			shader = self.shaders[shader]["preview_source"]
 
-		progress = 0
-		for path in self.shader_sources:
-			if os.path.isdir(path):
-				self.__getShaderDataFromDir(path)
-			elif os.path.isfile(path):
-				self.__getShaderDataFromPk3(path)
+		if shader in self.shaders and old_shader in self.shaders \
+		and hscale != None and vscale != None and rot != None:
+			scale = self.getPreviewScale(shader) / self.getPreviewScale(old_shader)
+			self.transformed_preview_cache.remove((shader, scale, hscale, vscale, rot))
 
-			progress += 1
-			pd.setValue(progress)
+	def __getPreviewPixmap(self, shader):
+		preview = self.preview_cache.get(shader)
 
-	def __getShaderDataFromDir(self, path):
-		ls = os.listdir(path)
+		if preview != None:
+			return preview
 
-		if "scripts" in ls:
-			for shader in [
-				path + os.sep + "scripts" + os.sep + node
-				for node in os.listdir(path + os.sep + "scripts")
-				if node.endswith(".shader")
-			]:
-				with open(shader) as f:
-					self.__parseShaderFileContent(shader, f.read())
+		self.__loadPreview(shader)
 
-		if "textures" in ls:
-			for directory in [
-				path + os.sep + "textures" + os.sep + node
-				for node in os.listdir(path + os.sep + "textures")
-				if os.path.isdir(path + os.sep + "textures" + os.sep + node)
-			]:
-				self.__parseTextureDir(directory)
+		if self.shaders[shader]["preview"]:
+			preview = self.convertQByteArrayToQPixmap(self.shaders[shader]["preview"])
+			self.preview_cache.put(shader, preview)
+			return preview
+		else:
+			return self.__getPlaceholder("NOT FOUND")
+
+	@staticmethod
+	def readTexture(path, open_paks):
+		"Reads a loose texture or a texture inside a pk3, given as pk3:member. open_paks maps pk3 path -> ZipFile."
+		import zipfile
+
+		if os.path.isfile(path):
+			with open(path, "rb") as f:
+				return f.read()
+
+		(pk3_path, member) = path.rsplit(":", 1)
+
+		if pk3_path not in open_paks:
+			open_paks[pk3_path] = zipfile.ZipFile(pk3_path)
+
+		return open_paks[pk3_path].read(member)
+
+	@staticmethod
+	def readThumbnail(cache, open_paks, key, path):
+		"""Returns the thumbnail of the texture at path and, if it had to be decoded because it is missing
+		in cache, the thumbnail with its descriptor. The thumbnail is None if the texture can't be read.
+		Doesn't touch QPixmap so ThumbnailProvider threads can call it with their own cache and pk3s."""
+		import zipfile
+
+		thumbnail = cache.getThumbnail(key)
+
+		if thumbnail != None:
+			return (thumbnail, None)
 
-	def __getShaderDataFromPk3(self, path):
 		try:
-			pk3 = zipfile.ZipFile(path)
-		except zipfile.BadZipFile:
+			content = Shaders.readTexture(path, open_paks)
+		except (OSError, KeyError, zipfile.BadZipFile) as e:
+			print("Failed to read image " + path + ": " + str(e), file = sys.stderr)
+			return (None, None)
+
+		new_thumbnail = ShaderScanner.createThumbnail(path, content)
+
+		return (new_thumbnail[:4], new_thumbnail)
+
+	def __loadPreview(self, texture):
+		"""Decodes the preview of a texture that was scanned without one, the result is memoized
+		in the database and in the thumbnail store."""
+		record = self.shaders[texture]
+
+		if record["preview"] != None or record["width"] == record["height"] == 0:
 			return
 
-		for pk3_path in pk3.namelist():
-			combined_path = path + ":" + pk3_path
+		self.__setThumbnail(texture, *Shaders.readThumbnail(self.cache, self.open_paks, record["key"], record["path"]))
 
-			if  pk3_path.startswith("textures/") \
-			and pk3_path.rsplit(".", 1)[-1].lower() in Static.TEXTURE_EXTENSIONS:
-				name = pk3_path[9:].rsplit(".", 1)[0]
+	def __setThumbnail(self, texture, thumbnail, new_thumbnail):
+		record = self.shaders[texture]
 
-				#preview = QtGui.QPixmap()
-				#preview.loadFromData(pk3.read(pk3_path))
-				preview = self.__createPixmap(combined_path, pk3.read(pk3_path))
+		if thumbnail == None:
+			record["preview"] = b""
+			return
 
-				width = preview.width()
-				height = preview.height()
+		if new_thumbnail != None and new_thumbnail[2] > 0:
+			self.__storeThumbnails({record["key"]: new_thumbnail})
 
-				if not preview.isNull():
-					preview = preview.scaled(128, 128, QtCore.Qt.KeepAspectRatio)
+			if self.descriptors != None and new_thumbnail[4] != None:
+				self.descriptors[record["key"]] = new_thumbnail[4]
+				self.similarity_index = None
 
-				self.__addTexture(name, combined_path, preview, width, height)
+		(preview, preview_width, width, height) = thumbnail
 
-			elif pk3_path.startswith("scripts/") and pk3_path.endswith(".shader"):
-				self.__parseShaderFileContent(combined_path, pk3.read(pk3_path))
+		record["preview"] = preview
+		if preview_width > 0 and width > 0:
+			record["preview_scale"] = preview_width / width
 
-	def __parseShaderFileContent(self, path, content):
-		print("Parsing shader file " + path)
+	def getPreviewJob(self, shader):
+		"""Returns None if getPreview(shader) returns at once, otherwise (texture, key, path, preview) for a
+		ThumbnailProvider to read and decode the preview of texture, preview is None if it still has to be read."""
+		if shader not in self.shaders:
+			return None
 
-		if type(content) == bytes:
-			try:
-				content = content.decode("ascii")
-			except UnicodeDecodeError as e:
-				print("Failed to convert a shader file " + path + " to ascii: " + str(e), file = sys.stderr)
-				return
+		if self.shaders[shader]["is_shader"]:
+			shader = self.shaders[shader]["preview_source"]
 
-		shader = None
-		for line in content.splitlines():
-			if line.isspace() or line.strip().startswith("//"):
-				continue
+			# prevent recursion
+			if shader not in self.shaders or self.shaders[shader]["is_shader"]:
+				return None
 
-			line = line.split("//", 1)[0]
+		record = self.shaders[shader]
 
-			if line.startswith("textures/"):
-				if shader != None:
-					self.__parseShaderText(path, shader)
-				shader = line
-			elif shader != None:
-				shader += ("\n" + line)
+		if record["width"] == record["height"] == 0 or record["preview"] == b"" or shader in self.preview_cache:
+			return None
 
-		# parse last shader
-		if shader != None:
-			self.__parseShaderText(path, shader)
+		return (shader, record["key"], record["path"], record["preview"])
 
-	def __parseShaderText(self, path, text):
-		lines = text.splitlines()
+	def getLoadingPreview(self):
+		"Returns the image shown until a ThumbnailProvider has decoded a preview."
+		return self.__getPlaceholder("LOADING")
 
-		name = lines.pop(0).split("/", 1)[-1]
-		preview_source = None
+	def setDecodedPreview(self, texture, key, thumbnail, new_thumbnail, image):
+		"""Takes over a preview read and decoded by a ThumbnailProvider thread, thumbnail is None if
+		the record had the preview already. Returns False if texture was reloaded meanwhile."""
+		if texture not in self.shaders or self.shaders[texture]["key"] != key:
+			return False
 
-		qer_editorimage = None
-		diffusemap = None
-		random_map = None # if no qer_editorimage/diffusemap is set, use the last map we've seen
+		if self.shaders[texture]["preview"] == None:
+			self.__setThumbnail(texture, thumbnail, new_thumbnail)
 
-		for line in lines:
-			line = line.strip()
-			line_lower = line.lower()
+		if self.shaders[texture]["preview"]:
+			self.preview_cache.put(texture, QtGui.QPixmap.fromImage(image))
 
-			try:
-				if line_lower.startswith("qer_editorimage"):
-					qer_editorimage = line.split(None, 1)[-1]
-				elif line_lower.startswith("diffusemap"):
-					diffusemap = line.split(None, 1)[-1]
-				elif line_lower.startswith("map") and "textures/" in line:
-					random_map = line.split(None, 1)[-1]
-			except IndexError:
-				return
+		return True
 
-			if qer_editorimage != None:
-				preview_source = qer_editorimage
-			elif diffusemap != None:
-				preview_source = diffusemap
-			elif random_map != None:
-				preview_source = random_map
+	def loadShaders(self, pd, basepath, homepath, pakdir, reload = False, scanned = None):
+		"""Updates self.basepath and self.homepath and loads shader data from disk if the pathes have changed.
+		scanned is called with the records of every source as soon as it was scanned. Once pd was canceled,
+		the sources not scanned yet keep their old records."""
+		if self.basepath != basepath or self.homepath != homepath or reload:
+			necessary = True
+		# loading was canceled before every source was scanned
+		elif any(path not in self.source_records for path in self.shader_sources):
+			necessary = True
+		else:
+			necessary = False
 
-		if preview_source != None:
-			preview_source = preview_source.split("/", 1)[-1].rsplit(".", 1)[0]
-			self.__addShader(name, path, preview_source, text)
+		self.basepath = basepath
+		self.homepath = homepath
+		self.pakdir = pakdir
 
-	def __parseTextureDir(self, directory):
-		for node in [
-			node
-			for node in os.listdir(directory)
-			if os.path.isfile(directory + os.sep + node)
-			and node.rsplit(".", 1)[-1].lower() in Static.TEXTURE_EXTENSIONS
-		]:
-			name = os.path.basename(directory) + "/" + node.rsplit(".", 1)[0]
-			path = directory + os.sep + node
+		if necessary:
+			self.__compactCache()
+			self.__updateShaderSources(pd)
+			self.__updateShaderData(pd, scanned)
+
+		return necessary
 
-			#preview = QtGui.QPixmap()
-			#preview.load(path)
-			preview = self.__createPixmap(path, None)
+	def __compactCache(self):
+		"Drops the thumbnails no key points to from the cache, before scan processes read it."
+		try:
+			if self.cache.compact():
+				print("Compacted thumbnail cache " + self.cache.blob_path)
+		except (sqlite3.Error, OSError) as e:
+			print("Failed to compact thumbnail cache " + self.cache.blob_path + ": " + str(e), file = sys.stderr)
 
-			width = preview.width()
-			height = preview.height()
+	def reloadShaders(self, pd):
+		"Reloads shader data from disk."
+		self.loadShaders(pd, self.basepath, self.homepath, self.pakdir, True)
 
-			if not preview.isNull():
-				preview = preview.scaled(128, 128, QtCore.Qt.KeepAspectRatio)
+	def __getDescriptorTexture(self, shader):
+		"Returns the texture whose preview is shown for shader, None if there is none."
+		if shader not in self.shaders:
+			return None
 
-			self.__addTexture(name, path, preview, width, height)
+		if self.shaders[shader]["is_shader"]:
+			shader = self.shaders[shader]["preview_source"]
 
-	# It's not possible to run copy.deepcopy and pickle.dump on a QPixmap
-	def convertQPixmapToQByteArray(self, qpixmap):
-		qbytearray = QtCore.QByteArray()
-		qbuffer = QtCore.QBuffer(qbytearray)
-		qbuffer.open(QtCore.QIODevice.WriteOnly)
-		qpixmap.save(qbuffer, "JPG", 100)
-		qbuffer.close()
-		return qbytearray
+			# prevent recursion
+			if shader not in self.shaders or self.shaders[shader]["is_shader"]:
+				return None
 
-	def convertQByteArrayToQPixmap(self, qbytearray):
-		qpixmap = QtGui.QPixmap()
-		qpixmap.loadFromData(qbytearray)
-		return qpixmap
+		return shader
 
-	def __addTexture(self, name, path, preview, width, height):
-		"Adds a single loose texture to the database."
-		self.shaders[name] = dict()
-		self.shaders[name]["is_shader"] = False
-		self.shaders[name]["path"] = path
-		self.shaders[name]["preview"] = self.convertQPixmapToQByteArray(preview)
-		self.shaders[name]["preview_source"] = None
-		if preview.width() > 0 and width > 0:
-			self.shaders[name]["preview_scale"] = preview.width() / width
-		else:
-			self.shaders[name]["preview_scale"] = 1.0
-		self.shaders[name]["width"] = width
-		self.shaders[name]["height"] = height
-		self.shaders[name]["shader"] = None
+	def __getDescriptorKey(self, shader):
+		"Returns the content key of the texture whose preview is shown for shader, None if there is none."
+		texture = self.__getDescriptorTexture(shader)
 
-	def __addShader(self, name, path, preview_source, text):
-		self.shaders[name] = dict()
-		self.shaders[name]["is_shader"] = True
-		self.shaders[name]["path"] = path
-		self.shaders[name]["preview"] = None
-		self.shaders[name]["preview_source"] = preview_source
-		self.shaders[name]["preview_scale"] = None
-		self.shaders[name]["width"] = None
-		self.shaders[name]["height"] = None
-		self.shaders[name]["shader"] = text
-
-
-class Map():
-	def __init__(self, model):
-		self.model = model
+		if texture == None:
+			return None
 
-		self.content = None
-		self.shader_counter = dict() # shader -> count
-		self.index2shader = dict() # table row -> shader
-		self.shader2index = dict() # shader -> table row
+		return self.shaders[texture]["key"]
 
-	def __contains__(self, shader):
-		return shader in self.shader_counter
+	def __getSimilarityIndex(self):
+		if self.descriptors == None:
+			self.descriptors = self.cache.getDescriptors()
 
-	def __len__(self):
-		return len(self.shader_counter)
+		if self.similarity_index == None:
+			names = list()
+			descriptors = list()
 
-	def distinctShaders(self):
-		return len(self.shader_counter)
+			for shader in self.sorted_shaders:
+				key = self.__getDescriptorKey(shader)
 
-	def appearance(self, shader):
-		if shader in self.shader_counter:
-			return self.shader_counter[shader]
-		else:
-			return 0
+				if key in self.descriptors:
+					names.append(shader)
+					descriptors.append(self.descriptors[key])
 
-	def shaderToIndex(self, shader):
-		if shader in self.shader2index:
-			return self.shader2index[shader]
+			self.similarity_index = (names, ImageDescriptor.toArrays(descriptors))
+
+		return self.similarity_index
+
+	def getTexturesWithoutDescriptor(self, shaders = None):
+		"""Returns the textures shown for shaders, all shaders by default, whose preview wasn't decoded yet.
+		They are left out by getSimilarShaders and compared by name and size only by suggestReplacements."""
+		if self.descriptors == None:
+			self.descriptors = self.cache.getDescriptors()
+
+		if shaders == None:
+			textures = self.sorted_shaders
 		else:
-			return None
+			textures = sorted({self.__getDescriptorTexture(shader) for shader in shaders}.difference((None,)))
+
+		return [
+			texture for texture in textures
+			if not self.shaders[texture]["is_shader"]
+			and self.shaders[texture]["key"] not in self.descriptors
+			and self.shaders[texture]["preview"] == None
+			and not self.shaders[texture]["width"] == self.shaders[texture]["height"] == 0
+		]
+
+	def getSimilarShaders(self, shader, count = None):
+		"Returns the count shaders that look most similar to shader, most similar first."
+		if count == None:
+			count = Static.SIMILAR_SHADER_COUNT
+
+		(names, arrays) = self.__getSimilarityIndex()
+
+		key = self.__getDescriptorKey(shader)
 
-	def indexToShader(self, index):
-		if index in self.index2shader:
-			return self.index2shader[index]
+		if key == None or key not in self.descriptors or len(names) == 0:
+			return list()
+
+		distances = ImageDescriptor.getDistances([self.descriptors[key]], arrays)[0]
+
+		# only the best ones get sorted
+		if count < len(distances):
+			positions = numpy.argpartition(distances, count)[:count]
 		else:
-			return None
+			positions = numpy.arange(len(distances))
 
-	def parse(self, content):
-		self.content = content
-		self.shader_counter.clear()
+		# equally distant shaders stay sorted by name
+		positions = positions[numpy.lexsort((positions, distances[positions]))]
 
-		for line in content.splitlines():
-			words=line.split()
+		return [names[position] for position in positions.tolist()]
 
-			if len(words) == 24:
-				shader = words[15]
-			elif len(words) == 1 and "/" in words[0]:
-				shader = words[0]
-			else:
-				shader = None
-
-			if shader:
-				self.shader_counter.setdefault(shader, 0)
-				self.shader_counter[shader] += 1
-
-		self.__generateShaderOrder()
-
-	def __generateShaderOrder(self):
-		self.index2shader.clear()
-		self.shader2index.clear()
-
-		tmp = [(count, name) for (name, count) in self.shader_counter.items()]
-		tmp.sort(reverse = True)
-		position = 0
-		for (count, name) in tmp:
-			self.index2shader[position] = name
-			self.shader2index[name] = position
-			position += 1
-
-	# unused but might come in handy at a later moment
-#	def __faceRotation(self, p1_x, p1_y, p1_z, p2_x, p2_y, p2_z, p3_x, p3_y, p3_z, debug = False):
-#		"""Takes the vertices of a triangle describing a brush face in 3D space as an argument and
-#		calculates the rotation of the face around the texture projection axis."""
-#
-#		# V contains the vertices of the given triangle
-#		V = {
-#			0: {"x": p1_x, "y": p1_y, "z": p1_z},
-#			1: {"x": p2_x, "y": p2_y, "z": p2_z},
-#			2: {"x": p3_x, "y": p3_y, "z": p3_z}
-#		}
-#
-#		# r is the vertice at the right angle of V
-#		r = max(
-#				((p2_x - p3_x)**2 + (p2_y - p3_y)**2 + (p2_z - p3_z)**2, 0),
-#				((p1_x - p3_x)**2 + (p1_y - p3_y)**2 + (p1_z - p3_z)**2, 1),
-#				((p1_x - p2_x)**2 + (p1_y - p2_y)**2 + (p1_z - p2_z)**2, 2)
-#		)[1]
-#
-#		# u and v are vectors that span a plain orthogonal to V
-#		u = dict()
-#		v = dict()
-#		for axis in ("x", "y", "z"):
-#			u[axis] = V[r][axis] - V[(r - 1) % 3][axis]
-#			v[axis] = V[r][axis] - V[(r + 1) % 3][axis]
-#
-#		# n = u x v is the normal vector of the plain spanned by u and v
-#		n = dict()
-#		n["x"] = u["y"] * v["z"] - u["z"] * v["y"]
-#		n["y"] = u["z"] * v["x"] - u["x"] * v["z"]
-#		n["z"] = u["x"] * v["y"] - u["y"] * v["x"]
-#
-#		# the projection axis is the axis most "similar" to n
-#		projection_axis = max(
-#			(n["x"], "x"),
-#			(n["y"], "y"),
-#			(n["z"], "z")
-#		)[1]
-#
-#		if   projection_axis == "x":
-#			angle = math.atan2(u["y"], u["z"])
-#		elif projection_axis == "y":
-#			angle = math.atan2(u["x"], u["z"])
-#		else:
-#			angle = math.atan2(u["x"], u["y"])
-#
-#		if debug:
-#			print("Vertice 0: "+str(p1_x)+" "+str(p1_y)+" "+str(p1_z))
-#			print("Vertice 1: "+str(p2_x)+" "+str(p2_y)+" "+str(p2_z))
-#			print("Vertice 2: "+str(p3_x)+" "+str(p3_y)+" "+str(p3_z))
-#			print("Right angle vertice: "+str(r))
-#			print("Span vector u: "+str(u["x"])+" "+str(u["y"])+" "+str(u["z"]))
-#			print("Span vector v: "+str(v["x"])+" "+str(v["y"])+" "+str(v["z"]))
-#			print("Normal vector n: "+str(n["x"])+" "+str(n["y"])+" "+str(n["z"]))
-#			print("Projection axis: "+projection_axis)
-#			print("Angle: "+str(math.degrees(angle)))
-#
-#		return angle
-
-	def build(self, rules):
-		new_content = ""
-		replaced_faces = 0
-		replaced_patches = 0
-
-		inside_patch = False
-#		patch_old = patch_new = patch_rule_rot = patch_rule_rot_rad = patch_rule_hscale = patch_rule_vscale = None
-
-		for line in self.content.splitlines():
-			words = line.split()
-
-			# brush
-			if len(words) == 24 and words[15] in rules:
-#				(p1_x, p1_y, p1_z) = [float(i) for i in words[1:4]]
-#				(p2_x, p2_y, p2_z) = [float(i) for i in words[6:9]]
-#				(p3_x, p3_y, p3_z) = [float(i) for i in words[11:14]]
-
-				old = words[15]
-				old_hshift = float(words[16])
-				old_vshift = float(words[17])
-				old_rot = float(words[18])
-				old_hscale = float(words[19])
-				old_vscale = float(words[20])
-
-				new = rules.getNewShader(old)
-				rule_hscale = rules.getHScale(old)
-				rule_vscale = rules.getVScale(old)
-				rule_rot = rules.getRotation(old)
-				rule_rot_rad = math.radians(rule_rot)
-
-				new_rot = (old_rot + rule_rot) % 360.0
-
-				new_hscale = (math.cos(rule_rot_rad)**2 * old_hscale  \
-				           +  math.sin(rule_rot_rad)**2 * old_vscale) \
-				           *  rule_hscale
-
-				new_vscale = (math.cos(rule_rot_rad)**2 * old_vscale  \
-				           +  math.sin(rule_rot_rad)**2 * old_hscale) \
-				           *  rule_vscale
-
-				if old in self.model.shaders and new in self.model.shaders \
-				and self.model.shaders.sizeKnown(old) and self.model.shaders.sizeKnown(new):
-					old_hshift_ratio = old_hshift / self.model.shaders.getWidth(old)
-					old_vshift_ratio = old_vshift / self.model.shaders.getHeight(old)
-
-					old_hshift_ratio -= int(old_hshift_ratio)
-					old_vshift_ratio -= int(old_vshift_ratio)
-
-					new_hshift_ratio = math.cos(rule_rot_rad)**2 * old_hshift_ratio \
-					                 + math.sin(rule_rot_rad)**2 * old_vshift_ratio
-					new_vshift_ratio = math.cos(rule_rot_rad)**2 * old_vshift_ratio \
-					                 + math.sin(rule_rot_rad)**2 * old_hshift_ratio
-
-					new_hshift_ratio -= int(new_hshift_ratio)
-					new_vshift_ratio -= int(new_vshift_ratio)
-
-					new_hshift = new_hshift_ratio * self.model.shaders.getWidth(new)
-					new_vshift = new_vshift_ratio * self.model.shaders.getHeight(new)
-				else:
-					new_hshift = old_hshift / rule_hscale
-					new_vshift = old_vshift / rule_vscale
+	def __getNameTrigrams(self, shader):
+		"Returns the lower case trigrams of shader without its set name."
+		name = shader.split("/", 1)[-1].lower()
+
+		return {name[start:start + 3] for start in range(len(name) - 2)}
+
+	def suggestReplacements(self, pd, old_shaders, candidates, skip_own_set = False):
+		"""Returns old shader -> the best replacement among candidates. Candidates are scored by
+		shared name trigrams, by how well their aspect ratio fits once rotated like Rules would
+		rotate them and by their look, all candidates at once per old shader. With skip_own_set
+		the candidates of the old shader's own set are skipped. Old shaders without any candidate
+		sharing a trigram or a look are left out."""
+		(name_weight, aspect_weight, look_weight) = Static.SUGGESTION_WEIGHTS
+
+		candidates = [shader for shader in candidates if shader in self.shaders]
+
+		if len(candidates) == 0:
+			return dict()
+
+		setname2id = dict()
+		set_ids = numpy.array([setname2id.setdefault(shader.split("/", 1)[0], len(setname2id)) for shader in candidates])
+
+		# the search index covers set names as well, the postings have to match the trigrams counted
+		postings = dict() # trigram -> candidate numbers
+		trigram_counts = numpy.zeros(len(candidates), dtype = numpy.int64)
+		for number in range(len(candidates)):
+			trigrams = self.__getNameTrigrams(candidates[number])
+			trigram_counts[number] = len(trigrams)
+
+			for trigram in trigrams:
+				postings.setdefault(trigram, list()).append(number)
 
-				new_line = " ".join(words[0:15]) \
-				         + " " + new \
-				         + " " + str(new_hshift) \
-				         + " " + str(new_vshift) \
-				         + " " + str(new_rot) \
-				         + " " + str(new_hscale) \
-				         + " " + str(new_vscale) \
-				         + " " + " ".join(words[21:24])
+		postings = {trigram: numpy.array(numbers, dtype = numpy.int64) for (trigram, numbers) in postings.items()}
+		no_postings = numpy.zeros(0, dtype = numpy.int64)
 
-				replaced_faces += 1
+		widths = numpy.array([self.getWidth(shader) for shader in candidates], dtype = numpy.float64)
+		heights = numpy.array([self.getHeight(shader) for shader in candidates], dtype = numpy.float64)
+		known_sizes = (widths > 0) & (heights > 0)
+		(widths, heights) = (widths[known_sizes], heights[known_sizes])
 
-			# patch begin
-			elif len(words) == 1 and words[0] in rules:
-				inside_patch = True
+		(names, arrays) = self.__getSimilarityIndex()
+		name2row = {names[row]: row for row in range(len(names))}
+		rows = numpy.array([name2row.get(shader, -1) for shader in candidates], dtype = numpy.int64)
+		known_looks = rows >= 0
+		arrays = tuple(array[rows[known_looks]] for array in arrays)
 
-				patch_old = words[0]
-				patch_new = rules.getNewShader(patch_old)
-				patch_rule_rot_rad = math.radians(rules.getRotation(patch_old))
-#				patch_rule_hscale = rules.getHScale(patch_old)
-#				patch_rule_vscale = rules.getVScale(patch_old)
+		suggestions = dict()
+		pd.setMaximum(len(old_shaders))
 
-				new_line = patch_new
+		# the looks are compared for a batch of old shaders at once
+		batch_size = 64
+		for batch_start in range(0, len(old_shaders), batch_size):
+			batch = old_shaders[batch_start:batch_start + batch_size]
+			keys = [self.__getDescriptorKey(old_shader) for old_shader in batch]
+			with_looks = [position for position in range(len(batch)) if keys[position] in self.descriptors]
 
-				replaced_patches += 1
+			if len(with_looks) > 0 and known_looks.any():
+				batch_look_distances = ImageDescriptor.getDistances([self.descriptors[keys[position]] for position in with_looks], arrays)
 
-			elif inside_patch:
-				if   len(words) in (1, 7):
-					new_line = line
+			for position in range(len(batch)):
+				old_shader = batch[position]
+				pd.setValue(batch_start + position)
 
-					if words[0] in (")", "}"):
-						inside_patch = False
+				# dice coefficient of the name trigrams
+				trigrams = self.__getNameTrigrams(old_shader)
 
-				# patch column
+				if len(trigrams) > 0:
+					common = numpy.bincount(numpy.concatenate([postings.get(trigram, no_postings) for trigram in trigrams]), minlength = len(candidates))
 				else:
-					patch_column = words[1:-1]
-					new_line = "( "
-
-					# patch row
-					while len(patch_column) > 0:
-						patch_column.pop(0) # "("
-						old_x = patch_column.pop(0)
-						old_y = patch_column.pop(0)
-						old_z = patch_column.pop(0)
-						old_hshift = float(patch_column.pop(0))
-						old_vshift = float(patch_column.pop(0))
-						patch_column.pop(0) # ")"
-
-						# TODO: scale + shift patch?
-
-						new_hshift = math.cos(patch_rule_rot_rad)**2 * old_hshift \
-						           + math.sin(patch_rule_rot_rad)**2 * old_vshift
-						new_vshift = math.cos(patch_rule_rot_rad)**2 * old_vshift \
-						           + math.sin(patch_rule_rot_rad)**2 * old_hshift
-
-						new_line += "( " \
-						         +        old_x \
-						         +  " " + old_y \
-						         +  " " + old_z \
-						         +  " " + str(new_hshift) \
-						         +  " " + str(new_vshift) \
-						         +  " ) "
-
-					new_line += ")"
+					common = numpy.zeros(len(candidates), dtype = numpy.int64)
 
-			else:
-				new_line = line
+				name_distances = 1 - 2 * common / numpy.maximum(len(trigrams) + trigram_counts, 1)
 
-			new_content += new_line + "\n"
+				# log ratio of the aspect ratios, a factor of 4 or more is as bad as it gets
+				old_width = self.getWidth(old_shader)
+				old_height = self.getHeight(old_shader)
+				aspect_distances = numpy.full(len(candidates), 0.5)
 
-		return (new_content, replaced_faces, replaced_patches)
+				if old_width > 0 and old_height > 0:
+					rotated = Rules.guessRotation(old_width, old_height, widths, heights) != 0
+					ratios = numpy.where(rotated, heights / widths, widths / heights)
+					aspect_distances[known_sizes] = numpy.minimum(numpy.abs(numpy.log(ratios * old_height / old_width)) / math.log(4), 1)
 
+				look_distances = numpy.full(len(candidates), 0.5)
+				informative = common > 0
 
-class Rules():
-	def __init__(self, model):
-		self.model = model
+				if position in with_looks and known_looks.any():
+					look_distances[known_looks] = batch_look_distances[with_looks.index(position)]
+					informative |= known_looks
 
-		self.rules = dict() # old shader -> (new shader, hscale, vscale, rot)
+				scores = name_weight * name_distances + aspect_weight * aspect_distances + look_weight * look_distances
+				scores[~informative] = numpy.inf
 
-	def __contains__(self, rule):
-		return rule in self.rules
+				old_setname = old_shader.split("/", 1)[0]
+				if skip_own_set and old_setname in setname2id:
+					scores[set_ids == setname2id[old_setname]] = numpy.inf
 
-	def __len__(self):
-		return len(self.rules)
+				best = int(numpy.argmin(scores))
 
-	def empty(self):
-		return len(self) == 0
+				if scores[best] != numpy.inf:
+					suggestions[old_shader] = candidates[best]
 
-	def readFile(self, path):
-		with open(path, "r") as f:
-			content = f.read()
+		pd.setValue(len(old_shaders))
 
-		self.clear()
+		return suggestions
 
-		for line in content.splitlines():
-			line = line.strip()
+	def __updateShaderSources(self, pd):
+		"""Writes pathes of mod directories and their pak files/dirs inside self.basepath
+		and self.homepath into self.shader_sources."""
+		self.shader_sources.clear()
 
-			if line.startswith("#") or line.startswith("//"):
-				continue
+		for path in (self.basepath, self.homepath):
+			if path != None:
+				path = os.path.expanduser(path).rstrip(os.sep)
 
-			words = line.split()
+				if not os.path.isdir(path):
+					continue
 
-			if len(words) != 5:
-				continue
+				mods = list()
+				for node in os.listdir(path):
+					if self.pakdir in ["", node]:
+						if os.path.isdir(path + os.sep + node):
+							mods.append(node)
+
+				for mod in mods:
+					mod_path = path + os.sep + mod
+					self.shader_sources.append(mod_path)
 
-			(old, new, hscale, vscale, rot) = words
+					for node in os.listdir(mod_path):
+						for pak_type in ["pk3", "dpk"]:
+							if node.endswith(os.extsep + pak_type) or node.endswith(os.extsep + pak_type + "dir"):
+								self.shader_sources.append(mod_path + os.sep + node)
 
-			try:
-				hscale = float(hscale)
-				vscale = float(vscale)
-				rot = float(rot)
-			except ValueError:
-				continue
+		pd.setMaximum(len(self.shader_sources))
 
-			self.__setRule(old, new, hscale, vscale, rot)
+	def __getSourceSignature(self, path):
+		"""Returns what identifies the content of a shader source: size and mtime of a pk3 or
+		a digest over the scripts and textures trees of a directory."""
+		try:
+			if os.path.isfile(path):
+				stat = os.stat(path)
+				return str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+			elif os.path.isdir(path):
+				digest = hashlib.sha1()
+				for tree in ("scripts", "textures"):
+					for (dirpath, dirnames, filenames) in os.walk(path + os.sep + tree):
+						dirnames.sort()
+						for node in sorted(filenames):
+							stat = os.stat(dirpath + os.sep + node)
+							digest.update((dirpath + os.sep + node + "\0" + str(stat.st_size) + "\0" + str(stat.st_mtime_ns) + "\n").encode("utf-8", "surrogateescape"))
+				return digest.hexdigest()
+		except OSError:
+			pass
 
-	def writeFile(self, path):
-		out = "# This is a rules file for " + Static.APP_TITLE + ".\n" \
-		    + "# <old shader> <new shader> <horizontal scale> <vertical scale> <rotation>\n"
+		return None
 
-		for (old, (new, hscale, vscale, rot)) in self.rules.items():
-			out += old + " " + new + " " + str(hscale) + " " + str(vscale) + " " + str(rot) + "\n"
+	def __updateShaderData(self, pd, scanned):
+		"""Writes database of shaders inside self.shader_sources into self.shaders.
+		Only sources that were added or modified since they were last scanned are scanned again."""
+		for path in list(self.source_records.keys()):
+			if path not in self.shader_sources:
+				del self.source_records[path]
 
-		with open(path, "w") as f:
-			f.write(out)
+		changed_sources = list()
+		signatures = list()
+		for path in self.shader_sources:
+			signature = self.__getSourceSignature(path)
 
-	def addRule(self, old, new):
-		self.__setRule(old, new, None, None, None)
-		self.setRotation(old)
+			if path not in self.source_records or self.source_records[path][0] != signature:
+				changed_sources.append(path)
+				signatures.append(signature)
 
-	def __setRule(self, old, new, hscale, vscale, rot):
-		self.rules[old] = [new, hscale, vscale, rot]
+		progress = len(self.shader_sources) - len(changed_sources)
+		pd.setValue(progress)
 
-	def delRule(self, shader):
-		if shader in self.rules:
-			self.rules.pop(shader)
+		# create the index before worker processes try to read it
+		self.cache.open()
 
-	def clear(self):
-		self.rules.clear()
+		processes = min(Static.SCAN_PROCESSES, len(changed_sources))
 
-	def getNewShader(self, shader):
-		if shader in self.rules:
-			return self.rules[shader][0]
+		if processes > 1:
+			results = self.__scanShaderSourcesParallel(pd, progress, changed_sources, processes, scanned)
 		else:
-			return None
+			results = self.__scanShaderSourcesSerial(pd, progress, changed_sources, scanned)
 
-	def getHScale(self, shader):
-		if shader in self.rules:
-			return self.rules[shader][1]
-		else:
-			return None
+		for (path, signature, records) in zip(changed_sources, signatures, results):
+			# not scanned because of canceling, the next load scans it
+			if records == None:
+				continue
 
-	def getVScale(self, shader):
-		if shader in self.rules:
-			return self.rules[shader][2]
-		else:
-			return None
+			self.source_records[path] = (signature, records)
+			self.dirty_sources.add(path)
 
-	def getRotation(self, shader):
-		if shader in self.rules:
-			return self.rules[shader][3]
-		else:
-			return None
+		self.mergeSourceRecords()
 
-	def setHScale(self, shader, value):
-		if shader in self.rules:
-			self.rules[shader][1] = value
+	def mergeSourceRecords(self):
+		self.__resetPreviews()
 
-	def setVScale(self, shader, value):
-		if shader in self.rules:
-			self.rules[shader][2] = value
+		super().mergeSourceRecords()
 
-	def setRotation(self, shader, value = None):
-		if shader in self.rules:
-			new_shader = self.getNewShader(shader)
-			both_shaders_known = shader in self.model.shaders and new_shader in self.model.shaders
+	def replaceWith(self, index):
+		self.__resetPreviews()
 
-			if both_shaders_known:
-				old_width = self.model.shaders.getWidth(shader)
-				old_height = self.model.shaders.getHeight(shader)
+		super().replaceWith(index)
 
-				new_width = self.model.shaders.getWidth(new_shader)
-				new_height = self.model.shaders.getHeight(new_shader)
+	def __resetPreviews(self):
+		"Forgets decoded previews and descriptors, called before the database is rebuilt."
+		self.preview_cache.clear()
+		self.transformed_preview_cache.clear()
 
-				both_shaders_known = \
-					old_width != 0 and old_height != 0 and new_width != 0 and new_height != 0
+		# paks might have changed on disk
+		for pk3 in self.open_paks.values():
+			pk3.close()
+		self.open_paks.clear()
 
-			if value == None:
-				if both_shaders_known:
-					if old_width > old_height and new_width < new_height \
-					or old_width < old_height and new_width > new_height:
-						rot = 90.0
-					else:
-						rot = 0.0
-				else:
-					rot = 0.0
-			else:
-				rot = value % 360.0
+		# the cache may have new descriptors now
+		self.descriptors = None
+		self.similarity_index = None
 
-			if both_shaders_known:
-				rot_rad = math.radians(rot)
+	def __scanShaderSourcesSerial(self, pd, progress, sources, scanned):
+		results = [None for path in sources]
 
-				hscale = math.fabs(
-					(old_width * math.cos(rot_rad) + old_height * math.sin(rot_rad)) / new_width
-				)
+		for position in range(len(sources)):
+			if pd.wasCanceled():
+				break
 
-				vscale = math.fabs(
-					(old_height * math.cos(rot_rad) + old_width * math.sin(rot_rad)) / new_height
-				)
-			else:
-				hscale = 1.0
-				vscale = 1.0
+			(records, thumbnails, scripts) = ShaderScanner.scanSource(sources[position], (self.cache.index_path, self.cache.blob_path), Static.LAZY_PREVIEWS)
+			results[position] = records
+			self.__storeThumbnails(thumbnails)
+			self.__storeScripts(scripts)
+
+			if scanned != None:
+				scanned(records)
 
-			self.rules[shader][1] = hscale
-			self.rules[shader][2] = vscale
-			self.rules[shader][3] = rot
+			progress += 1
+			pd.setValue(progress)
 
+		return results
 
-class Model():
-	def __init__(self):
-		self.view = None
+	def __scanShaderSourcesParallel(self, pd, progress, sources, processes, scanned):
+		results = [None for path in sources]
+
+		# spawn instead of fork, forking a process that runs a Qt GUI isn't safe
+		context = multiprocessing.get_context("spawn")
+
+		# every worker decodes crunch textures on its own, they would run processes² crunch processes otherwise
+		crunch_processes = max(Static.CRUNCH_PROCESSES // processes, 1)
+
+		with concurrent.futures.ProcessPoolExecutor(processes, context) as executor:
+			future2position = dict()
+			for position in range(len(sources)):
+				future = executor.submit(ShaderScanner.scanSource, sources[position], (self.cache.index_path, self.cache.blob_path), Static.LAZY_PREVIEWS, crunch_processes)
+				future2position[future] = position
+
+			for future in concurrent.futures.as_completed(future2position):
+				if future.cancelled():
+					continue
+
+				position = future2position[future]
+
+				try:
+					(results[position], thumbnails, scripts) = future.result()
+					self.__storeThumbnails(thumbnails)
+					self.__storeScripts(scripts)
+				except BaseException as e:
+					print("Failed to scan shader source " + sources[position] + ": " + str(e), file = sys.stderr)
+					results[position] = list()
+
+				if scanned != None:
+					scanned(results[position])
+
+				progress += 1
+				pd.setValue(progress)
 
-		self.shaders = Shaders()
-		self.rules = Rules(self)
-		self.map = Map(self)
+				# sources being scanned are still waited for
+				if pd.wasCanceled():
+					for other in future2position:
+						other.cancel()
+
+		return results
+
+	def __storeThumbnails(self, thumbnails):
+		"Adds thumbnails decoded by a scan to the cache, sources scanned later will reuse them."
+		try:
+			self.cache.putThumbnails(thumbnails)
+		except (sqlite3.Error, OSError) as e:
+			print("Failed to write thumbnails: " + str(e), file = sys.stderr)
+
+	def __storeScripts(self, scripts):
+		"Adds the shaders parsed by a scan to the cache, the same scripts won't be parsed again."
+		try:
+			self.cache.putScriptShaders(scripts)
+		except sqlite3.Error as e:
+			print("Failed to write shader scripts: " + str(e), file = sys.stderr)
+
+	def convertQByteArrayToQPixmap(self, qbytearray):
+		qpixmap = QtGui.QPixmap()
+		qpixmap.loadFromData(qbytearray)
+		return qpixmap
+
+
+class Model(chameleon_core.Model):
+	def __init__(self, cache = None):
+		super().__init__(Shaders(cache))
+
+		self.view = None
 
 	def openMap(self, path):
 		"Opens and parses a map file."
-		with open(path, "r") as f:
-			self.map.parse(f.read())
+		self.map.parse(path)
 
-		self.view.setStatus(os.path.basename(path) + " loaded.")
+		self.view.setStatus(
+			os.path.basename(path) + " loaded, " + str(self.map.countEntities()) + " entities, "
+			+ str(self.map.countBrushes()) + " brushes and " + str(self.map.countPatches()) + " patches."
+		)
 
 	def saveMap(self, path):
 		"Builds the new map and saves it to a file."
-		(new_content, replaced_faces, replaced_patches) = self.map.build(self.rules)
+		(replaced_faces, replaced_patches) = self.map.build(self.rules, path)
 
-		with open(path, "w") as f:
-			f.write(new_content)
+		# the opened map was overwritten, its offsets are gone
+		if os.path.realpath(path) == os.path.realpath(self.map.path):
+			self.map.parse(path)
 
 		self.view.setStatus("Replaced " + str(replaced_faces) + " faces and " + str(replaced_patches) + " patches.")
 
@@ -1697,10 +3027,40 @@ class Model():
 
 		self.view.setStatus(str(len(self.rules)) + " rules saved.")
 
-	def readCache(self):
-		"Tries to read shader cache from filesystem."
+	def getShadersWithoutRule(self):
+		"Returns the map shaders that have no rule yet."
+		return [shader for shader in self.map.shader_counter if shader not in self.rules]
+
+	def getCandidates(self, setnames):
+		"Returns the shaders of the given sets, or all shaders if there are none."
+		if not setnames:
+			return self.shaders.getShaders()
+
+		candidates = list()
+		for setname in setnames:
+			candidates.extend(self.shaders.getShadersForSet(setname))
+
+		return candidates
+
+	def suggestRules(self, pd, old_shaders, candidates, skip_own_set, undecoded = 0):
+		"""Adds a rule with the best replacement among candidates for every shader of old_shaders,
+		undecoded is the number of their previews that were not decoded and not compared."""
+		suggestions = self.shaders.suggestReplacements(pd, old_shaders, candidates, skip_own_set)
+
+		for (old_shader, new_shader) in suggestions.items():
+			self.rules.addRule(old_shader, new_shader)
+
+		status = "Suggested " + str(len(suggestions)) + " of " + str(len(old_shaders)) + " missing rules"
+
+		if undecoded > 0:
+			status += ", " + str(undecoded) + " previews were not decoded and compared by name and size only"
+
+		self.view.setStatus(status + ".")
+
+	def readCache(self, reader):
+		"Takes over the shader cache read by a finished CacheReader, if there was one."
 		try:
-			self.shaders.readCache(Static.SHADER_CACHE_FILE)
+			self.shaders.replaceWith(reader.getIndex())
 		except FileNotFoundError:
 			return False
 		except BaseException as e:
@@ -1710,43 +3070,49 @@ class Model():
 			self.view.setStatus("Loaded " + str(len(self.shaders)) + " shaders from cache.")
 			return True
 
-	def writeCache(self):
-		"Saves shader cache to a file."
+	def loadShaders(self, loader):
+		"Takes over the shaders loaded by a finished ShaderLoader, it already wrote them to the cache."
 		try:
-			self.shaders.writeCache(Static.SHADER_CACHE_FILE)
+			shaders = loader.getShaders()
 		except BaseException as e:
-			print("Failed to write cache file " + Static.SHADER_CACHE_FILE + ": " + str(e), file = sys.stderr)
+			print("Failed to load shaders: " + str(e), file = sys.stderr)
+
+			# drop the records added while loading
+			self.shaders.mergeSourceRecords()
 
-	def loadShaders(self, pd, basepath, homepath, pakdir):
-		"Loads shaders inside given pathes."
-		changed = self.shaders.loadShaders(pd, basepath, homepath, pakdir)
+			self.view.setStatus("Failed to load shaders.")
+			return
 
-		if changed:
-			self.writeCache()
+		if loader.changed:
+			self.shaders.replaceWith(shaders)
 
+		if loader.wasCanceled():
+			self.view.setStatus("Loading canceled, " + str(len(self.shaders)) + " shaders loaded.")
+		elif loader.changed:
 			self.view.setStatus("Loaded " + str(len(self.shaders)) + " shaders from disk.")
 		else:
 			self.view.setStatus("Shader sources unchanged.")
 
-	def reloadShaders(self, pd):
-		"Reloads shaders."
-		self.shaders.reloadShaders(pd)
-		self.writeCache()
 
-		self.view.setStatus("Loaded " + str(len(self.shaders)) + " shaders from disk.")
+if __name__ == "__main__":
+	multiprocessing.freeze_support()
 
+	parser = argparse.ArgumentParser(description = "Replaces the shaders of maps as a rules file says. Opens the GUI unless --batch is given.")
+	Batch.addArguments(parser)
+	parser.add_argument("--startup-benchmark", action = "store_true", help = "print how long the GUI takes to show up and to read the shader cache, then quit")
+	parser.add_argument("--max-window-time", type = float, metavar = "SECONDS", help = "make --startup-benchmark fail if the GUI takes longer to show up")
+	parser.add_argument("--max-cache-time", type = float, metavar = "SECONDS", help = "make --startup-benchmark fail if the shader cache takes longer to be read")
+	(args, unknown_args) = parser.parse_known_args()
 
-if __name__ == "__main__":
 	app = QtWidgets.QApplication(sys.argv)
 
 	model = Model()
 	view = View(model)
 	model.view = view
 
-	view.restoreSession()
+	view.show()
 
-	if not model.readCache():
-		view.askSettings()
+	# everything else happens once the window is up
+	QtCore.QTimer.singleShot(0, lambda: view.start(args.startup_benchmark, (args.max_window_time, args.max_cache_time)))
 
-	view.show()
 	sys.exit(app.exec_())
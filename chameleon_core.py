@@ -0,0 +1,2083 @@
+#!/usr/bin/env python3
+# Needs Python >= 3.3, NumPy
+
+
+# Copyright 2013 Unvanquished Development
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Map parsing and building, rules files and the shader index of Chameleon, without Qt.
+Scripts and build nodes without a display server can import this module, the GUI is in chameleon.py."""
+
+
+import argparse
+import array
+import collections
+import concurrent.futures
+import itertools
+import math
+import mmap
+import multiprocessing
+import numpy
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import zlib
+
+try:
+	import fcntl
+except ImportError: # Windows
+	fcntl = None
+
+
+class Static():
+	APP_TITLE = "Chameleon"
+	GAME_TITLE = "Unvanquished"
+
+	# worker processes building maps in batch mode
+	BATCH_PROCESSES = os.cpu_count() or 1
+
+	MAP_FILE_EXTENSION = ".map"
+	# maps are copied and written, and replaced brush faces read and transformed, by chunks of this size, in bytes
+	MAP_BUFFER_SIZE = 1024 * 1024
+	RULE_FILE_EXTENSION = ".rules"
+
+	# parent directories of what QStandardPaths returns for the application, found without Qt
+	if platform.system() == "Windows":
+		standardConfigParentDir = os.path.expandvars("%LOCALAPPDATA%")
+		standardApplicationParentDir = os.path.join(os.path.expandvars("%APPDATA%"), "Microsoft", "Windows", "Start Menu")
+		standardDataParentDir = os.path.expandvars("%APPDATA%")
+		standardCacheParentDir = os.path.join(os.path.expandvars("%LOCALAPPDATA%"), APP_TITLE)
+	elif platform.system() == "Darwin":
+		standardConfigParentDir = os.path.expanduser(os.path.join("~", "Library", "Preferences"))
+		# not the parent of QStandardPaths.ApplicationsLocation, which gave /Unvanquished.app before, the game is
+		# installed in /Applications/Unvanquished.app
+		standardApplicationParentDir = "/Applications"
+		standardDataParentDir = os.path.expanduser(os.path.join("~", "Library", "Application Support"))
+		standardCacheParentDir = os.path.expanduser(os.path.join("~", "Library", "Caches"))
+	else:
+		standardConfigParentDir = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser(os.path.join("~", ".config"))
+		standardDataParentDir = os.environ.get("XDG_DATA_HOME") or os.path.expanduser(os.path.join("~", ".local", "share"))
+		standardApplicationParentDir = standardDataParentDir
+		standardCacheParentDir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+
+	old_settings_dir = None
+
+	if platform.system() == "Windows":
+		old_settings_dir = os.path.join(os.path.expandvars("%APPDATA%", APP_TITLE))
+		# "My Games" is not a Microsoft standard but a de facto standard,
+		# there is no environement variable and the name is not expected to be localized.
+		DEFAULT_HOMEPATH = os.path.join(os.path.expandvars("%CSIDL_MYDOCUMENTS%"), "My Games", GAME_TITLE)
+		DEFAULT_BASEPATH = os.path.join(os.path.expandvars("%PROGRAMFILES%"), GAME_TITLE)
+		# Qt is broken and uses a disposable place (Local App Data) to save configuration,
+		# The data folder is correct anyway.
+		SETTINGS_DIR = os.path.join(standardDataParentDir, APP_TITLE)
+		# There is no distinction between configuration and data on Windows anyway.
+		DATA_DIR = SETTINGS_DIR
+		CACHE_DIR = os.path.join(standardCacheParentDir, APP_TITLE)
+	elif platform.system() == "Darwin":
+		DEFAULT_HOMEPATH = os.path.join(standardDataParentDir, GAME_TITLE)
+		DEFAULT_BASEPATH = os.path.join(standardApplicationParentDir, GAME_TITLE + ".app", "Contents", "MacOS")
+		SETTINGS_DIR = os.path.join(standardConfigParentDir, APP_TITLE)
+		DATA_DIR = os.path.join(standardDataParentDir, APP_TITLE)
+		CACHE_DIR = os.path.join(standardCacheParentDir, APP_TITLE)
+	else: # Assume Linux or other Posix system.
+		old_settings_dir = os.path.join(os.path.expandvars("${HOME}"), "." + APP_TITLE.lower())
+		DEFAULT_HOMEPATH = os.path.join(standardDataParentDir, GAME_TITLE.lower())
+		DEFAULT_BASEPATH = os.path.join(DEFAULT_HOMEPATH, "base")
+		SETTINGS_DIR = os.path.join(standardConfigParentDir, APP_TITLE.lower())
+		DATA_DIR = os.path.join(standardDataParentDir, APP_TITLE.lower())
+		CACHE_DIR = os.path.join(standardCacheParentDir, APP_TITLE.lower())
+
+	DEFAULT_PAKDIR = "pkg"
+
+	SHADER_CACHE_FILE = os.path.join(CACHE_DIR, "shader_cache.sqlite")
+	THUMBNAIL_CACHE_FILE = os.path.join(CACHE_DIR, "thumbnails.bin")
+	SESSION_FILE = os.path.join(DATA_DIR, "session.dat")
+
+	@staticmethod
+	def makeDirs():
+		"Creates the settings and cache directories, moving the files of older versions there first."
+		os.makedirs(os.path.dirname(Static.SETTINGS_DIR), exist_ok=True)
+		os.makedirs(os.path.dirname(Static.CACHE_DIR), exist_ok=True)
+
+		if Static.old_settings_dir:
+			# What if it fails?
+			if os.path.isdir(Static.old_settings_dir) and not os.path.exists(Static.SETTINGS_DIR):
+				for file_name in [ "shader_cache.dat" ]:
+					old_file_path = os.path.join(Static.old_settings_dir, file_name)
+					new_file_path = os.path.join(Static.CACHE_DIR, file_name)
+					if os.path.exists(old_file_path) and not os.path.exists(new_file_path):
+						os.makedirs(Static.CACHE_DIR, exist_ok=True)
+						shutil.move(old_file_path, new_file_path)
+				for file_name in [ "session.dat" ]:
+					old_file_path = os.path.join(Static.old_settings_dir, file_name)
+					new_file_path = os.path.join(Static.DATA_DIR, file_name)
+					if os.path.exists(old_file_path) and not os.path.exists(new_file_path):
+						os.makedirs(Static.DATA_DIR, exist_ok=True)
+						shutil.move(old_file_path, new_file_path)
+				shutil.move(Static.old_settings_dir, Static.SETTINGS_DIR)
+
+		# Exceptions uncatched on purpose.
+		os.makedirs(Static.SETTINGS_DIR, exist_ok=True)
+		os.makedirs(Static.CACHE_DIR, exist_ok=True)
+
+
+class ShaderCacheVersionError(ValueError):
+	"Raised when reading a shader cache written with another schema version, nothing is discarded by reading."
+
+	def __init__(self, path, version, expected):
+		ValueError.__init__(self, "shader cache " + path + " has version " + str(version) + ", expected " + str(expected))
+		self.version = version
+
+
+class ShaderCache():
+	"""Persistent shader database made of an SQLite index and a thumbnail blob file.
+	The index holds the shader sources, their scan records without previews and the
+	position of every thumbnail inside the blob file, which is memory mapped for reading.
+	Thumbnails and the shaders parsed from scripts are addressed by the content of their
+	file, so identical textures and scripts of different paks, mods and releases are
+	decoded and parsed once."""
+
+	# bump when the schema or the scan results change, stored as the user_version of the index
+	VERSION = 4
+
+	# thumbnails are appended by the loading thread and the GUI thread, each with its own ShaderCache,
+	# and the blob file is replaced when compacted, so reads and writes of all instances take turns
+	blob_lock = threading.RLock()
+	blob_generation = 0 # bumped when the blob file is replaced, memory maps of older ones are stale
+
+	# the blob file is compacted once thumbnails no key points to take that many bytes and that much of it
+	COMPACT_MIN_DEAD_SIZE = 4 * 1024 * 1024
+	COMPACT_DEAD_FRACTION = 0.25
+
+	# keys looked up per query, SQLite limits the number of parameters
+	KEY_QUERY_SIZE = 500
+
+	def __init__(self, index_path, blob_path, read_only = False):
+		self.index_path = index_path
+		self.blob_path = blob_path
+		self.read_only = read_only # worker processes only read, the GUI process writes
+
+		self.connection = None
+		self.blob = None # read only memory map of the blob file
+		self.blob_generation = 0 # ShaderCache.blob_generation when the blob file was mapped
+
+	@staticmethod
+	def getKey(crc, size):
+		"Builds the key of a file from its CRC-32 and size, as found in a ZipInfo."
+		return "%08x-%x" % (crc, size)
+
+	@staticmethod
+	def getContentKey(content):
+		"Builds the key of a loose file from its content, it matches the key of the same file inside a pk3."
+		return ShaderCache.getKey(zlib.crc32(content), len(content))
+
+	def open(self):
+		"""Connects to the index, creating it if necessary. An index written with another schema
+		version is rejected when reading and reset when writing, never silently misread."""
+		if self.connection != None:
+			return
+
+		if self.read_only:
+			# only worker processes need it and it takes longer to import than this module
+			import urllib.request
+
+			self.connection = sqlite3.connect("file:" + urllib.request.pathname2url(self.index_path) + "?mode=ro", uri = True)
+		else:
+			os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+			self.connection = sqlite3.connect(self.index_path)
+			# lets worker processes read while new thumbnails are written
+			self.connection.execute("PRAGMA journal_mode = WAL")
+
+		version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+		if version == self.VERSION:
+			return
+
+		if self.read_only:
+			self.close()
+
+			# created but never written
+			if version == 0:
+				raise FileNotFoundError(self.index_path)
+
+			raise ShaderCacheVersionError(self.index_path, version, self.VERSION)
+
+		if version != 0:
+			print("Discarding shader cache " + self.index_path + " with version " + str(version) + ", expected " + str(self.VERSION), file = sys.stderr)
+
+		self.__createSchema()
+
+	def close(self):
+		if self.blob != None:
+			self.blob.close()
+			self.blob = None
+
+		if self.connection != None:
+			self.connection.close()
+			self.connection = None
+
+	def __createSchema(self):
+		with self.connection:
+			# another connection may be creating the schema at the same time, the first one to get
+			# the write lock does it and the others find it done
+			self.connection.execute("BEGIN IMMEDIATE")
+
+			if self.connection.execute("PRAGMA user_version").fetchone()[0] == self.VERSION:
+				return
+
+			for table in ("meta", "sources", "records", "thumbnails", "scripts", "script_shaders"):
+				self.connection.execute("DROP TABLE IF EXISTS " + table)
+
+			self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+			self.connection.execute("CREATE TABLE IF NOT EXISTS sources (position INTEGER, path TEXT PRIMARY KEY, signature TEXT)")
+			self.connection.execute(
+				"CREATE TABLE IF NOT EXISTS records (source TEXT, seq INTEGER, is_shader INTEGER, name TEXT, path TEXT, key TEXT,"
+				" preview_source TEXT, preview_width INTEGER, width INTEGER, height INTEGER, text TEXT,"
+				" PRIMARY KEY (source, seq))"
+			)
+			self.connection.execute(
+				"CREATE TABLE IF NOT EXISTS thumbnails (key TEXT PRIMARY KEY, offset INTEGER, length INTEGER,"
+				" preview_width INTEGER, width INTEGER, height INTEGER, descriptor BLOB)"
+			)
+			# scripts without shaders are cached as well, so they get their own table
+			self.connection.execute("CREATE TABLE IF NOT EXISTS scripts (key TEXT PRIMARY KEY)")
+			self.connection.execute(
+				"CREATE TABLE IF NOT EXISTS script_shaders (key TEXT, seq INTEGER, name TEXT, preview_source TEXT, text TEXT,"
+				" PRIMARY KEY (key, seq))"
+			)
+			self.connection.execute("PRAGMA user_version = " + str(self.VERSION))
+
+			# emptied before the schema is committed, so that nobody appends to it before
+			with ShaderCache.blob_lock, open(self.blob_path, "wb"):
+				pass
+
+	def __getBlob(self, end):
+		"Returns a memory map of the blob file that covers at least end bytes."
+		if self.blob == None or len(self.blob) < end or self.blob_generation != ShaderCache.blob_generation:
+			if self.blob != None:
+				self.blob.close()
+				self.blob = None
+
+			with open(self.blob_path, "rb") as f:
+				self.blob = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+			self.blob_generation = ShaderCache.blob_generation
+
+		return self.blob
+
+	def getThumbnail(self, key):
+		"Returns (preview, preview width, width, height) or None if key is unknown."
+		try:
+			# the offset has to match the blob file, which may be being compacted
+			with ShaderCache.blob_lock:
+				self.open()
+
+				row = self.connection.execute(
+					"SELECT offset, length, preview_width, width, height FROM thumbnails WHERE key = ?", (key,)
+				).fetchone()
+
+				if row == None:
+					return None
+
+				(offset, length, preview_width, width, height) = row
+
+				preview = self.__getBlob(offset + length)[offset:offset + length]
+		except (sqlite3.Error, OSError, ValueError) as e:
+			print("Failed to read thumbnail " + key + ": " + str(e), file = sys.stderr)
+			return None
+
+		if len(preview) != length:
+			return None
+
+		return (preview, preview_width, width, height)
+
+	def putThumbnails(self, thumbnails):
+		"""Appends key -> (preview, preview width, width, height, descriptor) to the blob file and the index.
+		Thumbnails stored already are not appended again, only a descriptor they lack is added."""
+		self.open()
+
+		rows = list()
+		descriptors = list()
+
+		with ShaderCache.blob_lock:
+			stored_keys = self.__getStoredKeys(thumbnails.keys())
+
+			with open(self.blob_path, "ab") as f:
+				# other instances may append to the same file, the lock is released when it is closed
+				if fcntl != None:
+					fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+				# the position of a file opened for appending is only known once it is written to
+				offset = os.fstat(f.fileno()).st_size
+
+				for (key, (preview, preview_width, width, height, descriptor)) in thumbnails.items():
+					if key in stored_keys:
+						if descriptor != None:
+							descriptors.append((descriptor, key))
+						continue
+
+					rows.append((key, offset, len(preview), preview_width, width, height, descriptor))
+					f.write(preview)
+					offset += len(preview)
+
+			# the index only points to thumbnails once they are on disk
+			with self.connection:
+				self.connection.executemany("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+				self.connection.executemany("UPDATE thumbnails SET descriptor = ? WHERE key = ? AND descriptor IS NULL", descriptors)
+
+	def __getStoredKeys(self, keys):
+		"Returns the keys among keys that have a thumbnail in the index."
+		keys = list(keys)
+		stored_keys = set()
+
+		for start in range(0, len(keys), self.KEY_QUERY_SIZE):
+			chunk = keys[start:start + self.KEY_QUERY_SIZE]
+			stored_keys.update(key for (key,) in self.connection.execute(
+				"SELECT key FROM thumbnails WHERE key IN (" + ", ".join("?" * len(chunk)) + ")", chunk
+			))
+
+		return stored_keys
+
+	def compact(self):
+		"""Rewrites the blob file without the thumbnails no key points to anymore, once they take much of it,
+		and returns whether it did. Instances of this process map the new file, other processes must not
+		read meanwhile, so it is called before sources are scanned."""
+		self.open()
+
+		with ShaderCache.blob_lock:
+			size = os.path.getsize(self.blob_path)
+			live_size = self.connection.execute("SELECT COALESCE(SUM(length), 0) FROM thumbnails").fetchone()[0]
+			dead_size = size - live_size
+
+			if dead_size < self.COMPACT_MIN_DEAD_SIZE or dead_size < size * self.COMPACT_DEAD_FRACTION:
+				return False
+
+			rows = self.connection.execute("SELECT key, offset, length FROM thumbnails ORDER BY offset").fetchall()
+
+			(handle, temp_path) = tempfile.mkstemp(prefix = ".chameleon-", suffix = ".bin", dir = os.path.dirname(self.blob_path))
+
+			try:
+				shutil.copymode(self.blob_path, temp_path)
+
+				offsets = list()
+				lost_keys = list()
+
+				with open(self.blob_path, "rb") as source, open(handle, "wb") as destination:
+					offset = 0
+
+					for (key, old_offset, length) in rows:
+						source.seek(old_offset)
+						preview = source.read(length)
+
+						# written by a process that died before it was done
+						if len(preview) != length:
+							lost_keys.append((key,))
+							continue
+
+						destination.write(preview)
+						offsets.append((offset, key))
+						offset += length
+
+				with self.connection:
+					self.connection.executemany("UPDATE thumbnails SET offset = ? WHERE key = ?", offsets)
+					self.connection.executemany("DELETE FROM thumbnails WHERE key = ?", lost_keys)
+
+					# replaced before the new offsets are committed, so that a failure keeps both as they were
+					if self.blob != None:
+						self.blob.close()
+						self.blob = None
+
+					os.replace(temp_path, self.blob_path)
+			except BaseException:
+				if os.path.exists(temp_path):
+					os.remove(temp_path)
+
+				raise
+
+			ShaderCache.blob_generation += 1
+
+		return True
+
+	def getDescriptors(self):
+		"Returns key -> image descriptor of all thumbnails that have one."
+		try:
+			self.open()
+
+			return dict(self.connection.execute("SELECT key, descriptor FROM thumbnails WHERE descriptor IS NOT NULL"))
+		except (sqlite3.Error, ValueError) as e:
+			print("Failed to read image descriptors: " + str(e), file = sys.stderr)
+			return dict()
+
+	def getScriptShaders(self, key):
+		"Returns the (name, preview source, text) of every shader of the script with the given key or None if key is unknown."
+		try:
+			self.open()
+
+			if self.connection.execute("SELECT 1 FROM scripts WHERE key = ?", (key,)).fetchone() == None:
+				return None
+
+			return self.connection.execute(
+				"SELECT name, preview_source, text FROM script_shaders WHERE key = ? ORDER BY seq", (key,)
+			).fetchall()
+		except (sqlite3.Error, ValueError) as e:
+			print("Failed to read shader script " + key + ": " + str(e), file = sys.stderr)
+			return None
+
+	def putScriptShaders(self, scripts):
+		"Adds key -> list of (name, preview source, text) to the index."
+		self.open()
+
+		with self.connection:
+			for (key, shaders) in scripts.items():
+				self.connection.execute("DELETE FROM script_shaders WHERE key = ?", (key,))
+				self.connection.execute("INSERT OR REPLACE INTO scripts VALUES (?)", (key,))
+				self.connection.executemany(
+					"INSERT INTO script_shaders VALUES (?, ?, ?, ?, ?)",
+					((key, seq) + tuple(shaders[seq]) for seq in range(len(shaders)))
+				)
+
+	def readState(self):
+		"""Returns (basepath, homepath, pakdir, shader sources, source -> (signature, records)).
+		Records come without previews and shader text, previews are read from the blob file when shown."""
+		if not os.path.isfile(self.index_path):
+			raise FileNotFoundError(self.index_path)
+
+		self.open()
+
+		meta = dict(self.connection.execute("SELECT name, value FROM meta"))
+
+		if "basepath" not in meta:
+			raise FileNotFoundError(self.index_path)
+
+		sources = list()
+		source_records = dict()
+		for (path, signature) in self.connection.execute("SELECT path, signature FROM sources ORDER BY position"):
+			sources.append(path)
+			if signature != None:
+				source_records[path] = (signature, list())
+
+		for (source, is_shader, name, path, key, preview_source, preview_width, width, height) in self.connection.execute(
+			"SELECT source, is_shader, name, path, key, preview_source, preview_width, width, height"
+			" FROM records ORDER BY source, seq"
+		):
+			if source not in source_records:
+				continue
+
+			if is_shader:
+				source_records[source][1].append(("shader", name, path, preview_source, None))
+			else:
+				source_records[source][1].append(("texture", name, path, key, None, preview_width, width, height))
+
+		return (meta["basepath"], meta["homepath"], meta["pakdir"], sources, source_records)
+
+	def writeState(self, basepath, homepath, pakdir, sources, source_records, dirty_sources):
+		"Writes the source list and replaces the records of the sources in dirty_sources."
+		self.open()
+
+		with self.connection:
+			self.connection.executemany(
+				"INSERT OR REPLACE INTO meta VALUES (?, ?)",
+				(("basepath", basepath), ("homepath", homepath), ("pakdir", pakdir))
+			)
+
+			self.connection.execute("DELETE FROM sources")
+			self.connection.executemany(
+				"INSERT INTO sources VALUES (?, ?, ?)",
+				(
+					(position, sources[position], source_records[sources[position]][0] if sources[position] in source_records else None)
+					for position in range(len(sources))
+				)
+			)
+
+			self.connection.execute("DELETE FROM records WHERE source NOT IN (SELECT path FROM sources)")
+
+			for source in dirty_sources:
+				self.connection.execute("DELETE FROM records WHERE source = ?", (source,))
+
+				if source not in source_records:
+					continue
+
+				rows = list()
+				for (seq, record) in enumerate(source_records[source][1]):
+					if record[0] == "texture":
+						(kind, name, path, key, preview, preview_width, width, height) = record
+						rows.append((source, seq, 0, name, path, key, None, preview_width, width, height, None))
+					else: # record[0] == "shader"
+						(kind, name, path, preview_source, text) = record
+						rows.append((source, seq, 1, name, path, None, preview_source, None, None, None, text))
+
+				self.connection.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+class ShaderIndex():
+	"""Names, sizes and sets of the shaders and textures found in the shader sources, as read from
+	the shader cache. Previews are kept as encoded bytes, nothing is decoded or drawn."""
+
+	def __init__(self, cache = None):
+		self.basepath = None
+		self.homepath = None
+		self.pakdir = None
+		self.shader_sources = list() # dirs/pk3s inside self.basepath/self.homepath
+		self.source_records = dict() # shader source -> (signature, records)
+		self.dirty_sources = set() # shader sources whose cached records are outdated
+		self.shaders = dict() # shader name -> property -> value
+		self.sets = dict() # set name -> sorted shader names, in set name order
+		self.sorted_shaders = list() # all shader names, sorted
+		self.lowered_shaders = list() # lower case names in the same order, for searching
+		self.trigrams = collections.defaultdict(list) # lower case trigram -> positions in self.sorted_shaders
+		self.cache = cache or ShaderCache(Static.SHADER_CACHE_FILE, Static.THUMBNAIL_CACHE_FILE)
+
+	def __contains__(self, shader):
+		return shader in self.shaders
+
+	def __len__(self):
+		return len(self.shaders)
+
+	def emtpy(self):
+		return len(self) == 0
+
+	def writeCache(self):
+		"Writes the source list and the records of rescanned sources to the cache."
+		self.cache.writeState(self.basepath, self.homepath, self.pakdir, self.shader_sources, self.source_records, self.dirty_sources)
+		self.dirty_sources.clear()
+
+	def readCache(self):
+		"""Reads the source list and the records of every source from the cache.
+		Sources without records are rescanned by the next reload."""
+		(self.basepath, self.homepath, self.pakdir, shader_sources, source_records) = self.cache.readState()
+
+		self.shader_sources = shader_sources
+		self.source_records = source_records
+		self.dirty_sources.clear()
+
+		self.mergeSourceRecords()
+
+	def replaceWith(self, index):
+		"Takes over the sources and the database of another index, one read by another thread for example."
+		self.basepath = index.basepath
+		self.homepath = index.homepath
+		self.pakdir = index.pakdir
+		self.shader_sources = index.shader_sources
+		self.source_records = index.source_records
+		self.dirty_sources = index.dirty_sources
+		self.shaders = index.shaders
+		self.sets = index.sets
+		self.sorted_shaders = index.sorted_shaders
+		self.lowered_shaders = index.lowered_shaders
+		self.trigrams = index.trigrams
+
+	def addScannedRecords(self, sources_records):
+		"""Adds the records of sources scanned while others are still being scanned, in the order they were
+		scanned. Only the set index is updated, searching finds them once all sources are merged."""
+		for records in sources_records:
+			self.__addRecords(records)
+
+		self.__updateSetIndex()
+
+	def getPath(self, shader):
+		if shader in self.shaders and not self.shaders[shader]["is_shader"]:
+			return self.shaders[shader]["path"]
+		else:
+			return ""
+
+	def getWidth(self, shader):
+		if shader in self.shaders:
+			if self.shaders[shader]["is_shader"]:
+				preview_source = self.shaders[shader]["preview_source"]
+				if preview_source in self.shaders \
+				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
+					return self.getWidth(preview_source)
+				else:
+					return 0
+			else:
+				return self.shaders[shader]["width"]
+		else:
+			return 0
+
+	def getHeight(self, shader):
+		if shader in self.shaders:
+			if self.shaders[shader]["is_shader"]:
+				preview_source = self.shaders[shader]["preview_source"]
+				if preview_source in self.shaders \
+				and not self.shaders[preview_source]["is_shader"]: # prevent recursion
+					return self.getHeight(preview_source)
+				else:
+					return 0
+			else:
+				return self.shaders[shader]["height"]
+		else:
+			return 0
+
+	def sizeKnown(self, shader):
+		return self.getWidth(shader) > 0 and self.getHeight(shader) > 0
+
+	def getResolution(self, shader):
+		return str(self.getWidth(shader)) + " x " + str(self.getHeight(shader))
+
+	def getBasepath(self):
+		return self.basepath
+
+	def getHomepath(self):
+		return self.homepath
+
+	def getPakdir(self):
+		return self.pakdir
+
+	def __updateNameIndex(self):
+		"Maps every trigram of the lower case shader names to the names containing it."
+		self.sorted_shaders = sorted(self.shaders.keys())
+		self.lowered_shaders = [shader.lower() for shader in self.sorted_shaders]
+		self.trigrams.clear()
+
+		for (position, name) in enumerate(self.lowered_shaders):
+			for trigram in {name[start:start + 3] for start in range(len(name) - 2)}:
+				self.trigrams[trigram].append(position)
+
+	def searchShaders(self, query):
+		"Returns the sorted names of all shaders containing query, ignoring case."
+		query = query.lower()
+
+		if len(query) < 3:
+			# too short to narrow down by trigrams
+			return [self.sorted_shaders[position] for position in range(len(self.lowered_shaders)) if query in self.lowered_shaders[position]]
+
+		postings = list()
+		for start in range(len(query) - 2):
+			trigram = query[start:start + 3]
+
+			if trigram not in self.trigrams:
+				return list()
+
+			postings.append(self.trigrams[trigram])
+
+		# intersect beginning with the rarest trigram
+		postings.sort(key = len)
+		candidates = set(postings[0]).intersection(*postings[1:])
+
+		# trigrams can appear in another order than in query
+		return [self.sorted_shaders[position] for position in sorted(candidates) if query in self.lowered_shaders[position]]
+
+	def getShaders(self):
+		return list(self.sorted_shaders)
+
+	def getSets(self):
+		# the index is built sorted
+		return list(self.sets.keys())
+
+	def getShadersForSet(self, setname):
+		if setname in self.sets:
+			return list(self.sets[setname])
+		else:
+			return list()
+
+	def mergeSourceRecords(self):
+		"Rebuilds the shader database from the records of every source, in source order."
+		self.shaders.clear()
+
+		# merge in source order so later sources still override earlier ones
+		for path in self.shader_sources:
+			if path in self.source_records:
+				self.__addRecords(self.source_records[path][1])
+
+		self.__updateSetIndex()
+		self.__updateNameIndex()
+
+	def __updateSetIndex(self):
+		"Groups the sorted shader names by set, called whenever self.shaders was rebuilt."
+		self.sets.clear()
+
+		for shader in sorted(self.shaders.keys()):
+			split = shader.split("/", 1)
+
+			if split[0] not in self.sets:
+				self.sets[split[0]] = list()
+
+			# a name without set isn't listed for its own set
+			if len(split) > 1:
+				self.sets[split[0]].append(shader)
+
+	def __addRecords(self, records):
+		for record in records:
+			if record[0] == "texture":
+				self.__addTexture(*record[1:])
+			else: # record[0] == "shader"
+				self.__addShader(*record[1:])
+
+	def __addTexture(self, name, path, key, preview, preview_width, width, height):
+		"Adds a single loose texture to the database, preview is None if it wasn't decoded yet."
+		self.shaders[name] = dict()
+		self.shaders[name]["is_shader"] = False
+		self.shaders[name]["path"] = path
+		self.shaders[name]["key"] = key
+		self.shaders[name]["preview"] = preview
+		self.shaders[name]["preview_source"] = None
+		if preview_width > 0 and width > 0:
+			self.shaders[name]["preview_scale"] = preview_width / width
+		else:
+			self.shaders[name]["preview_scale"] = 1.0
+		self.shaders[name]["width"] = width
+		self.shaders[name]["height"] = height
+
+	def __addShader(self, name, path, preview_source, text):
+		self.shaders[name] = dict()
+		self.shaders[name]["is_shader"] = True
+		self.shaders[name]["path"] = path
+		self.shaders[name]["key"] = None
+		self.shaders[name]["preview"] = None
+		self.shaders[name]["preview_source"] = preview_source
+		self.shaders[name]["preview_scale"] = None
+		self.shaders[name]["width"] = None
+		self.shaders[name]["height"] = None
+
+
+class MapEntity():
+	"An entity of a map, its brushes and patches refer to it by its position in the map."
+	__slots__ = ("offset", "classname")
+
+	def __init__(self, offset):
+		self.offset = offset # offset of its opening brace
+		self.classname = None
+
+
+class MapFaces():
+	"""Brush faces of one format stored by column in arrays. A face knows where its line starts
+	and which part of that line holds its shader and texture values, so these can be read and
+	rewritten in place without keeping the rest of the line."""
+	__slots__ = ("offsets", "starts", "ends", "shaders", "brushes")
+
+	def __init__(self):
+		self.offsets = array.array("q") # offset of the line
+		self.starts = array.array("I") # start of the shader and texture values in the line
+		self.ends = array.array("I") # end of the shader and texture values in the line
+		self.shaders = array.array("i") # shader id
+		self.brushes = array.array("i") # brush id
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def extend(self, offsets, starts, ends, shaders, brushes):
+		"Appends faces given as NumPy arrays of equal length."
+		for (column, values) in zip(MapFaces.__slots__, (offsets, starts, ends, shaders, brushes)):
+			getattr(self, column).frombytes(memoryview(values.astype(getattr(self, column).typecode, copy = False)).cast("B"))
+
+	def getColumn(self, column):
+		"Returns a column as a NumPy array, without copying it."
+		return numpy.frombuffer(getattr(self, column), dtype = getattr(self, column).typecode)
+
+
+class MapPatches():
+	"""Patches stored by column in arrays. A patch knows where its shader is written and the
+	offsets of the lines of its control point columns."""
+	__slots__ = ("offsets", "starts", "ends", "shaders", "entities", "formats", "first_columns", "column_offsets")
+
+	def __init__(self):
+		self.offsets = array.array("q") # offset of the shader line
+		self.starts = array.array("I") # start of the shader name in the line
+		self.ends = array.array("I") # end of the shader name in the line
+		self.shaders = array.array("i") # shader id
+		self.entities = array.array("i") # entity id
+		self.formats = array.array("b") # 2 for patchDef2, 3 for patchDef3
+		self.first_columns = array.array("q") # index of the first column in column_offsets
+		self.column_offsets = array.array("q") # offsets of the lines of all columns
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def getColumnOffsets(self, patch):
+		first = self.first_columns[patch]
+
+		if patch + 1 < len(self.first_columns):
+			last = self.first_columns[patch + 1]
+		else:
+			last = len(self.column_offsets)
+
+		return self.column_offsets[first:last]
+
+
+class MapModifiedError(ValueError):
+	"Raised when building a map whose file changed since it was parsed, the map has to be parsed again."
+
+	def __init__(self, path):
+		ValueError.__init__(self, "map was modified since it was opened: " + path)
+		self.path = path
+
+
+class Map():
+	# ( p1 ) ( p2 ) ( p3 ) shader hshift vshift rot hscale vscale [flags] in Quake 3 format or
+	# ( p1 ) ( p2 ) ( p3 ) shader [ ux uy uz ushift ] [ vx vy vz vshift ] rot hscale vscale [flags] in Valve 220 format
+	FACE_PATTERN = re.compile(
+		rb"\s*(?:\([^()]*\)\s*){3}(?P<shader>[^\s\[(\"]\S*)\s+"
+		rb"(?P<texture>\[(?P<u>[^\]]*)\]\s*\[(?P<v>[^\]]*)\]\s*\S+\s+\S+\s+\S+|\S+\s+\S+\s+\S+\s+\S+\s+\S+)"
+		rb"(?:\s+\S+){0,3}\s*$"
+	)
+
+	# ( p1 ) ( p2 ) ( p3 ) ( ( s ) ( t ) ) shader [flags] in brushDef or
+	# ( plane ) ( ( s ) ( t ) ) "shader" [flags] in brushDef3
+	PRIMITIVE_FACE_PATTERN = re.compile(
+		rb"\s*(?:\([^()]*\)\s*){1,3}(?P<matrix>\(\s*\((?P<s>[^()]*)\)\s*\((?P<t>[^()]*)\)\s*\))\s*"
+		rb"(?:\"(?P<quoted>[^\"]*)\"|(?P<shader>[^\s\"]+))"
+		rb"(?:\s+\S+){0,3}\s*$"
+	)
+
+	PATCH_SHADER_PATTERN = re.compile(rb"\s*(?:\"(?P<quoted>[^\"]*)\"|(?P<shader>[^\s\"]+))\s*$")
+	KEY_VALUE_PATTERN = re.compile(rb"\s*\"(?P<key>[^\"]*)\"\s+\"(?P<value>[^\"]*)\"")
+
+	# bytes of content parse splits in lines and tokens at once, and faces it adds at once
+	PARSE_CHUNK_SIZE = 1024 * 1024
+
+	# brushes use a single face format, brushDef and brushDef3 faces are stored together as primitive faces
+	BRUSH_FORMATS = ("legacy", "valve220", "brushDef", "brushDef3")
+	FACE_FORMATS = ("legacy", "valve220", "primitive")
+
+	# brackets and parentheses around texture values of Valve 220 and primitive faces
+	TEXTURE_DELIMITERS = str.maketrans("[]()", "    ")
+
+	def __init__(self, model):
+		self.model = model
+
+		self.path = None
+		self.signature = None # size and modification time of the map when it was parsed
+		self.shader_counter = dict() # shader -> count
+		self.index2shader = dict() # table row -> shader
+		self.shader2index = dict() # shader -> table row
+
+		self.shader_names = list() # shader id -> shader
+		self.shader_ids = dict() # shader -> shader id
+		self.entities = list() # entity id -> MapEntity
+		self.brush_entities = array.array("i") # brush id -> entity id
+		self.brush_formats = array.array("b") # brush id -> index in BRUSH_FORMATS
+		self.faces = {face_format: MapFaces() for face_format in Map.FACE_FORMATS}
+		self.patches = MapPatches()
+
+	def __contains__(self, shader):
+		return shader in self.shader_counter
+
+	def __len__(self):
+		return len(self.shader_counter)
+
+	def distinctShaders(self):
+		return len(self.shader_counter)
+
+	def appearance(self, shader):
+		if shader in self.shader_counter:
+			return self.shader_counter[shader]
+		else:
+			return 0
+
+	def shaderToIndex(self, shader):
+		if shader in self.shader2index:
+			return self.shader2index[shader]
+		else:
+			return None
+
+	def indexToShader(self, index):
+		if index in self.index2shader:
+			return self.index2shader[index]
+		else:
+			return None
+
+	def countEntities(self):
+		return len(self.entities)
+
+	def countBrushes(self, brush_format = None):
+		if brush_format == None:
+			return len(self.brush_formats)
+		else:
+			return self.brush_formats.count(Map.BRUSH_FORMATS.index(brush_format))
+
+	def countFaces(self):
+		return sum(len(faces) for faces in self.faces.values())
+
+	def countPatches(self):
+		return len(self.patches)
+
+	def parse(self, path):
+		"""Reads the entities, brushes, faces and patches of a map file into compact tables, the
+		content itself is not kept. Brushes in Quake 3, Valve 220, brushDef and brushDef3 format
+		and patchDef2 and patchDef3 patches are understood, anything else is left as it is."""
+		self.path = path
+		self.signature = self.__getSignature()
+		self.__clear()
+
+		with open(path, "rb") as f:
+			# an empty file can't be mapped
+			if os.fstat(f.fileno()).st_size > 0:
+				with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as content:
+					(structure_offsets, run_ends, faces) = self.__scanLines(content)
+					(blocks, primitive_faces) = self.__parseStructure(content, structure_offsets, run_ends)
+					self.__addBrushes(content, faces, blocks, primitive_faces)
+
+		self.__sortShaderIds()
+		self.__countShaders()
+		self.__generateShaderOrder()
+
+	def __scanLines(self, content):
+		"""Splits the content in lines and tokens with NumPy, chunk by chunk. Returns the offsets of the
+		lines not starting with a parenthesis, where the run of brushes in Quake 3 or Valve 220 format
+		opened on each of them ends and the columns of the lines starting with one, see __scanChunk."""
+		structure_offsets = list()
+		structure_kinds = list()
+		faces = tuple(list() for column in range(5))
+
+		position = 0
+		while position < len(content):
+			end = min(position + Map.PARSE_CHUNK_SIZE, len(content))
+
+			# chunks end with a line
+			if end < len(content):
+				end = content.rfind(b"\n", position, end) + 1 or content.find(b"\n", end) + 1 or len(content)
+
+			(chunk_structure_offsets, chunk_structure_kinds, chunk_faces) = self.__scanChunk(content[position:end])
+
+			structure_offsets.append(chunk_structure_offsets + position)
+			structure_kinds.append(chunk_structure_kinds)
+			for (column, values) in zip(faces, (chunk_faces[0] + position,) + chunk_faces[1:]):
+				column.append(values)
+
+			position = end
+
+		structure_kinds = numpy.concatenate(structure_kinds)
+
+		# a line opening a brush followed by one closing it is a brush with nothing but faces, the run of
+		# these brushes starting at a line ends at the first line of the same parity that doesn't open one
+		opens_brush = numpy.zeros(len(structure_kinds), dtype = bool)
+		opens_brush[:-1] = (structure_kinds[:-1] == 1) & (structure_kinds[1:] == 2)
+		run_ends = numpy.empty(len(structure_kinds), dtype = numpy.int64)
+
+		for parity in (0, 1):
+			ends = numpy.append(numpy.flatnonzero(~opens_brush[parity::2]), len(opens_brush[parity::2]))
+			run_ends[parity::2] = ends[numpy.searchsorted(ends, numpy.arange(len(opens_brush[parity::2])))] * 2 + parity
+
+		# the columns of faces are big, the chunks of each are freed once joined
+		for column in faces:
+			column[:] = [numpy.concatenate(column)]
+
+		return (numpy.concatenate(structure_offsets), run_ends, tuple(column.pop() for column in faces))
+
+	def __scanChunk(self, data):
+		"""Returns the offsets of the lines of a chunk not starting with a parenthesis, blank lines and comments
+		left out, and their kinds, 1 for an opening brace alone, 2 for a closing one and 0 for anything else.
+		Returns offsets, shader starts, texture ends, shader ids and format ids of the lines starting with one
+		too. These are faces in Quake 3 format with format id 0 or in Valve 220 format with format id 1 if
+		written as usual, with parentheses and brackets as tokens of their own, or lines FACE_PATTERN has to
+		tell with format id -2, their shader id is -1."""
+		chunk = numpy.frombuffer(data, dtype = numpy.uint8)
+
+		# space or \t, \n, \v, \f and \r, as for bytes.split() and \s in the patterns, uint8 wraps around
+		separators = (chunk == ord(" ")) | (chunk - ord("\t") <= ord("\r") - ord("\t"))
+
+		# tokens start and end where separators do
+		edges = numpy.flatnonzero(numpy.diff(separators, prepend = True, append = True))
+		(token_starts, token_ends) = (edges[0::2], edges[1::2])
+
+		line_starts = numpy.concatenate(([0], numpy.flatnonzero(chunk[:-1] == ord("\n")) + 1))
+		first_tokens = numpy.searchsorted(token_starts, line_starts)
+		token_counts = numpy.searchsorted(token_starts, numpy.append(line_starts[1:], len(chunk))) - first_tokens
+
+		is_blank = token_counts == 0
+		(line_starts, first_tokens, token_counts) = (line_starts[~is_blank], first_tokens[~is_blank], token_counts[~is_blank])
+
+		first_characters = chunk[token_starts[first_tokens]]
+		first_lengths = token_ends[first_tokens] - token_starts[first_tokens]
+		is_comment = (first_characters == ord("/")) & (first_lengths > 1) & (chunk[numpy.minimum(token_starts[first_tokens] + 1, len(chunk) - 1)] == ord("/"))
+		is_face = first_characters == ord("(")
+
+		is_structure = ~is_face & ~is_comment
+		is_brace = (token_counts == 1) & (first_lengths == 1)
+		structure_kinds = numpy.select((is_brace & (first_characters == ord("{")), is_brace & (first_characters == ord("}"))), (1, 2), 0).astype(numpy.int8)
+		(structure_starts, structure_kinds) = (line_starts[is_structure], structure_kinds[is_structure])
+
+		(line_starts, first_tokens, token_counts) = (line_starts[is_face], first_tokens[is_face], token_counts[is_face])
+
+		tokens = dict()
+
+		def getToken(number):
+			if number not in tokens:
+				token = numpy.minimum(first_tokens + number, len(token_starts) - 1)
+				tokens[number] = (token_starts[token], token_ends[token])
+
+			return tokens[number]
+
+		def isToken(number, character):
+			(starts, ends) = getToken(number)
+			return (ends - starts == 1) & (chunk[starts] == ord(character))
+
+		def countCharacters(positions, starts, ends):
+			return numpy.searchsorted(positions, ends) - numpy.searchsorted(positions, starts)
+
+		(shader_starts, shader_ends) = getToken(15)
+
+		# the parentheses of the points are the only ones before the shader, which doesn't start like texture values
+		is_usual = isToken(0, "(") & isToken(4, ")") & isToken(5, "(") & isToken(9, ")") & isToken(10, "(") & isToken(14, ")")
+		is_usual &= countCharacters(numpy.flatnonzero((chunk == ord("(")) | (chunk == ord(")"))), line_starts, shader_starts) == 6
+		is_usual &= (chunk[shader_starts] != ord("[")) & (chunk[shader_starts] != ord("(")) & (chunk[shader_starts] != ord("\""))
+
+		is_legacy = is_usual & (token_counts >= 21) & (token_counts <= 24) & (chunk[getToken(16)[0]] != ord("["))
+
+		# [ ux uy uz ushift ] [ vx vy vz vshift ] without other closing brackets
+		is_valve220 = is_usual & (token_counts >= 31) & (token_counts <= 34) & isToken(16, "[") & isToken(21, "]") & isToken(22, "[") & isToken(27, "]")
+		is_valve220 &= countCharacters(numpy.flatnonzero(chunk == ord("]")), getToken(16)[0], getToken(27)[1]) == 2
+
+		# shaders of lines that turn out not to be in a brush are forgotten by __sortShaderIds
+		is_known = is_legacy | is_valve220
+		shaders = numpy.full(len(line_starts), -1, dtype = numpy.int32)
+		shaders[is_known] = self.__getShaderIds(list(map(data.__getitem__, map(slice, shader_starts[is_known].tolist(), shader_ends[is_known].tolist()))))
+
+		return (structure_starts, structure_kinds, (
+			line_starts,
+			(shader_starts - line_starts).astype(numpy.uint32),
+			(numpy.where(is_valve220, getToken(30)[1], getToken(20)[1]) - line_starts).astype(numpy.uint32),
+			shaders,
+			numpy.select((is_legacy, is_valve220), (0, 1), -2).astype(numpy.int8)
+		))
+
+	def __parseStructure(self, content, structure_offsets, run_ends):
+		"""Reads the entities, patches and brushDef and brushDef3 faces from the lines not starting with a
+		parenthesis. Returns the blocks faces can be in, in file order, as arrays of brush formats, entities,
+		starts and ends, the brush format is -1 for a brush in Quake 3 or Valve 220 format, which doesn't
+		exist until it has a face. The faces of brushDef and brushDef3 brushes are returned with their block."""
+		blocks = (array.array("b"), array.array("i"), array.array("q"), array.array("q"))
+		primitive_faces = list()
+
+		state = "outside"
+		entity = -1
+
+		number = 0
+		while number < len(structure_offsets):
+			if state == "entity" and run_ends[number] > number:
+				run_end = int(run_ends[number])
+				count = (run_end - number) // 2
+
+				blocks[0].extend(itertools.repeat(-1, count))
+				blocks[1].extend(itertools.repeat(entity, count))
+				blocks[2].frombytes(structure_offsets[number:run_end:2].tobytes())
+				blocks[3].frombytes(structure_offsets[number + 1:run_end:2].tobytes())
+
+				number = run_end
+				continue
+
+			offset = int(structure_offsets[number])
+			position = content.find(b"\n", offset) + 1 or len(content)
+			line = content[offset:position]
+			stripped = line.strip()
+			number += 1
+
+			# the keyword of a brush or patch definition, faces are added afterwards
+			if state == "primitive":
+				if stripped == b"}":
+					blocks[3][-1] = offset
+					state = "entity"
+				elif stripped in (b"brushDef", b"brushDef3"):
+					blocks[3][-1] = offset
+					self.__addBlock(blocks, Map.BRUSH_FORMATS.index(stripped.decode()), entity, offset, offset)
+					position = self.__parseBrushDef(content, position, blocks, primitive_faces)
+					number = int(numpy.searchsorted(structure_offsets, position))
+					state = "primitive end"
+				elif stripped in (b"patchDef2", b"patchDef3"):
+					blocks[3][-1] = offset
+					position = self.__parsePatch(content, position, entity, int(stripped[-1:]))
+					number = int(numpy.searchsorted(structure_offsets, position))
+					state = "patch end"
+
+			elif state == "patch end":
+				if stripped == b"}":
+					state = "primitive end"
+
+			elif state == "primitive end":
+				if stripped == b"}":
+					state = "entity"
+
+			elif state == "entity":
+				if stripped == b"{":
+					self.__addBlock(blocks, -1, entity, offset, len(content))
+					state = "primitive"
+				elif stripped == b"}":
+					state = "outside"
+				else:
+					match = Map.KEY_VALUE_PATTERN.match(line)
+
+					if match and match.group("key") == b"classname":
+						self.entities[entity].classname = match.group("value").decode("latin-1")
+
+			elif state == "outside":
+				if stripped == b"{":
+					entity = len(self.entities)
+					self.entities.append(MapEntity(offset))
+					state = "entity"
+
+		return (blocks, primitive_faces)
+
+	def __addBlock(self, blocks, brush_format, entity, start, end):
+		for (column, value) in zip(blocks, (brush_format, entity, start, end)):
+			column.append(value)
+
+	def __readLines(self, content, position):
+		"Yields the offset, the line and the stripped line of the lines from position on."
+		while position < len(content):
+			offset = position
+			position = content.find(b"\n", offset) + 1 or len(content)
+			line = content[offset:position]
+
+			yield (offset, line, line.strip())
+
+	def __parseBrushDef(self, content, position, blocks, primitive_faces):
+		"Reads the faces of a brushDef or brushDef3 brush from after its keyword, returns the position after them."
+		state = "brushDef"
+
+		for (offset, line, stripped) in self.__readLines(content, position):
+			if not stripped or stripped.startswith(b"//"):
+				pass
+
+			elif state == "brushDef":
+				if stripped == b"{":
+					(blocks[2][-1], blocks[3][-1]) = (offset, len(content))
+					state = "brushDef faces"
+
+			elif stripped.startswith(b"("):
+				match = Map.PRIMITIVE_FACE_PATTERN.match(line)
+
+				if match and len(match.group("s").split()) == 3 and len(match.group("t").split()) == 3:
+					if match.group("quoted") != None:
+						(shader, end) = (match.group("quoted"), match.end("quoted") + 1)
+					else:
+						(shader, end) = (match.group("shader"), match.end("shader"))
+
+					primitive_faces.append((offset, match.start("matrix"), end, self.__getShaderId(shader), len(blocks[0]) - 1))
+
+			elif stripped == b"}":
+				blocks[3][-1] = offset
+				return offset + len(line)
+
+		return len(content)
+
+	def __parsePatch(self, content, position, entity, patch_format):
+		"Reads a patch from after its keyword, returns the position after its columns."
+		state = "patchDef"
+
+		for (offset, line, stripped) in self.__readLines(content, position):
+			if not stripped or stripped.startswith(b"//"):
+				pass
+
+			elif state == "patchDef":
+				if stripped == b"{":
+					state = "patch shader"
+
+			elif state == "patch shader":
+				match = Map.PATCH_SHADER_PATTERN.match(line)
+
+				if not match:
+					return offset + len(line)
+
+				group = "quoted" if match.group("quoted") != None else "shader"
+
+				self.patches.offsets.append(offset)
+				self.patches.starts.append(match.start(group))
+				self.patches.ends.append(match.end(group))
+				self.patches.shaders.append(self.__getShaderId(match.group(group)))
+				self.patches.entities.append(entity)
+				self.patches.formats.append(patch_format)
+				self.patches.first_columns.append(len(self.patches.column_offsets))
+
+				state = "patch header"
+
+			# ( width height [subdivisions] 0 0 0 ) comes before the opening parenthesis of the columns
+			elif state == "patch header":
+				if stripped == b"(":
+					state = "patch columns"
+
+			elif state == "patch columns":
+				if stripped.startswith(b"("):
+					self.patches.column_offsets.append(offset)
+				elif stripped == b")":
+					return offset + len(line)
+
+		return len(content)
+
+	def __addBrushes(self, content, faces, blocks, primitive_faces):
+		"""Adds the brushes of the blocks and the faces inside them, the first face of a brush in
+		Quake 3 or Valve 220 format sets its format. Faces not written as usual are matched here."""
+		(offsets, shader_starts, texture_ends, shaders, face_formats) = faces
+		block_formats = numpy.frombuffer(blocks[0], dtype = numpy.int8).copy()
+		block_ends = numpy.frombuffer(blocks[3], dtype = numpy.int64)
+
+		# the block a face is in, if it's in one of a brush in Quake 3 or Valve 220 format
+		face_blocks = (numpy.searchsorted(numpy.frombuffer(blocks[2], dtype = numpy.int64), offsets, side = "right") - 1).astype(numpy.int32)
+
+		if len(block_formats):
+			face_formats[(face_blocks < 0) | (offsets >= block_ends[face_blocks]) | (block_formats[face_blocks] != -1)] = -1
+		else:
+			face_formats[:] = -1
+
+		for face in numpy.flatnonzero(face_formats == -2).tolist():
+			offset = int(offsets[face])
+			match = Map.FACE_PATTERN.match(content[offset:content.find(b"\n", offset) + 1 or len(content)])
+
+			if not match:
+				face_format = -1
+			elif match.group("u") == None:
+				face_format = 0
+			elif len(match.group("u").split()) == 4 and len(match.group("v").split()) == 4:
+				face_format = 1
+			else:
+				face_format = -1
+
+			if face_format != -1:
+				(shader_starts[face], texture_ends[face]) = (match.start("shader"), match.end("texture"))
+				shaders[face] = self.__getShaderId(match.group("shader"))
+
+			face_formats[face] = face_format
+
+		# faces are in file order, legacy and valve220 come first in both BRUSH_FORMATS and FACE_FORMATS
+		(brush_faces, brush_face_formats) = (face_blocks[face_formats >= 0], face_formats[face_formats >= 0])
+		is_first = numpy.diff(brush_faces, prepend = -1) != 0
+		block_formats[brush_faces[is_first]] = brush_face_formats[is_first]
+
+		has_brush = block_formats >= 0
+		block_brushes = numpy.cumsum(has_brush, dtype = numpy.int32) - 1
+
+		self.brush_entities.frombytes(numpy.frombuffer(blocks[1], dtype = numpy.int32)[has_brush].tobytes())
+		self.brush_formats.frombytes(block_formats[has_brush].tobytes())
+
+		# a slice at a time, not to copy every column at once
+		for first in range(0, len(offsets), Map.PARSE_CHUNK_SIZE):
+			part = slice(first, first + Map.PARSE_CHUNK_SIZE)
+
+			for (face_format_id, face_format) in enumerate(("legacy", "valve220")):
+				selected = face_formats[part] == face_format_id
+				columns = (offsets[part], shader_starts[part], texture_ends[part], shaders[part], face_blocks[part])
+
+				self.faces[face_format].extend(*(column[selected] for column in columns[:4]), block_brushes[columns[4][selected]])
+
+		if primitive_faces:
+			(offsets, starts, ends, shaders, face_blocks) = (numpy.array(column) for column in zip(*primitive_faces))
+			self.faces["primitive"].extend(offsets, starts, ends, shaders, block_brushes[face_blocks])
+
+	def __clear(self):
+		self.shader_counter.clear()
+		self.shader_names.clear()
+		self.shader_ids.clear()
+		self.entities.clear()
+		self.brush_entities = array.array("i")
+		self.brush_formats = array.array("b")
+		self.faces = {face_format: MapFaces() for face_format in Map.FACE_FORMATS}
+		self.patches = MapPatches()
+
+	def __getShaderId(self, shader):
+		shader = shader.decode("latin-1")
+
+		if shader not in self.shader_ids:
+			self.shader_ids[shader] = len(self.shader_names)
+			self.shader_names.append(shader)
+
+		return self.shader_ids[shader]
+
+	def __getShaderIds(self, shaders):
+		"Returns the shader ids of a list of shaders as a NumPy array, looking each distinct shader up once."
+		distinct = collections.defaultdict()
+		distinct.default_factory = distinct.__len__
+		indices = numpy.fromiter(map(distinct.__getitem__, shaders), dtype = numpy.intp, count = len(shaders))
+
+		return numpy.array([self.__getShaderId(shader) for shader in distinct], dtype = numpy.int32)[indices]
+
+	def __sortShaderIds(self):
+		"""Numbers the shaders in the order they first appear in the map, as reading it line by line would,
+		and forgets those only found on lines that turned out not to be faces."""
+		first_offsets = numpy.full(len(self.shader_names), numpy.iinfo(numpy.int64).max, dtype = numpy.int64)
+
+		for table in list(self.faces.values()) + [self.patches]:
+			numpy.minimum.at(first_offsets, numpy.frombuffer(table.shaders, dtype = numpy.int32), numpy.frombuffer(table.offsets, dtype = numpy.int64))
+
+		order = numpy.argsort(first_offsets, kind = "stable")[:numpy.count_nonzero(first_offsets < numpy.iinfo(numpy.int64).max)]
+		new_ids = numpy.full(len(first_offsets), -1, dtype = numpy.int32)
+		new_ids[order] = numpy.arange(len(order), dtype = numpy.int32)
+
+		for table in list(self.faces.values()) + [self.patches]:
+			shaders = numpy.frombuffer(table.shaders, dtype = numpy.int32)
+			shaders[:] = new_ids[shaders]
+
+		self.shader_names[:] = [self.shader_names[shader_id] for shader_id in order.tolist()]
+		self.shader_ids.clear()
+		self.shader_ids.update((shader, shader_id) for (shader_id, shader) in enumerate(self.shader_names))
+
+	def __countShaders(self):
+		counts = numpy.zeros(len(self.shader_names), dtype = numpy.int64)
+
+		for faces in self.faces.values():
+			counts += numpy.bincount(faces.getColumn("shaders"), minlength = len(self.shader_names))
+
+		counts += numpy.bincount(numpy.frombuffer(self.patches.shaders, dtype = numpy.int32), minlength = len(self.shader_names))
+
+		self.shader_counter.update((shader, count) for (shader, count) in zip(self.shader_names, counts.tolist()) if count > 0)
+
+	def __getSignature(self):
+		stat = os.stat(self.path)
+		return (stat.st_size, stat.st_mtime_ns)
+
+	def __generateShaderOrder(self):
+		self.index2shader.clear()
+		self.shader2index.clear()
+
+		tmp = [(count, name) for (name, count) in self.shader_counter.items()]
+		tmp.sort(reverse = True)
+		position = 0
+		for (count, name) in tmp:
+			self.index2shader[position] = name
+			self.shader2index[name] = position
+			position += 1
+
+	# unused but might come in handy at a later moment
+#	def __faceRotation(self, p1_x, p1_y, p1_z, p2_x, p2_y, p2_z, p3_x, p3_y, p3_z, debug = False):
+#		"""Takes the vertices of a triangle describing a brush face in 3D space as an argument and
+#		calculates the rotation of the face around the texture projection axis."""
+#
+#		# V contains the vertices of the given triangle
+#		V = {
+#			0: {"x": p1_x, "y": p1_y, "z": p1_z},
+#			1: {"x": p2_x, "y": p2_y, "z": p2_z},
+#			2: {"x": p3_x, "y": p3_y, "z": p3_z}
+#		}
+#
+#		# r is the vertice at the right angle of V
+#		r = max(
+#				((p2_x - p3_x)**2 + (p2_y - p3_y)**2 + (p2_z - p3_z)**2, 0),
+#				((p1_x - p3_x)**2 + (p1_y - p3_y)**2 + (p1_z - p3_z)**2, 1),
+#				((p1_x - p2_x)**2 + (p1_y - p2_y)**2 + (p1_z - p2_z)**2, 2)
+#		)[1]
+#
+#		# u and v are vectors that span a plain orthogonal to V
+#		u = dict()
+#		v = dict()
+#		for axis in ("x", "y", "z"):
+#			u[axis] = V[r][axis] - V[(r - 1) % 3][axis]
+#			v[axis] = V[r][axis] - V[(r + 1) % 3][axis]
+#
+#		# n = u x v is the normal vector of the plain spanned by u and v
+#		n = dict()
+#		n["x"] = u["y"] * v["z"] - u["z"] * v["y"]
+#		n["y"] = u["z"] * v["x"] - u["x"] * v["z"]
+#		n["z"] = u["x"] * v["y"] - u["y"] * v["x"]
+#
+#		# the projection axis is the axis most "similar" to n
+#		projection_axis = max(
+#			(n["x"], "x"),
+#			(n["y"], "y"),
+#			(n["z"], "z")
+#		)[1]
+#
+#		if   projection_axis == "x":
+#			angle = math.atan2(u["y"], u["z"])
+#		elif projection_axis == "y":
+#			angle = math.atan2(u["x"], u["z"])
+#		else:
+#			angle = math.atan2(u["x"], u["y"])
+#
+#		if debug:
+#			print("Vertice 0: "+str(p1_x)+" "+str(p1_y)+" "+str(p1_z))
+#			print("Vertice 1: "+str(p2_x)+" "+str(p2_y)+" "+str(p2_z))
+#			print("Vertice 2: "+str(p3_x)+" "+str(p3_y)+" "+str(p3_z))
+#			print("Right angle vertice: "+str(r))
+#			print("Span vector u: "+str(u["x"])+" "+str(u["y"])+" "+str(u["z"]))
+#			print("Span vector v: "+str(v["x"])+" "+str(v["y"])+" "+str(v["z"]))
+#			print("Normal vector n: "+str(n["x"])+" "+str(n["y"])+" "+str(n["z"]))
+#			print("Projection axis: "+projection_axis)
+#			print("Angle: "+str(math.degrees(angle)))
+#
+#		return angle
+
+	def __readLine(self, source):
+		"Reads the next line and returns it without its line break, and the line break."
+		raw = source.readline()
+
+		# keep \r\n line breaks as they are
+		if raw.endswith(b"\r\n"):
+			end = len(raw) - 2
+		elif raw.endswith(b"\n"):
+			end = len(raw) - 1
+		else:
+			end = len(raw)
+
+		return (raw[:end].decode("latin-1"), raw[end:])
+
+	def __copy(self, source, destination, size):
+		"Copies size bytes from source to destination in bounded chunks."
+		while size > 0:
+			chunk = source.read(min(size, Static.MAP_BUFFER_SIZE))
+
+			if not chunk:
+				break
+
+			destination.write(chunk)
+			size -= len(chunk)
+
+	def build(self, rules, path):
+		"""Writes the map with rules applied to path and returns the numbers of replaced faces and
+		patches. Only the lines of replaced faces and patches are rewritten, everything in between
+		is copied from the opened map in chunks, so memory use does not grow with the map size."""
+		if self.__getSignature() != self.signature:
+			raise MapModifiedError(self.path)
+
+		face_rules = self.__getFaceRules(rules)
+		rule_ids = face_rules["rule_ids"]
+
+		# replaced faces of all formats in the order of the file
+		face_offsets = [numpy.array([], dtype = numpy.int64)]
+		face_formats = [numpy.array([], dtype = numpy.int8)]
+		face_rows = [numpy.array([], dtype = numpy.intp)]
+
+		for (face_format, faces) in self.faces.items():
+			rows = numpy.flatnonzero(rule_ids[faces.getColumn("shaders")] != -1)
+
+			face_offsets.append(faces.getColumn("offsets")[rows])
+			face_formats.append(numpy.full(len(rows), Map.FACE_FORMATS.index(face_format), dtype = numpy.int8))
+			face_rows.append(rows)
+
+		face_offsets = numpy.concatenate(face_offsets)
+		order = numpy.argsort(face_offsets)
+		face_offsets = face_offsets[order]
+		face_formats = numpy.concatenate(face_formats)[order]
+		face_rows = numpy.concatenate(face_rows)[order]
+
+		patches = [patch for (patch, shader) in enumerate(self.patches.shaders) if rule_ids[shader] != -1]
+
+		# replace the file a link points to and not the link
+		path = os.path.realpath(path)
+
+		# write next to the destination first, it may be the opened map
+		(handle, temp_path) = tempfile.mkstemp(prefix = ".chameleon-", suffix = Static.MAP_FILE_EXTENSION, dir = os.path.dirname(path))
+
+		try:
+			Map.__copyPermissions(path, temp_path)
+
+			with open(self.path, "rb") as source, open(handle, "wb", buffering = Static.MAP_BUFFER_SIZE) as destination:
+				position = 0
+				face_index = 0
+				patch_index = 0
+
+				while face_index < len(face_offsets) or patch_index < len(patches):
+					if patch_index < len(patches):
+						next_patch = self.patches.offsets[patches[patch_index]]
+					else:
+						next_patch = None
+
+					if face_index < len(face_offsets) \
+					and (next_patch == None or face_offsets[face_index] < next_patch):
+						# faces up to the next patch, within one buffer
+						start = int(face_offsets[face_index])
+						end = numpy.searchsorted(face_offsets, start + Static.MAP_BUFFER_SIZE)
+
+						if next_patch != None:
+							end = min(end, numpy.searchsorted(face_offsets, next_patch))
+
+						end = max(end, face_index + 1)
+
+						self.__copy(source, destination, start - position)
+						self.__buildFaces(source, destination, face_offsets[face_index:end], face_formats[face_index:end], face_rows[face_index:end], face_rules)
+						face_index = end
+					else:
+						self.__copy(source, destination, next_patch - position)
+						self.__buildPatch(source, destination, patches[patch_index], rules)
+						patch_index += 1
+
+					position = source.tell()
+
+				shutil.copyfileobj(source, destination, Static.MAP_BUFFER_SIZE)
+
+			os.replace(temp_path, path)
+		except BaseException:
+			os.remove(temp_path)
+			raise
+
+		return (len(face_offsets), len(patches))
+
+	@staticmethod
+	def __copyPermissions(path, temp_path):
+		"""Gives the file written by mkstemp, only readable by its owner, the mode and if possible the owner of
+		the file it replaces, or the mode a new file would get."""
+		if os.path.exists(path):
+			shutil.copymode(path, temp_path)
+
+			stat = os.stat(path)
+			if hasattr(os, "chown") and (stat.st_uid, stat.st_gid) != (os.getuid(), os.getgid()):
+				try:
+					os.chown(temp_path, stat.st_uid, stat.st_gid)
+				except PermissionError:
+					pass
+		else:
+			# the umask can only be read by setting it
+			umask = os.umask(0o022)
+			os.umask(umask)
+
+			os.chmod(temp_path, 0o666 & ~umask)
+
+	def __getFaceRules(self, rules):
+		"""Returns the rule of every shader id, -1 if it has none, and the new shader and values of
+		every rule as NumPy arrays indexed by rule."""
+		shaders = self.model.shaders
+
+		rule_ids = numpy.full(len(self.shader_names), -1, dtype = numpy.intp)
+		rule_news = list()
+		rule_values = list()
+		rule_sizes_known = list()
+
+		for (shader_id, old) in enumerate(self.shader_names):
+			if old not in rules:
+				continue
+
+			new = rules.getNewShader(old)
+			rule_hscale = rules.getHScale(old)
+			rule_vscale = rules.getVScale(old)
+			rule_rot = rules.getRotation(old)
+			rule_rot_rad = math.radians(rule_rot)
+
+			sizes_known = old in shaders and new in shaders \
+			          and shaders.sizeKnown(old) and shaders.sizeKnown(new)
+
+			if sizes_known:
+				sizes = (shaders.getWidth(old), shaders.getHeight(old), shaders.getWidth(new), shaders.getHeight(new))
+				(auto_hscale, auto_vscale) = Rules.getScales(*sizes, rule_rot)
+			else:
+				sizes = (1, 1, 1, 1)
+				(auto_hscale, auto_vscale) = (1.0, 1.0)
+
+			# texture matrices are relative to the texture size already, only the part of the
+			# rule scale that differs from the scale fitting the new texture applies to them
+			matrix_hscale = rule_hscale / auto_hscale if auto_hscale != 0 else rule_hscale
+			matrix_vscale = rule_vscale / auto_vscale if auto_vscale != 0 else rule_vscale
+
+			# texture axes and matrices keep exact values when turned by right angles
+			if rule_rot % 90.0 == 0.0:
+				(rule_cos, rule_sin) = ((1.0, 0.0), (0.0, 1.0), (-1.0, 0.0), (0.0, -1.0))[int(rule_rot // 90.0) % 4]
+			else:
+				(rule_cos, rule_sin) = (math.cos(rule_rot_rad), math.sin(rule_rot_rad))
+
+			rule_ids[shader_id] = len(rule_news)
+			rule_news.append(new)
+			rule_values.append((
+				rule_hscale, rule_vscale, rule_rot,
+				math.cos(rule_rot_rad)**2, math.sin(rule_rot_rad)**2,
+				rule_cos, rule_sin,
+				matrix_hscale, matrix_vscale
+			) + sizes)
+			rule_sizes_known.append(sizes_known)
+
+		rule_values = numpy.array(rule_values, dtype = numpy.float64).reshape(-1, 13).T
+
+		face_rules = dict(zip((
+			"hscale", "vscale", "rot", "cos2", "sin2", "cos", "sin", "matrix_hscale", "matrix_vscale",
+			"old_width", "old_height", "new_width", "new_height"
+		), rule_values))
+
+		face_rules["sizes_known"] = numpy.array(rule_sizes_known, dtype = bool)
+		face_rules["rule_ids"] = rule_ids
+		face_rules["news"] = rule_news
+
+		return face_rules
+
+	def __buildFaces(self, source, destination, offsets, face_formats, rows, face_rules):
+		"""Rewrites the brush faces at offsets, the first one is the next line of source. The lines
+		in between are read at once with them and the faces of every format transformed together."""
+		start = int(offsets[0])
+		content = (source.read(int(offsets[-1]) - start) + source.readline()).decode("latin-1")
+
+		edit_starts = offsets - start
+		edit_ends = offsets - start
+		new_texts = numpy.empty(len(offsets), dtype = object)
+
+		for (format_index, (face_format, faces)) in enumerate(self.faces.items()):
+			selected = numpy.flatnonzero(face_formats == format_index)
+
+			if len(selected) == 0:
+				continue
+
+			format_rows = rows[selected]
+
+			edit_starts[selected] += faces.getColumn("starts")[format_rows]
+			edit_ends[selected] += faces.getColumn("ends")[format_rows]
+
+			texts = [content[edit_start:edit_end] for (edit_start, edit_end) in zip(edit_starts[selected].tolist(), edit_ends[selected].tolist())]
+
+			build = {
+				"legacy": self.__buildLegacyFaces,
+				"valve220": self.__buildValveFaces,
+				"primitive": self.__buildPrimitiveFaces,
+			}[face_format]
+
+			new_texts[selected] = build(texts, faces.getColumn("shaders")[format_rows], face_rules)
+
+		parts = list()
+		position = 0
+		for (edit_start, edit_end, new_text) in zip(edit_starts.tolist(), edit_ends.tolist(), new_texts.tolist()):
+			parts.append(content[position:edit_start])
+			parts.append(new_text)
+			position = edit_end
+		parts.append(content[position:])
+
+		destination.write("".join(parts).encode("latin-1"))
+
+	def __getRules(self, shaders, face_rules):
+		"Returns the rule indices of faces with the given shader ids and their rule values."
+		indices = face_rules["rule_ids"][shaders]
+
+		return (indices, {name: values[indices] for (name, values) in face_rules.items() if name not in ("rule_ids", "news")})
+
+	def __transformTexture(self, hshift, vshift, rot, hscale, vscale, rule):
+		"Returns the new shift, rotation and scale of texture values given as NumPy arrays."
+		# same operations in the same order as a face at a time, so results are identical,
+		# a zero scale fails instead of writing inf
+		with numpy.errstate(divide = "raise", invalid = "raise"):
+			new_rot = numpy.remainder(rot + rule["rot"], 360.0)
+
+			new_hscale = (rule["cos2"] * hscale + rule["sin2"] * vscale) * rule["hscale"]
+			new_vscale = (rule["cos2"] * vscale + rule["sin2"] * hscale) * rule["vscale"]
+
+			new_hshift = numpy.empty(len(hshift))
+			new_vshift = numpy.empty(len(vshift))
+
+			known = rule["sizes_known"]
+			unknown = ~rule["sizes_known"]
+
+			old_hshift_ratio = hshift[known] / rule["old_width"][known]
+			old_vshift_ratio = vshift[known] / rule["old_height"][known]
+
+			# int() has no negative zero, + 0.0 turns the -0.0 of trunc into 0.0 as well
+			old_hshift_ratio -= numpy.trunc(old_hshift_ratio) + 0.0
+			old_vshift_ratio -= numpy.trunc(old_vshift_ratio) + 0.0
+
+			new_hshift_ratio = rule["cos2"][known] * old_hshift_ratio + rule["sin2"][known] * old_vshift_ratio
+			new_vshift_ratio = rule["cos2"][known] * old_vshift_ratio + rule["sin2"][known] * old_hshift_ratio
+
+			new_hshift_ratio -= numpy.trunc(new_hshift_ratio) + 0.0
+			new_vshift_ratio -= numpy.trunc(new_vshift_ratio) + 0.0
+
+			new_hshift[known] = new_hshift_ratio * rule["new_width"][known]
+			new_vshift[known] = new_vshift_ratio * rule["new_height"][known]
+
+			new_hshift[unknown] = hshift[unknown] / rule["hscale"][unknown]
+			new_vshift[unknown] = vshift[unknown] / rule["vscale"][unknown]
+
+		return (new_hshift, new_vshift, new_rot, new_hscale, new_vscale)
+
+	def __buildLegacyFaces(self, texts, shaders, face_rules):
+		"Returns the new shader and texture values of Quake 3 faces given their old ones."
+		(indices, rule) = self.__getRules(shaders, face_rules)
+		(hshift, vshift, rot, hscale, vscale) = \
+			numpy.array([text.split()[1:6] for text in texts], dtype = numpy.float64).reshape(-1, 5).T
+
+		new_values = self.__transformTexture(hshift, vshift, rot, hscale, vscale, rule)
+
+		# tolist() gives Python floats, so they are formatted as before
+		return [
+			"%s %r %r %r %r %r" % ((face_rules["news"][index],) + values)
+			for (index, values) in zip(indices.tolist(), zip(*[values.tolist() for values in new_values]))
+		]
+
+	def __buildValveFaces(self, texts, shaders, face_rules):
+		"""Returns the new shader and texture values of Valve 220 faces given their old ones, the
+		texture axes are rotated as the rule says."""
+		(indices, rule) = self.__getRules(shaders, face_rules)
+		values = numpy.array([text.translate(Map.TEXTURE_DELIMITERS).split()[1:12] for text in texts], dtype = numpy.float64).reshape(-1, 11)
+
+		(u_axis, u_shift, v_axis, v_shift) = (values[:, 0:3], values[:, 3], values[:, 4:7], values[:, 7])
+		(rot, hscale, vscale) = values[:, 8:11].T
+
+		(new_u_shift, new_v_shift, new_rot, new_hscale, new_vscale) = \
+			self.__transformTexture(u_shift, v_shift, rot, hscale, vscale, rule)
+
+		cos = rule["cos"][:, numpy.newaxis]
+		sin = rule["sin"][:, numpy.newaxis]
+
+		new_u_axis = cos * u_axis + sin * v_axis
+		new_v_axis = cos * v_axis - sin * u_axis
+
+		return [
+			"%s [ %r %r %r %r ] [ %r %r %r %r ] %r %r %r" % ((face_rules["news"][index],) + tuple(u_axis) + (u_shift,) + tuple(v_axis) + (v_shift,) + tuple(texture))
+			for (index, u_axis, u_shift, v_axis, v_shift, *texture) in zip(
+				indices.tolist(), new_u_axis.tolist(), new_u_shift.tolist(), new_v_axis.tolist(),
+				new_v_shift.tolist(), new_rot.tolist(), new_hscale.tolist(), new_vscale.tolist()
+			)
+		]
+
+	def __buildPrimitiveFaces(self, texts, shaders, face_rules):
+		"Returns the new texture matrix and shader of brushDef and brushDef3 faces given their old ones."
+		(indices, rule) = self.__getRules(shaders, face_rules)
+		values = numpy.array([text.translate(Map.TEXTURE_DELIMITERS).split()[0:6] for text in texts], dtype = numpy.float64).reshape(-1, 6)
+
+		(s_row, t_row) = (values[:, 0:3], values[:, 3:6])
+
+		cos = rule["cos"][:, numpy.newaxis]
+		sin = rule["sin"][:, numpy.newaxis]
+
+		# rotate and scale in texture space, a larger scale shrinks texture coordinates
+		with numpy.errstate(divide = "raise", invalid = "raise"):
+			new_s_row = (cos * s_row + sin * t_row) / rule["matrix_hscale"][:, numpy.newaxis]
+			new_t_row = (cos * t_row - sin * s_row) / rule["matrix_vscale"][:, numpy.newaxis]
+
+		return [
+			"( ( %r %r %r ) ( %r %r %r ) ) %s" % (tuple(s_row) + tuple(t_row) + (Map.__quote(face_rules["news"][index], text.endswith('"')),))
+			for (index, s_row, t_row, text) in zip(indices.tolist(), new_s_row.tolist(), new_t_row.tolist(), texts)
+		]
+
+	@staticmethod
+	def __quote(shader, quoted):
+		if quoted:
+			return '"' + shader + '"'
+		else:
+			return shader
+
+	def __buildPatch(self, source, destination, patch, rules):
+		"Rewrites the patch whose shader line is the next line of source."
+		(line, line_break) = self.__readLine(source)
+
+		patch_old = self.shader_names[self.patches.shaders[patch]]
+		patch_new = rules.getNewShader(patch_old)
+		patch_rule_rot_rad = math.radians(rules.getRotation(patch_old))
+
+		line = line[:self.patches.starts[patch]] + patch_new + line[self.patches.ends[patch]:]
+		destination.write(line.encode("latin-1") + line_break)
+
+		for column_offset in self.patches.getColumnOffsets(patch):
+			self.__copy(source, destination, column_offset - source.tell())
+			(line, line_break) = self.__readLine(source)
+
+			patch_column = line.split()[1:-1]
+			new_line = line[:len(line) - len(line.lstrip())] + "( "
+
+			# patch row
+			while len(patch_column) > 0:
+				patch_column.pop(0) # "("
+				old_x = patch_column.pop(0)
+				old_y = patch_column.pop(0)
+				old_z = patch_column.pop(0)
+				old_hshift = float(patch_column.pop(0))
+				old_vshift = float(patch_column.pop(0))
+				patch_column.pop(0) # ")"
+
+				# TODO: scale + shift patch?
+
+				new_hshift = math.cos(patch_rule_rot_rad)**2 * old_hshift \
+				           + math.sin(patch_rule_rot_rad)**2 * old_vshift
+				new_vshift = math.cos(patch_rule_rot_rad)**2 * old_vshift \
+				           + math.sin(patch_rule_rot_rad)**2 * old_hshift
+
+				new_line += "( " \
+				         +        old_x \
+				         +  " " + old_y \
+				         +  " " + old_z \
+				         +  " " + str(new_hshift) \
+				         +  " " + str(new_vshift) \
+				         +  " ) "
+
+			new_line += ")"
+
+			destination.write(new_line.encode("latin-1") + line_break)
+
+
+class Rules():
+	def __init__(self, model):
+		self.model = model
+
+		self.rules = dict() # old shader -> (new shader, hscale, vscale, rot)
+
+	def __contains__(self, rule):
+		return rule in self.rules
+
+	def __len__(self):
+		return len(self.rules)
+
+	def empty(self):
+		return len(self) == 0
+
+	def readFile(self, path):
+		with open(path, "r") as f:
+			content = f.read()
+
+		self.clear()
+
+		for line in content.splitlines():
+			line = line.strip()
+
+			if line.startswith("#") or line.startswith("//"):
+				continue
+
+			words = line.split()
+
+			if len(words) != 5:
+				continue
+
+			(old, new, hscale, vscale, rot) = words
+
+			try:
+				hscale = float(hscale)
+				vscale = float(vscale)
+				rot = float(rot)
+			except ValueError:
+				continue
+
+			self.__setRule(old, new, hscale, vscale, rot)
+
+	def writeFile(self, path):
+		out = "# This is a rules file for " + Static.APP_TITLE + ".\n" \
+		    + "# <old shader> <new shader> <horizontal scale> <vertical scale> <rotation>\n"
+
+		for (old, (new, hscale, vscale, rot)) in self.rules.items():
+			out += old + " " + new + " " + str(hscale) + " " + str(vscale) + " " + str(rot) + "\n"
+
+		with open(path, "w") as f:
+			f.write(out)
+
+	def addRule(self, old, new):
+		self.__setRule(old, new, None, None, None)
+		self.setRotation(old)
+
+	def __setRule(self, old, new, hscale, vscale, rot):
+		self.rules[old] = [new, hscale, vscale, rot]
+
+	def delRule(self, shader):
+		if shader in self.rules:
+			self.rules.pop(shader)
+
+	def clear(self):
+		self.rules.clear()
+
+	def getNewShader(self, shader):
+		if shader in self.rules:
+			return self.rules[shader][0]
+		else:
+			return None
+
+	def getHScale(self, shader):
+		if shader in self.rules:
+			return self.rules[shader][1]
+		else:
+			return None
+
+	def getVScale(self, shader):
+		if shader in self.rules:
+			return self.rules[shader][2]
+		else:
+			return None
+
+	def getRotation(self, shader):
+		if shader in self.rules:
+			return self.rules[shader][3]
+		else:
+			return None
+
+	def setHScale(self, shader, value):
+		if shader in self.rules:
+			self.rules[shader][1] = value
+
+	def setVScale(self, shader, value):
+		if shader in self.rules:
+			self.rules[shader][2] = value
+
+	@staticmethod
+	def guessRotation(old_width, old_height, new_width, new_height):
+		"""Rotates by 90 degrees if exactly one of both textures is portrait. Works on numbers and
+		elementwise on NumPy arrays."""
+		return numpy.where(
+			(old_width > old_height) & (new_width < new_height) | (old_width < old_height) & (new_width > new_height),
+			90.0, 0.0
+		)
+
+	@staticmethod
+	def getScales(old_width, old_height, new_width, new_height, rot):
+		"Returns the scales that make the new texture cover the old one when rotated by rot degrees."
+		rot_rad = math.radians(rot)
+
+		hscale = math.fabs(
+			(old_width * math.cos(rot_rad) + old_height * math.sin(rot_rad)) / new_width
+		)
+
+		vscale = math.fabs(
+			(old_height * math.cos(rot_rad) + old_width * math.sin(rot_rad)) / new_height
+		)
+
+		return (hscale, vscale)
+
+	def setRotation(self, shader, value = None):
+		if shader in self.rules:
+			new_shader = self.getNewShader(shader)
+			both_shaders_known = shader in self.model.shaders and new_shader in self.model.shaders
+
+			if both_shaders_known:
+				old_width = self.model.shaders.getWidth(shader)
+				old_height = self.model.shaders.getHeight(shader)
+
+				new_width = self.model.shaders.getWidth(new_shader)
+				new_height = self.model.shaders.getHeight(new_shader)
+
+				both_shaders_known = \
+					old_width != 0 and old_height != 0 and new_width != 0 and new_height != 0
+
+			if value == None:
+				if both_shaders_known:
+					rot = float(Rules.guessRotation(old_width, old_height, new_width, new_height))
+				else:
+					rot = 0.0
+			else:
+				rot = value % 360.0
+
+			if both_shaders_known:
+				(hscale, vscale) = Rules.getScales(old_width, old_height, new_width, new_height, rot)
+			else:
+				hscale = 1.0
+				vscale = 1.0
+
+			self.rules[shader][1] = hscale
+			self.rules[shader][2] = vscale
+			self.rules[shader][3] = rot
+
+
+class Model():
+	"Shader index, rules and map, Map and Rules look up texture sizes through it."
+
+	def __init__(self, shaders):
+		self.shaders = shaders
+		self.rules = Rules(self)
+		self.map = Map(self)
+
+
+class Batch():
+	"""Applies a rules file to many maps without a GUI. Every worker process reads the rules and
+	the shader cache once, then parses and builds the maps it is given."""
+
+	model = None # model of the worker process
+
+	@staticmethod
+	def findMaps(paths):
+		"Returns (map, path relative to the output directory) of the given maps and of the maps below given directories."
+		maps = list()
+
+		for path in paths:
+			if os.path.isdir(path):
+				for (dir_path, dir_names, file_names) in os.walk(path):
+					dir_names.sort()
+
+					for file_name in sorted(file_names):
+						if file_name.endswith(Static.MAP_FILE_EXTENSION):
+							map_path = os.path.join(dir_path, file_name)
+							maps.append((map_path, os.path.relpath(map_path, path)))
+			else:
+				maps.append((path, os.path.basename(path)))
+
+		return maps
+
+	@staticmethod
+	def initWorker(rules_path, cache_paths):
+		Batch.model = Model(ShaderIndex(ShaderCache(*cache_paths, read_only = True)))
+
+		try:
+			Batch.model.shaders.readCache()
+		except FileNotFoundError:
+			pass
+		except (sqlite3.Error, ValueError) as e:
+			print("Failed to read cache file " + cache_paths[0] + ": " + str(e), file = sys.stderr)
+
+		Batch.model.rules.readFile(rules_path)
+
+	@staticmethod
+	def buildMap(source, destination):
+		"Returns the numbers of replaced faces and patches."
+		Batch.model.map.parse(source)
+		return Batch.model.map.build(Batch.model.rules, destination)
+
+	@staticmethod
+	def run(rules_path, paths, output_dir = None, cache_paths = None, processes = Static.BATCH_PROCESSES):
+		"""Builds the given maps and the maps below given directories, to output_dir or in place,
+		and prints what was replaced in every map. Returns the number of maps that failed."""
+		cache_paths = cache_paths or (Static.SHADER_CACHE_FILE, Static.THUMBNAIL_CACHE_FILE)
+
+		if not os.path.isfile(cache_paths[0]):
+			print("No shader cache at " + cache_paths[0] + ", texture sizes are unknown.", file = sys.stderr)
+
+		jobs = list()
+		for (source, relative_path) in Batch.findMaps(paths):
+			if output_dir != None:
+				destination = os.path.join(output_dir, relative_path)
+				os.makedirs(os.path.dirname(destination), exist_ok=True)
+			else:
+				destination = source
+
+			jobs.append((source, destination))
+
+		failures = 0
+
+		def report(source, build):
+			nonlocal failures
+
+			try:
+				(replaced_faces, replaced_patches) = build()
+			except BaseException as e:
+				print("Failed to build map " + source + ": " + str(e), file = sys.stderr)
+				failures += 1
+			else:
+				print(source + ": Replaced " + str(replaced_faces) + " faces and " + str(replaced_patches) + " patches.")
+
+		if processes <= 1:
+			Batch.initWorker(rules_path, cache_paths)
+
+			for (source, destination) in jobs:
+				report(source, lambda: Batch.buildMap(source, destination))
+		else:
+			context = multiprocessing.get_context("spawn")
+
+			with concurrent.futures.ProcessPoolExecutor(processes, context, Batch.initWorker, (rules_path, cache_paths)) as executor:
+				future2source = {executor.submit(Batch.buildMap, source, destination): source for (source, destination) in jobs}
+
+				for future in concurrent.futures.as_completed(future2source):
+					report(future2source[future], future.result)
+
+		return failures
+
+	@staticmethod
+	def addArguments(parser):
+		"Adds the options of the batch mode to an argparse parser."
+		parser.add_argument("--batch", metavar = "RULES", help = "apply the rules file to the given maps without a GUI")
+		parser.add_argument("--output-dir", help = "directory to write the maps to, maps are rewritten in place otherwise")
+		parser.add_argument("--cache-dir", default = Static.CACHE_DIR, help = "directory of the shader cache, to read texture sizes from")
+		parser.add_argument("--processes", type = int, default = Static.BATCH_PROCESSES, help = "maps built at once")
+		parser.add_argument("maps", nargs = "*", metavar = "MAP", help = "maps, or directories to look for maps in")
+
+	@staticmethod
+	def main():
+		"Runs the batch mode with the command line arguments, returns the exit status."
+		parser = argparse.ArgumentParser(description = "Replaces the shaders of maps as a rules file says, without a GUI.")
+		Batch.addArguments(parser)
+		args = parser.parse_args()
+
+		if not args.batch:
+			parser.error("--batch is required")
+
+		cache_paths = (
+			os.path.join(args.cache_dir, os.path.basename(Static.SHADER_CACHE_FILE)),
+			os.path.join(args.cache_dir, os.path.basename(Static.THUMBNAIL_CACHE_FILE))
+		)
+
+		failures = Batch.run(args.batch, args.maps, args.output_dir, cache_paths, args.processes)
+		return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+	multiprocessing.freeze_support()
+
+	sys.exit(Batch.main())
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# Needs Python >= 3.3, NumPy
+
+
+"""Compares the brush faces and patches written by Map.build with the per-face code that transformed
+them one at a time before faces were transformed in NumPy batches, the output has to be identical.
+Faces in Valve 220, brushDef and brushDef3 format are compared with the same code written a face at a time.
+
+	python3 -m unittest discover tests"""
+
+
+import math
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chameleon_core import Model, ShaderIndex, Static
+
+
+# old shader -> new shader, rule rotation or None to guess it, hscale and vscale or None to keep the ones of the rotation
+RULES = {
+	"old/known": ("new/known", None, None, None),
+	"old/wide": ("new/tall", None, None, None),
+	"old/rotated": ("new/known", 33.3, None, None),
+	"old/scaled": ("new/wide", 270, 0.3, 2.5),
+	"old/unknown": ("new/unknown", 90, 2, 0.5),
+	"old/half_known": ("new/known", 180, None, None),
+	"old/to_unknown": ("new/unknown", None, 0.5, 4),
+}
+
+# texture -> width, height, textures missing here have an unknown size
+SIZES = {
+	"old/known": (128, 128),
+	"old/wide": (256, 64),
+	"old/rotated": (64, 128),
+	"old/scaled": (512, 256),
+	"old/half_known": (0, 0),
+	"old/to_unknown": (64, 64),
+	"new/known": (256, 256),
+	"new/tall": (64, 256),
+	"new/wide": (1024, 128),
+}
+
+SHIFTS = ("0", "-0", "16", "-8", "3.25", "-127.5", "1e-05", "4096", "-0.0", "12.000001")
+SCALES = ("0.5", "-0.5", "1", "0.25", "-1.75", "2", "0.125")
+ROTATIONS = ("0", "-0", "90", "180", "-90", "45.5", "359.9", "720")
+AXES = ("0", "-0", "1", "-1", "0.5", "-0.707107", "0.333333")
+MATRIX = ("0", "-0", "1", "-1", "0.0078125", "-0.00390625", "0.5", "3.25", "1e-05")
+
+BRUSH_FORMATS = ("legacy", "valve220", "brushDef", "brushDef3")
+
+
+def transformTexture(old, old_hshift, old_vshift, old_rot, old_hscale, old_vscale, rules, shaders):
+	"The new shift, rotation and scale of the texture of a face, as they were computed a face at a time."
+	new = rules.getNewShader(old)
+	rule_hscale = rules.getHScale(old)
+	rule_vscale = rules.getVScale(old)
+	rule_rot = rules.getRotation(old)
+	rule_rot_rad = math.radians(rule_rot)
+
+	new_rot = (old_rot + rule_rot) % 360.0
+
+	new_hscale = (math.cos(rule_rot_rad)**2 * old_hscale  \
+	           +  math.sin(rule_rot_rad)**2 * old_vscale) \
+	           *  rule_hscale
+
+	new_vscale = (math.cos(rule_rot_rad)**2 * old_vscale  \
+	           +  math.sin(rule_rot_rad)**2 * old_hscale) \
+	           *  rule_vscale
+
+	if old in shaders and new in shaders and shaders.sizeKnown(old) and shaders.sizeKnown(new):
+		old_hshift_ratio = old_hshift / shaders.getWidth(old)
+		old_vshift_ratio = old_vshift / shaders.getHeight(old)
+
+		old_hshift_ratio -= int(old_hshift_ratio)
+		old_vshift_ratio -= int(old_vshift_ratio)
+
+		new_hshift_ratio = math.cos(rule_rot_rad)**2 * old_hshift_ratio \
+		                 + math.sin(rule_rot_rad)**2 * old_vshift_ratio
+		new_vshift_ratio = math.cos(rule_rot_rad)**2 * old_vshift_ratio \
+		                 + math.sin(rule_rot_rad)**2 * old_hshift_ratio
+
+		new_hshift_ratio -= int(new_hshift_ratio)
+		new_vshift_ratio -= int(new_vshift_ratio)
+
+		new_hshift = new_hshift_ratio * shaders.getWidth(new)
+		new_vshift = new_vshift_ratio * shaders.getHeight(new)
+	else:
+		new_hshift = old_hshift / rule_hscale
+		new_vshift = old_vshift / rule_vscale
+
+	return (new_hshift, new_vshift, new_rot, new_hscale, new_vscale)
+
+
+def getRotation(rules, old):
+	"The cosine and sine of the rule rotation, exact for right angles."
+	rule_rot = rules.getRotation(old)
+
+	if rule_rot % 90.0 == 0.0:
+		return ((1.0, 0.0), (0.0, 1.0), (-1.0, 0.0), (0.0, -1.0))[int(rule_rot // 90.0) % 4]
+	else:
+		return (math.cos(math.radians(rule_rot)), math.sin(math.radians(rule_rot)))
+
+
+def buildFace(words, rules, shaders):
+	"The new line of a brush face given as its 24 words, as it was built a face at a time."
+	old = words[15]
+	values = transformTexture(old, *(float(word) for word in words[16:21]), rules, shaders)
+
+	return " ".join(words[0:15]) \
+	     + " " + rules.getNewShader(old) \
+	     + " " + " ".join(str(value) for value in values) \
+	     + " " + " ".join(words[21:24])
+
+
+def buildValveFace(words, rules, shaders):
+	"""The new line of a brush face in Valve 220 format given as its 34 words, the texture axes
+	are turned by the rule rotation."""
+	old = words[15]
+	(u_axis, u_shift) = ([float(word) for word in words[17:20]], float(words[20]))
+	(v_axis, v_shift) = ([float(word) for word in words[23:26]], float(words[26]))
+
+	(new_u_shift, new_v_shift, new_rot, new_hscale, new_vscale) = \
+		transformTexture(old, u_shift, v_shift, *(float(word) for word in words[28:31]), rules, shaders)
+
+	(cos, sin) = getRotation(rules, old)
+
+	new_u_axis = [cos * u + sin * v for (u, v) in zip(u_axis, v_axis)]
+	new_v_axis = [cos * v - sin * u for (u, v) in zip(u_axis, v_axis)]
+
+	return " ".join(words[0:15]) \
+	     + " " + rules.getNewShader(old) \
+	     + " [ " + " ".join(repr(value) for value in new_u_axis + [new_u_shift]) + " ]" \
+	     + " [ " + " ".join(repr(value) for value in new_v_axis + [new_v_shift]) + " ]" \
+	     + " " + " ".join(repr(value) for value in (new_rot, new_hscale, new_vscale)) \
+	     + " " + " ".join(words[31:34])
+
+
+def buildPrimitiveFace(words, rules, shaders):
+	"""The new line of a brushDef or brushDef3 face given as its words. The rows of the texture matrix
+	are turned by the rule rotation and divided by the part of the rule scale that differs from the
+	scale fitting the new texture, the matrix is relative to the texture size already."""
+	# ( ( s ) ( t ) ) follows the points or the plane
+	matrix = next(index for index in range(len(words) - 1) if words[index] == words[index + 1] == "(")
+
+	old = words[matrix + 12].strip('"')
+	new = rules.getNewShader(old)
+	s_row = [float(word) for word in words[matrix + 2:matrix + 5]]
+	t_row = [float(word) for word in words[matrix + 7:matrix + 10]]
+
+	(matrix_hscale, matrix_vscale) = (rules.getHScale(old), rules.getVScale(old))
+
+	if old in shaders and new in shaders and shaders.sizeKnown(old) and shaders.sizeKnown(new):
+		rule_rot_rad = math.radians(rules.getRotation(old))
+		(old_width, old_height) = (shaders.getWidth(old), shaders.getHeight(old))
+
+		fitting_hscale = math.fabs((old_width * math.cos(rule_rot_rad) + old_height * math.sin(rule_rot_rad)) / shaders.getWidth(new))
+		fitting_vscale = math.fabs((old_height * math.cos(rule_rot_rad) + old_width * math.sin(rule_rot_rad)) / shaders.getHeight(new))
+
+		matrix_hscale = matrix_hscale / fitting_hscale if fitting_hscale != 0 else matrix_hscale
+		matrix_vscale = matrix_vscale / fitting_vscale if fitting_vscale != 0 else matrix_vscale
+
+	(cos, sin) = getRotation(rules, old)
+
+	new_s_row = [(cos * s + sin * t) / matrix_hscale for (s, t) in zip(s_row, t_row)]
+	new_t_row = [(cos * t - sin * s) / matrix_vscale for (s, t) in zip(s_row, t_row)]
+
+	return " ".join(words[0:matrix]) \
+	     + " ( ( " + " ".join(repr(value) for value in new_s_row) + " )" \
+	     + " ( " + " ".join(repr(value) for value in new_t_row) + " ) )" \
+	     + " " + (new if words[matrix + 12] == old else '"' + new + '"') \
+	     + " " + " ".join(words[matrix + 13:])
+
+
+def buildPatchColumn(line, rule_rot_rad):
+	"The new line of a patch column, as it was built a point at a time."
+	patch_column = line.split()[1:-1]
+	new_line = line[:len(line) - len(line.lstrip())] + "( "
+
+	while len(patch_column) > 0:
+		patch_column.pop(0) # "("
+		old_x = patch_column.pop(0)
+		old_y = patch_column.pop(0)
+		old_z = patch_column.pop(0)
+		old_hshift = float(patch_column.pop(0))
+		old_vshift = float(patch_column.pop(0))
+		patch_column.pop(0) # ")"
+
+		new_hshift = math.cos(rule_rot_rad)**2 * old_hshift \
+		           + math.sin(rule_rot_rad)**2 * old_vshift
+		new_vshift = math.cos(rule_rot_rad)**2 * old_vshift \
+		           + math.sin(rule_rot_rad)**2 * old_hshift
+
+		new_line += "( " + old_x + " " + old_y + " " + old_z + " " + str(new_hshift) + " " + str(new_vshift) + " ) "
+
+	return new_line + ")"
+
+
+def buildReference(lines, rules, shaders):
+	"Applies rules to the lines of a map written by generateMap a line at a time."
+	out = list()
+	patch_rule_rot_rad = None
+	primitive = False # in the faces of a brushDef or brushDef3 brush
+
+	for line in lines:
+		words = line.split()
+
+		if primitive and words[0] == "(" and words[-4].strip('"') in rules:
+			out.append(buildPrimitiveFace(words, rules, shaders))
+		elif len(words) == 24 and words[0] == "(" and words[15] in rules:
+			out.append(buildFace(words, rules, shaders))
+		elif len(words) == 34 and words[0] == "(" and words[15] in rules:
+			out.append(buildValveFace(words, rules, shaders))
+		elif len(words) == 1 and words[0].strip('"') in rules and out[-1] == "{" and out[-2] in ("patchDef2", "patchDef3"):
+			out.append(words[0].replace(words[0].strip('"'), rules.getNewShader(words[0].strip('"'))))
+			patch_rule_rot_rad = math.radians(rules.getRotation(words[0].strip('"')))
+		elif patch_rule_rot_rad != None and line.startswith("( (") and line.endswith(") )"):
+			out.append(buildPatchColumn(line, patch_rule_rot_rad))
+		else:
+			if line == "}":
+				patch_rule_rot_rad = None
+				primitive = False
+			elif line in ("brushDef", "brushDef3"):
+				primitive = True
+
+			out.append(line)
+
+	return out
+
+
+def generateFace(rng, shader, brush_format, face):
+	"Returns the line of a brush face of the given format."
+	texture = (
+		rng.choice(SHIFTS + (str(rng.uniform(-4096, 4096)),)), rng.choice(SHIFTS),
+		rng.choice(ROTATIONS), rng.choice(SCALES), rng.choice(SCALES + (str(rng.uniform(-2, 2)),))
+	)
+
+	if brush_format == "legacy":
+		return "( 0 0 %d ) ( 1 0 %d ) ( 0 1 %d ) %s %s %s %s %s %s 0 0 0" % ((face, face, face, shader) + texture)
+	elif brush_format == "valve220":
+		axes = tuple(rng.choice(AXES) for axis in range(6))
+		return "( 0 0 %d ) ( 1 0 %d ) ( 0 1 %d ) %s [ %s %s %s %s ] [ %s %s %s %s ] %s %s %s 0 0 0" % (
+			(face, face, face, shader) + axes[0:3] + texture[0:1] + axes[3:6] + texture[1:5]
+		)
+
+	matrix = "( ( %s %s %s ) ( %s %s %s ) )" % tuple(rng.choice(MATRIX) for value in range(6))
+
+	if brush_format == "brushDef":
+		return "( 0 0 %d ) ( 1 0 %d ) ( 0 1 %d ) %s %s 0 0 0" % (face, face, face, matrix, shader)
+	else: # brush_format == "brushDef3"
+		return "( 0 0 1 %d ) %s \"%s\" 0 0 0" % (-face, matrix, shader)
+
+
+def generateMap(rng, brushes, patches, brush_formats = ("legacy",), patch_formats = (2,)):
+	"""Returns the lines of a map with brushes and patches of the old and of other shaders, mixed,
+	each brush and patch of one of the given formats."""
+	shaders = sorted(RULES) + ["common/caulk", "other/kept"]
+
+	lines = ["// entity 0", "{", "\"classname\" \"worldspawn\""]
+
+	kinds = ["brush"] * brushes + ["patch"] * patches
+	rng.shuffle(kinds)
+
+	for brush in range(len(kinds)):
+		lines.append("// brush " + str(brush))
+		lines.append("{")
+
+		if kinds[brush] == "patch":
+			patch_format = rng.choice(patch_formats)
+
+			lines.append("patchDef" + str(patch_format))
+			lines.append("{")
+
+			# patchDef3 comes from Doom 3 maps, which quote shaders
+			if patch_format == 3:
+				lines.append("\"" + rng.choice(shaders) + "\"")
+				lines.append("( 3 3 1 1 0 0 0 )")
+			else:
+				lines.append(rng.choice(shaders))
+				lines.append("( 3 3 0 0 0 )")
+
+			lines.append("(")
+
+			for column in range(3):
+				points = [
+					"( %d %d 0 %s %s )" % (column * 64, row * 64, rng.choice(SHIFTS), rng.choice(SHIFTS))
+					for row in range(3)
+				]
+				lines.append("( " + " ".join(points) + " )")
+
+			lines.append(")")
+			lines.append("}")
+		else:
+			brush_format = rng.choice(brush_formats)
+
+			if brush_format in ("brushDef", "brushDef3"):
+				lines.append(brush_format)
+				lines.append("{")
+
+			for face in range(6):
+				lines.append(generateFace(rng, rng.choice(shaders), brush_format, face))
+
+			if brush_format in ("brushDef", "brushDef3"):
+				lines.append("}")
+
+		lines.append("}")
+
+	lines.append("}")
+
+	return lines
+
+
+class MapBuildTest(unittest.TestCase):
+	def setUp(self):
+		shaders = ShaderIndex()
+		shaders.shader_sources = ["test"]
+		shaders.source_records = {"test": (None, [
+			("texture", name, "textures/" + name + ".tga", name, None, 0, width, height)
+			for (name, (width, height)) in SIZES.items()
+		])}
+		shaders.mergeSourceRecords()
+
+		self.model = Model(shaders)
+
+		for (old, (new, rot, hscale, vscale)) in RULES.items():
+			self.model.rules.addRule(old, new)
+			self.model.rules.setRotation(old, rot)
+
+			if hscale != None:
+				self.model.rules.setHScale(old, hscale)
+				self.model.rules.setVScale(old, vscale)
+
+		self.directory = tempfile.TemporaryDirectory()
+
+		# several chunks of faces per build
+		self.buffer_size = Static.MAP_BUFFER_SIZE
+		Static.MAP_BUFFER_SIZE = 4096
+
+	def tearDown(self):
+		Static.MAP_BUFFER_SIZE = self.buffer_size
+
+		self.directory.cleanup()
+
+	def __build(self, lines):
+		"Returns the lines Map.build writes for the map made of lines."
+		path = os.path.join(self.directory.name, "test.map")
+		built_path = os.path.join(self.directory.name, "built.map")
+
+		with open(path, "w") as f:
+			f.write("\n".join(lines) + "\n")
+
+		self.model.map.parse(path)
+		self.model.map.build(self.model.rules, built_path)
+
+		with open(built_path) as f:
+			return f.read().splitlines()
+
+	def test_random_map(self):
+		rng = random.Random(19)
+
+		lines = generateMap(rng, 2000, 200)
+		reference = buildReference(lines, self.model.rules, self.model.shaders)
+
+		self.assertNotEqual(reference, lines)
+		self.assertEqual(self.__build(lines), reference)
+
+	def test_faces_only(self):
+		lines = generateMap(random.Random(20), 500, 0)
+		reference = buildReference(lines, self.model.rules, self.model.shaders)
+
+		self.assertNotEqual(reference, lines)
+		self.assertEqual(self.__build(lines), reference)
+
+	def test_patches_only(self):
+		lines = generateMap(random.Random(21), 0, 100)
+		reference = buildReference(lines, self.model.rules, self.model.shaders)
+
+		self.assertNotEqual(reference, lines)
+		self.assertEqual(self.__build(lines), reference)
+
+	def __testFormat(self, seed, brush_formats, patch_formats = (2,), brushes = 500, patches = 0):
+		lines = generateMap(random.Random(seed), brushes, patches, brush_formats, patch_formats)
+		reference = buildReference(lines, self.model.rules, self.model.shaders)
+
+		self.assertNotEqual(reference, lines)
+		self.assertEqual(self.__build(lines), reference)
+
+		for brush_format in brush_formats:
+			self.assertGreater(self.model.map.countBrushes(brush_format), 0, brush_format)
+
+	def test_valve220_faces(self):
+		self.__testFormat(22, ("valve220",))
+
+	def test_brushDef_faces(self):
+		self.__testFormat(23, ("brushDef",))
+
+	def test_brushDef3_faces(self):
+		self.__testFormat(24, ("brushDef3",))
+
+	def test_patchDef3_patches(self):
+		self.__testFormat(25, (), (3,), 0, 100)
+
+	def test_mixed_formats(self):
+		self.__testFormat(26, BRUSH_FORMATS, (2, 3), 2000, 200)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Needs Python >= 3.3, NumPy
+
+
+"""Checks that the thumbnail blob file of the shader cache doesn't grow with thumbnails stored again
+and that compacting it keeps every thumbnail readable, by instances that mapped the old file too.
+
+	python3 -m unittest discover tests"""
+
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chameleon_core import ShaderCache
+
+
+def makeThumbnails(first, count, descriptor = None):
+	"Returns key -> thumbnail of count thumbnails of different sizes."
+	return {
+		"key%d" % number: (bytes([number % 256]) * (1000 + number), 128, 256, 256, descriptor)
+		for number in range(first, first + count)
+	}
+
+
+class ShaderCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.paths = (os.path.join(self.directory.name, "shader_cache.sqlite"), os.path.join(self.directory.name, "thumbnails.bin"))
+		self.cache = ShaderCache(*self.paths)
+
+		self.compact_min_dead_size = ShaderCache.COMPACT_MIN_DEAD_SIZE
+		ShaderCache.COMPACT_MIN_DEAD_SIZE = 1024
+
+	def tearDown(self):
+		ShaderCache.COMPACT_MIN_DEAD_SIZE = self.compact_min_dead_size
+
+		self.cache.close()
+		self.directory.cleanup()
+
+	def __assertThumbnails(self, cache, thumbnails):
+		for (key, thumbnail) in thumbnails.items():
+			self.assertEqual(cache.getThumbnail(key), thumbnail[:4], key)
+
+	def test_stored_again(self):
+		thumbnails = makeThumbnails(0, 100)
+		self.cache.putThumbnails(thumbnails)
+		size = os.path.getsize(self.paths[1])
+
+		# scanned again, with descriptors computed meanwhile
+		self.cache.putThumbnails(makeThumbnails(0, 100, b"descriptor"))
+
+		self.assertEqual(os.path.getsize(self.paths[1]), size)
+		self.assertEqual(len(self.cache.getDescriptors()), 100)
+		self.__assertThumbnails(self.cache, thumbnails)
+
+	def test_compact(self):
+		thumbnails = makeThumbnails(0, 300)
+		self.cache.putThumbnails(thumbnails)
+
+		reader = ShaderCache(*self.paths, read_only = True)
+		self.__assertThumbnails(reader, thumbnails)
+
+		# thumbnails of a cache written by older versions, which stored them again
+		with self.cache.connection:
+			self.cache.connection.execute("DELETE FROM thumbnails WHERE key IN (SELECT key FROM thumbnails ORDER BY offset LIMIT 200)")
+
+		for number in range(200):
+			del thumbnails["key%d" % number]
+
+		self.assertTrue(self.cache.compact())
+		self.assertEqual(os.path.getsize(self.paths[1]), sum(len(thumbnail[0]) for thumbnail in thumbnails.values()))
+		self.assertFalse(self.cache.compact())
+
+		self.__assertThumbnails(self.cache, thumbnails)
+		self.__assertThumbnails(reader, thumbnails)
+
+		reader.close()
+
+	def test_compact_too_little(self):
+		self.cache.putThumbnails(makeThumbnails(0, 10))
+
+		with self.cache.connection:
+			self.cache.connection.execute("DELETE FROM thumbnails WHERE key = 'key9'")
+
+		self.assertFalse(self.cache.compact())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Needs Python >= 3.3, PyQt5, NumPy
+
+
+"""Runs chameleon.py --startup-benchmark on a shader cache of many textures without a display server,
+the window has to show up and the cache has to be read within the limits below. Skipped without PyQt5.
+
+	python3 -m unittest discover tests"""
+
+
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from chameleon_core import ShaderCache, ShaderIndex
+
+
+CHAMELEON = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "chameleon.py")
+
+# seconds from the start of chameleon.py, several times what they take on a desktop computer
+WINDOW_TIME_LIMIT = 3.0
+CACHE_TIME_LIMIT = 6.0
+
+SOURCES = 20
+TEXTURES_PER_SOURCE = 2000
+
+
+@unittest.skipIf(importlib.util.find_spec("PyQt5") == None, "PyQt5 is not installed")
+class StartupTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+
+		self.environment = dict(os.environ)
+		self.environment["QT_QPA_PLATFORM"] = "offscreen"
+		self.environment["HOME"] = self.directory.name
+
+		for (variable, name) in (("XDG_CACHE_HOME", "cache"), ("XDG_CONFIG_HOME", "config"), ("XDG_DATA_HOME", "data"), ("XDG_RUNTIME_DIR", "runtime")):
+			self.environment[variable] = os.path.join(self.directory.name, name)
+			os.makedirs(self.environment[variable], mode = 0o700)
+
+		cache_dir = os.path.join(self.environment["XDG_CACHE_HOME"], "chameleon")
+		os.makedirs(cache_dir)
+
+		shaders = ShaderIndex(ShaderCache(os.path.join(cache_dir, "shader_cache.sqlite"), os.path.join(cache_dir, "thumbnails.bin")))
+		shaders.basepath = self.directory.name
+		shaders.homepath = self.directory.name
+		shaders.pakdir = "pkg"
+
+		for source in range(SOURCES):
+			source_path = "pkg/set" + str(source) + ".pk3"
+			shaders.shader_sources.append(source_path)
+			shaders.source_records[source_path] = ("signature", [
+				("texture", "set%d/texture%d" % (source, texture), "textures/set%d/texture%d.tga" % (source, texture), None, None, 0, 256, 256)
+				for texture in range(TEXTURES_PER_SOURCE)
+			])
+			shaders.dirty_sources.add(source_path)
+
+		shaders.writeCache()
+		shaders.cache.close()
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def __runBenchmark(self, window_limit, cache_limit):
+		"Returns the exit status and the output of the benchmark."
+		process = subprocess.run(
+			[sys.executable, CHAMELEON, "--startup-benchmark", "--max-window-time", str(window_limit), "--max-cache-time", str(cache_limit)],
+			env = self.environment, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True, timeout = 60
+		)
+
+		return (process.returncode, process.stdout + process.stderr)
+
+	def test_startup_time(self):
+		(status, output) = self.__runBenchmark(WINDOW_TIME_LIMIT, CACHE_TIME_LIMIT)
+
+		self.assertIn(str(SOURCES * TEXTURES_PER_SOURCE) + " shaders", output)
+		self.assertEqual(status, 0, output)
+
+	def test_limit_exceeded(self):
+		(status, output) = self.__runBenchmark(WINDOW_TIME_LIMIT, 0)
+
+		self.assertIn("Shader cache read after more than", output)
+		self.assertEqual(status, 1, output)
+
+
+if __name__ == "__main__":
+	unittest.main()